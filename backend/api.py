@@ -1,21 +1,60 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import gzip
+import hashlib
+import hmac
+import http.client
 import json
 import logging
-from collections import defaultdict
+import os
+import queue
+import resource
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from typing import List
 
 import anndata
+import h5py
+import numpy as np
 
 import falcon
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest, multiprocess
 
 from wsgiref import simple_server
 
 import scipy.sparse
 from falcon import HTTPStatus
-import urllib.request
-from datetime import datetime
+import urllib.parse
+
+from data_preparation.wormcells_formats import COEXPRESSION_METRICS, COEXPRESSION_NEIGHBORS_KEY, \
+    COEXPRESSION_SIMILARITIES_KEY, HISTOGRAM_TENSOR_FORMAT, SWARMPLOT_COLUMNAR_FORMAT, SWARMPLOT_STATS, \
+    find_nearest_profiles, normalize_gene_profiles, read_names
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import gunicorn.app.base
+except ImportError:
+    gunicorn = None
 
 
 logger = logging.getLogger(__name__)
@@ -35,93 +74,1631 @@ class HandleCORS(object):
             raise HTTPStatus(falcon.HTTP_200, body='\n')
 
 
+STORE_INDEX_FILE_NAME = 'index.json'
+STORE_FORMAT_VERSION = 1
+# stats used to rank the genes in the swarmplot, the values are the sort_by parameter of the API
+SWARMPLOT_SORT_STATS = {'p_value': 'proba_not_de', 'lfc': 'lfc_mean', 'expr': 'scale1'}
+DEFAULT_PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'wormcells-viz-profiles')
+
+# prometheus metrics, exposed by MetricsReader. With several gunicorn workers, the PROMETHEUS_MULTIPROC_DIR environment
+# variable must point to an empty directory, where each worker writes its values so that they can be aggregated
+REQUESTS = Counter('wormcells_requests_total', 'Requests handled by the API', ['route', 'method', 'status'])
+REQUEST_DURATION = Histogram('wormcells_request_duration_seconds', 'Time spent handling the requests',
+                             ['route', 'method'],
+                             buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+RESPONSE_SIZE = Histogram('wormcells_response_size_bytes', 'Size of the response bodies as sent, after compression',
+                          ['route'], buckets=[4 ** exponent for exponent in range(4, 14)])
+RESPONSE_CACHE_RESULTS = Counter('wormcells_response_cache_total', 'Lookups of the cacheable responses in the '
+                                 'response cache, by result: hit, miss or not_modified', ['route', 'result'])
+EXCLUDED_ENTITIES = Counter('wormcells_excluded_entities_total',
+                            'Requested genes and cells that are not in the dataset', ['query_type'])
+DATASET_LOAD_DURATION = Gauge('wormcells_dataset_load_seconds', 'Time spent loading each part of the datasets',
+                              ['dataset', 'data_type'], multiprocess_mode='max')
+DATASET_SIZE = Gauge('wormcells_dataset_size_bytes', 'Size of the arrays of the datasets, held in memory, memory '
+                     'mapped or read from HDF5 files on demand', ['dataset', 'data_type', 'storage'],
+                     multiprocess_mode='max')
+DATASET_LOADED = Gauge('wormcells_dataset_loaded', 'Number of processes that loaded each dataset, the workers '
+                       'forked after a dataset is loaded share it with their parent', ['dataset'],
+                       multiprocess_mode='livesum')
+DATASET_EVICTIONS = Counter('wormcells_dataset_evictions_total', 'Datasets unloaded to stay within the memory budget',
+                            ['dataset'])
+DATASET_RELOADS = Counter('wormcells_dataset_reloads_total', 'Reloads of the datasets whose files changed, by outcome: '
+                          'ok or error', ['dataset', 'outcome'])
+WORKER_MAX_RSS = Gauge('wormcells_worker_max_rss_bytes', 'Peak resident memory of each worker process',
+                       multiprocess_mode='liveall')
+WORMBASE_REQUEST_DURATION = Histogram('wormcells_wormbase_request_duration_seconds',
+                                      'Time spent in the requests to the WormBase REST API', ['outcome'],
+                                      buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+
+def read_store_index(store_dir: str):
+    with open(os.path.join(store_dir, STORE_INDEX_FILE_NAME)) as index_file:
+        index = json.load(index_file)
+    if index.get('format_version') != STORE_FORMAT_VERSION:
+        raise ValueError(f"unsupported store format version in {store_dir}: {index.get('format_version')}")
+    return index
+
+
+def get_hdf5_format(file_path: str):
+    """get the wormcells-viz format of an HDF5 file written by data_preparation, or None for anndata files"""
+    if not h5py.is_hdf5(file_path):
+        return None
+    with h5py.File(file_path, 'r') as h5_file:
+        return h5_file.attrs.get('wormcells_format')
+
+
+def get_paths_signature(paths: List[str]):
+    """size and modification time of the data files, or of the files in a store directory, to detect changed files
+    without reading them. Returns None if a file is missing, eg while it is replaced"""
+    try:
+        return [(file_path, os.path.getsize(file_path), os.stat(file_path).st_mtime_ns) for path in paths
+                for file_path in (sorted(os.path.join(path, file_name) for file_name in os.listdir(path))
+                                  if os.path.isdir(path) else [path])]
+    except OSError:
+        return None
+
+
+def compute_data_version(paths: List[str], signature: list = None, sample_size: int = 1024 * 1024):
+    """hash the signature of the data files, or of the files in a store directory, plus the first and the last
+    sample_size bytes of each file
+
+    The sampled bytes alone would keep the version of a file regenerated with the same size, header and tail, the
+    signature (taken before loading the files when given) gives a new version to any rewritten file, without reading
+    several GB at startup.
+    """
+    signature = signature if signature is not None else get_paths_signature(paths)
+    version = hashlib.sha256(json.dumps(signature).encode())
+    for path in paths:
+        file_paths = sorted(os.path.join(path, file_name) for file_name in os.listdir(path)) if os.path.isdir(path) \
+            else [path]
+        for file_path in file_paths:
+            size = os.path.getsize(file_path)
+            version.update(f"{os.path.basename(file_path)}:{size}".encode())
+            with open(file_path, 'rb') as data_file:
+                version.update(data_file.read(sample_size))
+                data_file.seek(max(size - sample_size, 0))
+                version.update(data_file.read(sample_size))
+    return version.hexdigest()[:16]
+
+
+def get_storage_sizes(arrays):
+    """total size in bytes of the arrays held in memory, memory mapped, or read on demand from HDF5 files"""
+    sizes = {'memory': 0, 'mapped': 0, 'hdf5': 0}
+    for array in arrays:
+        if isinstance(array, h5py.Dataset):
+            sizes['hdf5'] += array.size * array.dtype.itemsize
+        elif scipy.sparse.issparse(array):
+            sizes['memory'] += array.data.nbytes + array.indices.nbytes + array.indptr.nbytes
+        else:
+            sizes['mapped' if isinstance(array, np.memmap) else 'memory'] += np.asarray(array).nbytes
+    return sizes
+
+
+def get_max_rss_bytes():
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+# time spent in each phase of the current request, only set when the TimingMiddleware is installed
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+@contextlib.contextmanager
+def timing_span(name: str):
+    """add the time spent in the block to the phase of the current request, does nothing if timing is disabled"""
+    timings = request_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+def load_store_array(store_dir: str, file_name: str):
+    # read-only memory map: pages come from the OS page cache and are shared by every worker and dataset that maps
+    # the same file, so worker RSS does not grow with the dataset size
+    return np.load(os.path.join(store_dir, file_name), mmap_mode='r')
+
+
+class HeatmapData(object):
+    """Heatmap matrix of shape (cells x genes) with name -> position maps
+
+    The neighbors are the positions and similarities of the most co-expressed genes of each gene, of shape
+    (genes x number of neighbors) for each metric, when they were precomputed by data_preparation.py.
+    """
+
+    def __init__(self, matrix, cells: List[str], genes: List[str], neighbors: dict = None):
+        self.matrix = matrix
+        self.cells = list(cells)
+        self.genes = list(genes)
+        self.cell_idx = {cell_name: idx for idx, cell_name in enumerate(self.cells)}
+        self.gene_idx = {gene_id: idx for idx, gene_id in enumerate(self.genes)}
+        self.neighbors = neighbors or {}
+        # normalized gene profiles for each metric, computed on the first co-expression search
+        self.profiles = {}
+        self._profiles_lock = threading.Lock()
+
+    @classmethod
+    def from_anndata(cls, file_path: str):
+        adata = anndata.read_h5ad(file_path)
+        matrix = adata.X.toarray() if scipy.sparse.issparse(adata.X) else np.asarray(adata.X)
+        neighbors = {metric: (np.asarray(adata.varm[COEXPRESSION_NEIGHBORS_KEY.format(metric)]),
+                              np.asarray(adata.varm[COEXPRESSION_SIMILARITIES_KEY.format(metric)]))
+                     for metric in COEXPRESSION_METRICS if COEXPRESSION_NEIGHBORS_KEY.format(metric) in adata.varm}
+        return cls(matrix, adata.obs_names, adata.var_names, neighbors)
+
+    @classmethod
+    def from_store(cls, store_dir: str):
+        index = read_store_index(store_dir)['heatmap']
+        neighbors = {metric: (load_store_array(store_dir, COEXPRESSION_NEIGHBORS_KEY.format(metric) + '.npy'),
+                              load_store_array(store_dir, COEXPRESSION_SIMILARITIES_KEY.format(metric) + '.npy'))
+                     for metric in index.get('coexpression_neighbors', [])}
+        return cls(load_store_array(store_dir, 'heatmap.npy'), index['cells'], index['genes'], neighbors)
+
+    def get_profiles(self, metric: str):
+        if metric not in self.profiles:
+            with self._profiles_lock:
+                if metric not in self.profiles:
+                    self.profiles[metric] = normalize_gene_profiles(self.matrix, metric)
+        return self.profiles[metric]
+
+    def get_arrays(self):
+        return [self.matrix] + [array for arrays in self.neighbors.values() for array in arrays] + \
+            list(self.profiles.values())
+
+    def write_store(self, store_dir: str):
+        np.save(os.path.join(store_dir, 'heatmap.npy'), np.asarray(self.matrix))
+        for metric, (neighbors, similarities) in self.neighbors.items():
+            np.save(os.path.join(store_dir, COEXPRESSION_NEIGHBORS_KEY.format(metric) + '.npy'), np.asarray(neighbors))
+            np.save(os.path.join(store_dir, COEXPRESSION_SIMILARITIES_KEY.format(metric) + '.npy'),
+                    np.asarray(similarities))
+        return {'cells': self.cells, 'genes': self.genes, 'coexpression_neighbors': list(self.neighbors)}
+
+
+class HistogramData(object):
+    """Histogram counts for each gene, each one of shape (cells x bins)
+
+    Counts are either read from a (genes x cells x bins) tensor, memory mapped or stored in HDF5 chunked by gene, or,
+    for the original h5ad layout, from the sparse layer stored for each gene.
+    """
+
+    def __init__(self, cells: List[str], genes: List[str], bins: List[str], tensor=None, layers=None):
+        self.cells = list(cells)
+        self.genes = list(genes)
+        self.bins = list(bins)
+        self.gene_idx = {gene_id: idx for idx, gene_id in enumerate(self.genes)}
+        self.tensor = tensor
+        self.layers = layers
+
+    @classmethod
+    def from_anndata(cls, file_path: str):
+        adata = anndata.read_h5ad(file_path)
+        return cls(adata.obs_names, adata.layers.keys(), adata.var_names, layers=adata.layers)
+
+    @classmethod
+    def from_tensor_file(cls, file_path: str):
+        # the file stays open for the lifetime of the object, each request reads the single chunk of its gene
+        h5_file = h5py.File(file_path, 'r')
+        return cls(read_names(h5_file, 'cells'), read_names(h5_file, 'genes'),
+                   read_names(h5_file, 'bins'), tensor=h5_file['counts'])
+
+    @classmethod
+    def from_store(cls, store_dir: str):
+        index = read_store_index(store_dir)['histogram']
+        return cls(index['cells'], index['genes'], index['bins'], tensor=load_store_array(store_dir, 'histogram.npy'))
+
+    def get_gene_counts(self, gene_id: str):
+        """get the counts of a gene as an array of shape (cells x bins), raises KeyError for unknown genes"""
+        if self.tensor is not None:
+            return self.tensor[self.gene_idx[gene_id]]
+        layer = self.layers[gene_id]
+        return layer.toarray() if scipy.sparse.issparse(layer) else np.asarray(layer)
+
+    def get_arrays(self):
+        return [self.tensor] if self.tensor is not None else list(self.layers.values())
+
+    def write_store(self, store_dir: str):
+        tensor = np.lib.format.open_memmap(os.path.join(store_dir, 'histogram.npy'), mode='w+', dtype=np.int16,
+                                           shape=(len(self.genes), len(self.cells), len(self.bins)))
+        for idx, gene_id in enumerate(self.genes):
+            tensor[idx] = self.get_gene_counts(gene_id)
+        tensor.flush()
+        return {'cells': self.cells, 'genes': self.genes, 'bins': self.bins}
+
+
+class SwarmplotData(object):
+    """Swarmplot data as arrays
+
+    - stats[name]: one vs all DE statistic of shape (cells x genes) for each name in SWARMPLOT_STATS
+    - lfc: pairwise median log fold change of shape (group1 cells x group2 cells x genes)
+    - heatmap: log10 expression of shape (cells x genes), used to show the expression of each cell on mouseover
+    - gene_order[stat]: gene positions sorted by each ranking stat, of shape (2 x cells x genes), ascending first
+    - positive_lfc: boolean mask of shape (cells x genes) of the genes with positive one vs all lfc_mean
+
+    The rankings and the mask are computed once at load time when they are not provided by the store.
+    """
+
+    def __init__(self, cells: List[str], genes: List[str], stats, lfc, heatmap, gene_order=None,
+                 positive_lfc=None):
+        self.cells = list(cells)
+        self.genes = list(genes)
+        self.cell_idx = {cell_name: idx for idx, cell_name in enumerate(self.cells)}
+        self.gene_idx = {gene_id: idx for idx, gene_id in enumerate(self.genes)}
+        self.stats = stats
+        self.lfc = lfc
+        self.heatmap = heatmap
+        self.gene_order = gene_order if gene_order is not None else \
+            {stat: self.rank_genes(stats[stat]) for stat in SWARMPLOT_SORT_STATS.values()}
+        self.positive_lfc = positive_lfc if positive_lfc is not None else np.asarray(stats['lfc_mean']) > 0
+
+    @staticmethod
+    def rank_genes(values):
+        values = np.asarray(values, dtype=np.float64)
+        # negating keeps NaNs at the end when sorting in descending order, like pandas does
+        return np.stack([np.argsort(values, axis=1, kind='stable'),
+                         np.argsort(-values, axis=1, kind='stable')]).astype(np.int32)
+
+    def get_best_genes_loc(self, sort_stat: str, cell_loc: int, ascending: bool, max_num_genes: int):
+        return np.asarray(self.gene_order[sort_stat][0 if ascending else 1, cell_loc, 0:max_num_genes],
+                          dtype=np.intp)
+
+    @classmethod
+    def from_anndata(cls, file_path: str):
+        adata = anndata.read_h5ad(file_path)
+        cells = list(adata.obs_names)
+        genes = list(adata.var_names)
+        stats = {stat: np.stack([adata.uns[cell_name][stat].reindex(genes).values for cell_name in cells])
+                 for stat in SWARMPLOT_STATS}
+        lfc = np.stack([np.asarray(adata.layers[cell_name]) for cell_name in cells])
+        heatmap = adata.uns['heatmap'].reindex(index=genes, columns=cells).values.T
+        return cls(cells, genes, stats, lfc, heatmap)
+
+    @classmethod
+    def from_columnar_file(cls, file_path: str):
+        with h5py.File(file_path, 'r') as h5_file:
+            return cls(read_names(h5_file, 'cells'), read_names(h5_file, 'genes'),
+                       {stat: h5_file[stat][()] for stat in SWARMPLOT_STATS}, h5_file['lfc_median_pairwise'][()],
+                       h5_file['heatmap'][()])
+
+    @classmethod
+    def from_store(cls, store_dir: str):
+        index = read_store_index(store_dir)['swarmplot']
+        stats = load_store_array(store_dir, 'swarmplot_stats.npy')
+        gene_order, positive_lfc = None, None
+        # stores written before the rankings were added are ranked at load time
+        if 'sort_stats' in index:
+            gene_order = load_store_array(store_dir, 'swarmplot_gene_order.npy')
+            gene_order = {stat: gene_order[idx] for idx, stat in enumerate(index['sort_stats'])}
+            positive_lfc = load_store_array(store_dir, 'swarmplot_positive_lfc.npy')
+        return cls(index['cells'], index['genes'], {stat: stats[idx] for idx, stat in enumerate(index['stats'])},
+                   load_store_array(store_dir, 'swarmplot_lfc.npy'),
+                   load_store_array(store_dir, 'swarmplot_heatmap.npy'),
+                   gene_order=gene_order, positive_lfc=positive_lfc)
+
+    def get_arrays(self):
+        return [*self.stats.values(), self.lfc, self.heatmap, *self.gene_order.values(), self.positive_lfc]
+
+    def write_store(self, store_dir: str):
+        np.save(os.path.join(store_dir, 'swarmplot_stats.npy'),
+                np.stack([np.asarray(self.stats[stat]) for stat in SWARMPLOT_STATS]))
+        np.save(os.path.join(store_dir, 'swarmplot_lfc.npy'), np.asarray(self.lfc))
+        np.save(os.path.join(store_dir, 'swarmplot_heatmap.npy'), np.asarray(self.heatmap))
+        sort_stats = list(self.gene_order.keys())
+        np.save(os.path.join(store_dir, 'swarmplot_gene_order.npy'),
+                np.stack([np.asarray(self.gene_order[stat]) for stat in sort_stats]))
+        np.save(os.path.join(store_dir, 'swarmplot_positive_lfc.npy'), np.asarray(self.positive_lfc))
+        return {'cells': self.cells, 'genes': self.genes, 'stats': SWARMPLOT_STATS, 'sort_stats': sort_stats}
+
+
+class NameIndex(object):
+    """Case insensitive prefix and substring search over names, eg gene ids, with optional extra labels for each name,
+    eg gene names
+
+    The lowercased labels are kept sorted for the prefix search with bisect, and joined in a single string for the
+    substring search with str.find, so that a query doesn't loop over all the labels in Python.
+    """
+
+    def __init__(self, names: List[str], extra_labels: dict = None):
+        self.names = list(names)
+        name_pos = {name: pos for pos, name in enumerate(self.names)}
+        # (label, position of its name), with each name as its own label
+        labels = [(name.lower(), pos) for pos, name in enumerate(self.names)] + \
+                 [(label.lower(), name_pos[name]) for name, label in (extra_labels or {}).items() if name in name_pos
+                  and label]
+        labels.sort()
+        self.sorted_labels = [label for label, _ in labels]
+        self.sorted_positions = [pos for _, pos in labels]
+        self.text = '\n'.join(self.sorted_labels)
+        self.offsets = []
+        offset = 0
+        for label in self.sorted_labels:
+            self.offsets.append(offset)
+            offset += len(label) + 1
+
+    def search(self, query: str, limit: int = 20):
+        """get the positions of the names with a label that starts with the query, then of the ones with a label that
+        contains it, in the order of the labels"""
+        query = query.lower()
+        if not query or '\n' in query:
+            return []
+        positions = {}
+        start = bisect.bisect_left(self.sorted_labels, query)
+        end = bisect.bisect_left(self.sorted_labels, query + '\uffff', lo=start)
+        for label_idx in range(start, end):
+            if len(positions) == limit:
+                return list(positions)
+            positions.setdefault(self.sorted_positions[label_idx])
+        offset = self.text.find(query)
+        while offset != -1 and len(positions) < limit:
+            label_idx = bisect.bisect_right(self.offsets, offset) - 1
+            positions.setdefault(self.sorted_positions[label_idx])
+            # continue after the label, each label is matched once
+            offset = self.text.find(query, self.offsets[label_idx] + len(self.sorted_labels[label_idx]) + 1)
+        return list(positions)
+
+
+DATASET_FILE_TYPES = ['heatmap', 'histogram', 'swarmplot']
+
+
 class FileStorageEngine(object):
+    """The heatmap, histogram and swarmplot data of a dataset
 
-    def __init__(self, heatmap_file_path, histogram_file_path, swarmplot_file_path):
-        self.heatmap = anndata.read_h5ad(heatmap_file_path)
-        self.histogram = anndata.read_h5ad(histogram_file_path)
-        self.swarmplot = anndata.read_h5ad(swarmplot_file_path)
-        logger.info("files successfully loaded")
-
-    def get_data_heatmap(self, gene_ids: List[str] = None, cell_names: List[str] = None, dataset: str = 'cengen'):
-        gene_ids = gene_ids if gene_ids else self.get_all_genes()[0:20]
-        cell_names = sorted(list(set(cell_names if cell_names else self.get_all_cells()[0:20])), reverse=True)
-        results_dict = defaultdict(dict)
-        valid_cell_names = self.get_all_cells()
-        valid_gene_ids = self.get_all_genes()
-        excluded_cells = set()
-        excluded_genes = set()
-        for cell_name in cell_names:
-            if cell_name not in valid_cell_names:
-                excluded_cells.add(cell_name)
-                continue
-            for gene_id in gene_ids:
-                if gene_id not in valid_gene_ids:
-                    excluded_genes.add(gene_id)
-                    continue
-                results_dict[gene_id][cell_name] = float(self.heatmap[cell_name, gene_id].X)
-        excluded_entities = [*excluded_cells, *excluded_genes]
-        return dict(results_dict), excluded_entities
+    The three parts are loaded in parallel threads, each one is set as an attribute once loaded, and accessing a part
+    that is still loading waits for it. Queries can check is_ready first to avoid waiting. A part that fails to load,
+    eg on a transient I/O error, is loaded again after a delay that doubles with each attempt, and only marked as
+    failed after load_attempts attempts.
+    """
+
+    load_attempts = 4
+    load_retry_delay = 1
+
+    def __init__(self, heatmap_file_path, histogram_file_path, swarmplot_file_path, name: str = 'default',
+                 wait: bool = True):
+        # each path is either a file produced by data_preparation.py or a store directory written by write_store,
+        # whose arrays are memory mapped read-only
+        self.name = name
+        self.paths = {'heatmap': heatmap_file_path, 'histogram': histogram_file_path,
+                      'swarmplot': swarmplot_file_path}
+        # taken before loading, so that files replaced while loading are reloaded
+        self.signature = get_paths_signature([heatmap_file_path, histogram_file_path, swarmplot_file_path])
+        self.version = compute_data_version([heatmap_file_path, histogram_file_path, swarmplot_file_path],
+                                            self.signature)
+        self.storage_sizes = {}
+        # catalogs and search indexes, built on first use
+        self._serialized_catalogs = {}
+        self._cell_index = None
+        self._gene_index = None
+        # (gene id, metric) -> nearest genes, least recently used first
+        self._similar_genes = OrderedDict()
+        self._similar_genes_lock = threading.Lock()
+        self.load_status = {data_type: {'state': 'loading', 'seconds': None, 'error': None}
+                            for data_type in DATASET_FILE_TYPES}
+        self._load_started = time.perf_counter()
+        self._loaded_events = {data_type: threading.Event() for data_type in DATASET_FILE_TYPES}
+        for data_type in DATASET_FILE_TYPES:
+            threading.Thread(target=self.load_part, args=(data_type,), name=f"load-{name}-{data_type}",
+                             daemon=True).start()
+        if wait:
+            self.wait()
+            logger.info(f"files of dataset {name} successfully loaded, dataset version {self.version}")
+
+    @staticmethod
+    def load_heatmap(file_path: str):
+        return HeatmapData.from_store(file_path) if os.path.isdir(file_path) else HeatmapData.from_anndata(file_path)
+
+    @staticmethod
+    def load_histogram(file_path: str):
+        if os.path.isdir(file_path):
+            return HistogramData.from_store(file_path)
+        elif get_hdf5_format(file_path) == HISTOGRAM_TENSOR_FORMAT:
+            return HistogramData.from_tensor_file(file_path)
+        return HistogramData.from_anndata(file_path)
+
+    @staticmethod
+    def load_swarmplot(file_path: str):
+        if os.path.isdir(file_path):
+            return SwarmplotData.from_store(file_path)
+        elif get_hdf5_format(file_path) == SWARMPLOT_COLUMNAR_FORMAT:
+            return SwarmplotData.from_columnar_file(file_path)
+        return SwarmplotData.from_anndata(file_path)
+
+    def load_part(self, data_type: str):
+        start = time.perf_counter()
+        try:
+            for attempt in range(1, self.load_attempts + 1):
+                try:
+                    data = getattr(self, 'load_' + data_type)(self.paths[data_type])
+                    break
+                except Exception as e:
+                    if attempt == self.load_attempts:
+                        raise
+                    delay = self.load_retry_delay * 2 ** (attempt - 1)
+                    logger.warning(f"failed to load the {data_type} of dataset {self.name} from "
+                                   f"{self.paths[data_type]}, attempt {attempt} of {self.load_attempts}, retrying in "
+                                   f"{delay}s: {e!r}")
+                    self.load_status[data_type].update(error=str(e))
+                    time.sleep(delay)
+        except Exception as e:
+            logger.exception(f"failed to load the {data_type} of dataset {self.name} from {self.paths[data_type]}")
+            self.load_status[data_type].update(state='failed', seconds=time.perf_counter() - start, error=str(e))
+        else:
+            setattr(self, data_type, data)
+            self.update_storage_sizes(data_type)
+            DATASET_LOAD_DURATION.labels(self.name, data_type).set(time.perf_counter() - start)
+            WORKER_MAX_RSS.set(get_max_rss_bytes())
+            self.load_status[data_type].update(state='ready', seconds=time.perf_counter() - start)
+            logger.info(f"{data_type} of dataset {self.name} loaded in {time.perf_counter() - start:.1f}s")
+        finally:
+            self._loaded_events[data_type].set()
+
+    def update_storage_sizes(self, data_type: str):
+        self.storage_sizes[data_type] = get_storage_sizes(getattr(self, data_type).get_arrays())
+        for storage, size in self.storage_sizes[data_type].items():
+            DATASET_SIZE.labels(self.name, data_type, storage).set(size)
+
+    def __getattr__(self, name: str):
+        # only called for the parts that are not loaded yet
+        if name in DATASET_FILE_TYPES:
+            self.wait([name])
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def wait(self, data_types: List[str] = DATASET_FILE_TYPES):
+        """wait for the given parts to be loaded, raises an error if one of them failed to load"""
+        for data_type in data_types:
+            self._loaded_events[data_type].wait()
+            if self.load_status[data_type]['state'] == 'failed':
+                raise RuntimeError(f"failed to load the {data_type} of dataset {self.name}: "
+                                   f"{self.load_status[data_type]['error']}")
 
-    def get_data_histogram(self, gene_id: str = None, cell_names: List[str] = None, sort_by_freq: bool = False):
+    def is_ready(self, data_types: List[str] = DATASET_FILE_TYPES):
+        return all(self.load_status[data_type]['state'] == 'ready' for data_type in data_types)
+
+    def get_failed_parts(self, data_types: List[str] = DATASET_FILE_TYPES):
+        return [data_type for data_type in data_types if self.load_status[data_type]['state'] == 'failed']
+
+    def get_load_status(self):
+        """state and load time of each part, the time is the elapsed one for the parts still loading"""
+        elapsed = time.perf_counter() - self._load_started
+        return {data_type: dict(status, seconds=status['seconds'] if status['seconds'] is not None else elapsed)
+                for data_type, status in self.load_status.items()}
+
+    def get_memory_size(self):
+        """size in bytes of the arrays held in memory by the loaded parts, the memory mapped and HDF5 arrays are not
+        counted"""
+        return sum(storage_sizes['memory'] for storage_sizes in list(self.storage_sizes.values()))
+
+    def write_store(self, store_dir: str):
+        """convert the loaded data to flat .npy arrays plus an index file that can be memory mapped by the workers
+
+        The files are written to a temporary directory next to the store and moved into it, so that a store can be
+        rewritten while it is served: the workers keep reading the replaced files until they reload the dataset.
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(os.path.abspath(store_dir)) + '.tmp-',
+                                   dir=os.path.dirname(os.path.abspath(store_dir)))
+        index = {'format_version': STORE_FORMAT_VERSION,
+                 'heatmap': self.heatmap.write_store(tmp_dir),
+                 'histogram': self.histogram.write_store(tmp_dir),
+                 'swarmplot': self.swarmplot.write_store(tmp_dir)}
+        with open(os.path.join(tmp_dir, STORE_INDEX_FILE_NAME), 'w') as index_file:
+            json.dump(index, index_file)
+        # the index is moved last, so that a partially written store is never picked up
+        for file_name in sorted(os.listdir(tmp_dir), key=lambda file_name: file_name == STORE_INDEX_FILE_NAME):
+            os.replace(os.path.join(tmp_dir, file_name), os.path.join(store_dir, file_name))
+        os.rmdir(tmp_dir)
+        logger.info("store successfully written to " + store_dir)
+
+    def get_heatmap_arrays(self, gene_ids: List[str] = None, cell_names: List[str] = None):
+        """get the heatmap values as an array of shape (cells x genes), with the valid gene ids and cell names, in
+        the order of the array, and the excluded entities"""
+        with timing_span('lookup'):
+            gene_ids = gene_ids if gene_ids else self.heatmap.genes[0:20]
+            cell_names = sorted(list(set(cell_names if cell_names else self.heatmap.cells[0:20])), reverse=True)
+            valid_cell_names = [cell_name for cell_name in cell_names if cell_name in self.heatmap.cell_idx]
+            excluded_cells = set(cell_names) - set(valid_cell_names)
+            # genes are only validated when at least one cell is valid, and duplicates keep their first position
+            valid_gene_ids = list(dict.fromkeys(gene_id for gene_id in gene_ids if gene_id in self.heatmap.gene_idx)) \
+                if valid_cell_names else []
+            excluded_genes = {gene_id for gene_id in gene_ids if gene_id not in self.heatmap.gene_idx} \
+                if valid_cell_names else set()
+            cells_loc = [self.heatmap.cell_idx[cell_name] for cell_name in valid_cell_names]
+            genes_loc = [self.heatmap.gene_idx[gene_id] for gene_id in valid_gene_ids]
+        with timing_span('gather'):
+            values = self.heatmap.matrix[np.ix_(cells_loc, genes_loc)]
+        return valid_gene_ids, valid_cell_names, values, [*excluded_cells, *excluded_genes]
+
+    def get_data_heatmap(self, gene_ids: List[str] = None, cell_names: List[str] = None):
+        gene_ids, cell_names, values, excluded_entities = self.get_heatmap_arrays(gene_ids, cell_names)
+        results_dict = {gene_id: dict(zip(cell_names, values[:, gene_pos].tolist()))
+                        for gene_pos, gene_id in enumerate(gene_ids)}
+        return results_dict, excluded_entities
+
+    def get_histogram_heatmap_values(self, gene_ids: List[str]):
+        """get the heatmap values of the histogram cells with a single gather, as one dict of cell values per gene"""
+        cell_names = [cell_name for cell_name in self.histogram.cells if cell_name in self.heatmap.cell_idx]
+        gene_ids = [gene_id for gene_id in dict.fromkeys(gene_ids) if gene_id in self.heatmap.gene_idx]
+        values = self.heatmap.matrix[np.ix_([self.heatmap.cell_idx[cell_name] for cell_name in cell_names],
+                                            [self.heatmap.gene_idx[gene_id] for gene_id in gene_ids])]
+        return {gene_id: dict(zip(cell_names, values[:, gene_pos].tolist())) for gene_pos, gene_id in
+                enumerate(gene_ids)}
+
+    def get_histogram_arrays(self, gene_id: str = None, cell_names: List[str] = None, sort_by_freq: bool = False,
+                             heatmap_values: dict = None):
+        """get the histogram counts as an array of shape (cells x bins) with the gene id, the cell names in the order
+        of the array and, if sort_by_freq is set, the heatmap value of each cell"""
         cell_names = set(cell_names) if cell_names else None
         gene_id = gene_id if gene_id else self.get_all_genes()[0]
-        return {cell_name: (self.histogram.layers[gene_id][idx].toarray()[0].tolist() if
-                            type(self.histogram.layers[gene_id][idx]) == scipy.sparse.csr_matrix else
-                            self.histogram.layers[gene_id][idx].tolist(),
-                            (float(self.heatmap[cell_name, gene_id].X) if sort_by_freq else 0)) for
-                idx, cell_name in enumerate(self.histogram.obs.index) if not cell_names or cell_name in
-                cell_names}, gene_id
+        with timing_span('read'):
+            counts = np.asarray(self.histogram.get_gene_counts(gene_id))
+        with timing_span('lookup'):
+            cells_loc = [idx for idx, cell_name in enumerate(self.histogram.cells) if not cell_names or
+                         cell_name in cell_names]
+            valid_cell_names = [self.histogram.cells[idx] for idx in cells_loc]
+            freqs = None
+            if sort_by_freq:
+                heatmap_values = heatmap_values if heatmap_values is not None else \
+                    self.get_histogram_heatmap_values([gene_id])[gene_id]
+                freqs = [heatmap_values[cell_name] for cell_name in valid_cell_names]
+        with timing_span('gather'):
+            counts = counts[cells_loc]
+        return gene_id, valid_cell_names, counts, freqs
 
-    def get_data_swarmplot(self, cell: str = None, sort_by: str = 'p_value', ascending: bool = True,
-                           max_num_genes: int = 50):
+    def get_data_histogram(self, gene_id: str = None, cell_names: List[str] = None, sort_by_freq: bool = False,
+                           heatmap_values: dict = None):
+        gene_id, cell_names, counts, freqs = self.get_histogram_arrays(gene_id, cell_names, sort_by_freq,
+                                                                       heatmap_values)
+        return {cell_name: (counts[idx].tolist(), (freqs[idx] if freqs is not None else 0)) for
+                idx, cell_name in enumerate(cell_names)}, gene_id
+
+    def get_swarmplot_arrays(self, cell: str = None, sort_by: str = 'p_value', ascending: bool = True,
+                             max_num_genes: int = 50):
+        """get the swarmplot data of the best genes for a cell, as a dict of arrays
+
+        - gene_ids and cell_names, in the order of the arrays
+        - ref_vals: heatmap values of the cell for each gene
+        - heatmap_vals, lfc_vals, positive_lfc: arrays of shape (cells x genes) with the heatmap value of each cell,
+          the median lfc of each cell vs the selected cell and whether the cell is shown for the gene
+        """
         cell = cell if cell else self.get_all_cells()[0]
         cell_names = self.get_all_cells()
-        best_genes = []
         sort_by = sort_by if sort_by else 'p_value'
         max_num_genes = max_num_genes if max_num_genes else 50
-        if sort_by == 'p_value':
-            best_genes = list(self.swarmplot.uns[cell].proba_not_de.sort_values(ascending=ascending)[0:max_num_genes].index.values)
-        elif sort_by == 'lfc':
-            best_genes = list(self.swarmplot.uns[cell].lfc_mean.sort_values(ascending=ascending)[0:max_num_genes].index.values)
-        elif sort_by == 'expr':
-            best_genes = list(self.swarmplot.uns[cell].scale1.sort_values(ascending=ascending)[0:max_num_genes].index.values)
-        best_genes_loc = {gene_id: self.swarmplot.var_names.get_loc(gene_id) for gene_id in best_genes}
-        cell_names_loc = {cell_name: self.swarmplot.obs_names.get_loc(cell_name) for cell_name in cell_names}
+        with timing_span('lookup'):
+            cell_loc = self.swarmplot.cell_idx[cell]
+            sort_stat = SWARMPLOT_SORT_STATS.get(sort_by)
+            cell_names_loc = np.array([self.swarmplot.cell_idx[cell_name] for cell_name in cell_names],
+                                      dtype=np.intp)
+        with timing_span('sort'):
+            best_genes_loc = self.swarmplot.get_best_genes_loc(sort_stat, cell_loc, ascending, max_num_genes) if \
+                sort_stat else np.array([], dtype=np.intp)
+        with timing_span('gather'):
+            return cell, {
+                'gene_ids': [self.swarmplot.genes[gene_loc] for gene_loc in best_genes_loc.tolist()],
+                'cell_names': cell_names,
+                'ref_vals': self.swarmplot.heatmap[cell_loc, best_genes_loc],
+                'heatmap_vals': self.swarmplot.heatmap[np.ix_(cell_names_loc, best_genes_loc)],
+                'lfc_vals': self.swarmplot.lfc[np.ix_(cell_names_loc, [cell_loc], best_genes_loc)][:, 0, :],
+                'positive_lfc': self.swarmplot.positive_lfc[np.ix_(cell_names_loc, best_genes_loc)]}
+
+    def get_data_swarmplot(self, cell: str = None, sort_by: str = 'p_value', ascending: bool = True,
+                           max_num_genes: int = 50):
+        cell, arrays = self.get_swarmplot_arrays(cell, sort_by, ascending, max_num_genes)
+        ref_vals = arrays['ref_vals'].tolist()
+        heatmap_vals = arrays['heatmap_vals'].tolist()
+        lfc_vals = arrays['lfc_vals'].tolist()
+        positive_lfc = arrays['positive_lfc'].tolist()
         results = {}
-        for gene_id in best_genes:
-            ref_val = float(self.swarmplot.uns['heatmap'][cell][gene_id])
-            results[gene_id] = (ref_val, [(cell_name, float(self.swarmplot.uns['heatmap'][cell_name][gene_id]),
-                                           float(self.swarmplot.layers[cell_name][cell_names_loc[cell]][best_genes_loc[gene_id]]))
-                                          for cell_name in cell_names if
-                                          float(self.swarmplot.uns[cell_name].lfc_mean[gene_id]) > 0])
+        for gene_pos, gene_id in enumerate(arrays['gene_ids']):
+            results[gene_id] = (
+                ref_vals[gene_pos], [(cell_name, heatmap_vals[cell_pos][gene_pos], lfc_vals[cell_pos][gene_pos])
+                                     for cell_pos, cell_name in enumerate(arrays['cell_names']) if
+                                     positive_lfc[cell_pos][gene_pos]])
         return cell, results
 
     def get_all_genes(self):
-        return list(self.heatmap.var_names)
+        # the list of the heatmap, not a copy, it must not be modified
+        return self.heatmap.genes
 
     def get_all_cells(self):
-        return list(self.heatmap.obs_names)
+        return self.heatmap.cells
+
+    def get_serialized_catalog(self, catalog: str):
+        """get the json list of all the genes or cells, serialized once"""
+        if catalog not in self._serialized_catalogs:
+            self._serialized_catalogs[catalog] = json.dumps(
+                self.get_all_genes() if catalog == 'genes' else self.get_all_cells()).encode()
+        return self._serialized_catalogs[catalog]
+
+    def search_cells(self, query: str, limit: int = 20):
+        if self._cell_index is None:
+            self._cell_index = NameIndex(self.get_all_cells())
+        return [self._cell_index.names[pos] for pos in self._cell_index.search(query, limit)]
+
+    def search_genes(self, query: str, limit: int = 20, gene_names: dict = None, rebuild_interval: float = 10):
+        """search the gene ids and, if given, the names of the genes, returns the matching gene ids
+
+        The index is built again when gene names were added since it was built, at most every rebuild_interval
+        seconds.
+        """
+        num_names = len(gene_names) if gene_names else 0
+        if self._gene_index is None or (num_names != self._gene_index[1] and
+                                        time.monotonic() - self._gene_index[2] > rebuild_interval):
+            self._gene_index = (NameIndex(self.get_all_genes(), dict(gene_names) if gene_names else None), num_names,
+                                time.monotonic())
+        gene_index = self._gene_index[0]
+        return [gene_index.names[pos] for pos in gene_index.search(query, limit)]
+
+    def get_similar_genes(self, gene_id: str, k: int = 20, metric: str = 'correlation', min_computed: int = 100,
+                          max_cached: int = 4096):
+        """get the ids and similarities of the k genes whose expression across the cells is the most similar to the
+        one of a gene
+
+        The neighbors precomputed by data_preparation.py are used when there are at least k of them. Otherwise they
+        are computed from the normalized gene profiles, at least min_computed of them so that the next queries for
+        the gene with a different k are served from the cache.
+        """
+        gene_loc = self.heatmap.gene_idx[gene_id]
+        precomputed = self.heatmap.neighbors.get(metric)
+        if precomputed is not None and precomputed[0].shape[1] >= k:
+            with timing_span('gather'):
+                return [self.heatmap.genes[loc] for loc in precomputed[0][gene_loc, :k].tolist()], \
+                    precomputed[1][gene_loc, :k].tolist()
+        key = (gene_id, metric)
+        with self._similar_genes_lock:
+            neighbors = self._similar_genes.get(key)
+            if neighbors is not None:
+                self._similar_genes.move_to_end(key)
+        if neighbors is None or (len(neighbors[0]) < k and len(neighbors[0]) < len(self.heatmap.genes) - 1):
+            with timing_span('search'):
+                computed = metric in self.heatmap.profiles
+                locs, similarities = find_nearest_profiles(self.heatmap.get_profiles(metric), [gene_loc],
+                                                           max(k, min_computed))
+                if not computed:
+                    self.update_storage_sizes('heatmap')
+            neighbors = [self.heatmap.genes[loc] for loc in locs[0].tolist()], similarities[0].tolist()
+            with self._similar_genes_lock:
+                self._similar_genes[key] = neighbors
+                while len(self._similar_genes) > max_cached:
+                    self._similar_genes.popitem(last=False)
+        return neighbors[0][:k], neighbors[1][:k]
+
+
+class DatasetRegistry(object):
+    """Datasets served by the API, each one loaded on its first request or by preload
+
+    When the arrays held in memory by the loaded datasets exceed the memory budget, the least recently used datasets
+    are unloaded. Memory mapped stores and HDF5 files read on demand are not counted in the budget, their pages are
+    shared with the other processes and can be dropped by the OS.
+
+    The preloaded datasets are loaded at startup, and the server is only ready once they are loaded. With background
+    loading, get returns a dataset right away while its parts are loading, instead of waiting for them.
+
+    When the files of a loaded dataset change, reload builds the new version in the background while the current one
+    is still served, and swaps it in once loaded. The requests that got the previous version finish with it, and its
+    memory is freed after them. With a watch interval, the files are checked for changes by a thread of each process.
+    """
+
+    def __init__(self, datasets: dict, default: str = None, memory_budget_bytes: int = None,
+                 preloaded: List[str] = None, background: bool = False, watch_interval: float = None):
+        # datasets maps the name of each dataset to the paths of its heatmap, histogram and swarmplot files
+        if not datasets:
+            raise ValueError("no datasets configured")
+        for name, paths in datasets.items():
+            if any(not paths.get(file_type) for file_type in DATASET_FILE_TYPES):
+                raise ValueError(f"dataset {name} needs a path for each of " + ", ".join(DATASET_FILE_TYPES))
+        self.datasets = datasets
+        self.default = default if default is not None else next(iter(datasets))
+        if self.default not in datasets:
+            raise ValueError(f"unknown default dataset {self.default}")
+        self.memory_budget_bytes = memory_budget_bytes
+        self.preloaded = list(preloaded or [])
+        self.background = background
+        self._loaded = OrderedDict()
+        # (signature, version) of the files of the datasets that are not loaded
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in datasets}
+        self._reloading = set()
+        self.watch_interval = watch_interval
+        self._watcher_pid = None
+
+    @classmethod
+    def from_config(cls, config_path: str, memory_budget_bytes: int = None, preload: bool = False,
+                    background: bool = False, watch_interval: float = None):
+        """read the datasets from a json file, see manual_deployment/datasets.example.json"""
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+        if memory_budget_bytes is None and config.get('memory_budget_mb'):
+            memory_budget_bytes = int(config['memory_budget_mb'] * 1024 * 1024)
+        return cls(config['datasets'], default=config.get('default'), memory_budget_bytes=memory_budget_bytes,
+                   preloaded=list(config['datasets']) if preload else None, background=background,
+                   watch_interval=watch_interval)
+
+    def get_name(self, req, params: dict):
+        """get the dataset of a request, from the route prefix, the dataset parameter or the default one"""
+        name = params.get('dataset')
+        if name is None and req.method == 'POST' and isinstance(req.media, dict):
+            name = req.media.get('dataset')
+        if name is None:
+            name = req.get_param('dataset', default=self.default)
+        if name not in self.datasets:
+            raise falcon.HTTPNotFound(description=f"unknown dataset {name}")
+        return name
+
+    def get(self, name: str = None):
+        """get the storage engine of a dataset, loading it if necessary"""
+        name = name or self.default
+        if self.watch_interval and self._watcher_pid != os.getpid():
+            self.start_watcher()
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                # the memory of the datasets loading in the background grows as their parts are loaded
+                self.evict(keep=name)
+                return self._loaded[name]
+        # the other datasets can be used while this one loads, concurrent requests for it wait for the first one
+        with self._load_locks[name]:
+            with self._lock:
+                if name in self._loaded:
+                    self._loaded.move_to_end(name)
+                    return self._loaded[name]
+            paths = self.datasets[name]
+            storage = FileStorageEngine(paths['heatmap'], paths['histogram'], paths['swarmplot'], name=name,
+                                        wait=not self.background)
+            with self._lock:
+                self._loaded[name] = storage
+                self.evict(keep=name)
+            DATASET_LOADED.labels(name).set(1)
+            return storage
+
+    def get_ready(self, name: str, data_types: List[str]):
+        """get a dataset whose given parts are loaded, with a 503 error while they are loading"""
+        storage = self.get(name)
+        if not storage.is_ready(data_types):
+            failed = storage.get_failed_parts(data_types)
+            if failed:
+                self.unload_failed(name, storage)
+                raise falcon.HTTPServiceUnavailable(description=f"the {', '.join(failed)} of dataset {name} failed "
+                                                                f"to load, it is loaded again on the next request",
+                                                    retry_after=10)
+            loading = [data_type for data_type in data_types if not storage.is_ready([data_type])]
+            raise falcon.HTTPServiceUnavailable(description=f"the {', '.join(loading)} of dataset {name} is loading",
+                                                retry_after=10)
+        return storage
+
+    def unload_failed(self, name: str, storage: FileStorageEngine):
+        """unload a dataset with parts that failed to load, unless it was already replaced, so that it is loaded again
+        instead of answering 503 until its files change"""
+        with self._lock:
+            if self._loaded.get(name) is not storage:
+                return
+            del self._loaded[name]
+        DATASET_LOADED.labels(name).set(0)
+        logger.warning(f"unloaded dataset {name}, the {', '.join(storage.get_failed_parts())} failed to load")
+
+    def evict(self, keep: str):
+        # called with the lock held. The requests still using an evicted dataset keep a reference to it, its memory is
+        # freed when they are done
+        if self.memory_budget_bytes is None:
+            return
+        # datasets that only use memory mapped or HDF5 arrays would free nothing, they stay loaded
+        candidates = [name for name, storage in self._loaded.items() if name != keep and storage.get_memory_size()]
+        while sum(storage.get_memory_size() for storage in self._loaded.values()) > self.memory_budget_bytes and \
+                candidates:
+            name = candidates.pop(0)
+            storage = self._loaded.pop(name)
+            self._versions.pop(name, None)
+            DATASET_LOADED.labels(name).set(0)
+            DATASET_EVICTIONS.labels(name).inc()
+            logger.info(f"unloaded dataset {name} to free {storage.get_memory_size()} bytes")
+
+    def load_preloaded(self):
+        """load the preloaded datasets, eg before forking the workers so that they share the pages of the arrays"""
+        for name in self.preloaded:
+            self.get(name)
+
+    def is_ready(self):
+        with self._lock:
+            loaded = dict(self._loaded)
+        # the preloaded datasets that failed to load are unloaded and, with background loading, loaded again, so that
+        # the readiness probe recovers from transient errors without waiting for a request
+        ready = True
+        for name in self.preloaded:
+            storage = loaded.get(name)
+            if storage is not None and storage.get_failed_parts():
+                self.unload_failed(name, storage)
+                storage = None
+            if storage is None and self.background:
+                storage = self.get(name)
+            ready = ready and storage is not None and storage.is_ready()
+        return ready
+
+    def reload(self, names: List[str] = None, wait: bool = False):
+        """reload the given datasets, or all of them, if their files changed since they were loaded, and return the
+        names of the datasets being reloaded. The datasets that are not loaded get the version of their new files"""
+        names = names if names is not None else list(self.datasets)
+        reloaded = []
+        with self._lock:
+            for name in names:
+                if name not in self._loaded:
+                    self._versions.pop(name, None)
+                elif name not in self._reloading and get_paths_signature(
+                        [self.datasets[name][file_type] for file_type in DATASET_FILE_TYPES]) != \
+                        self._loaded[name].signature:
+                    self._reloading.add(name)
+                    reloaded.append(name)
+        threads = [threading.Thread(target=self.swap, args=(name,), name=f"reload-{name}", daemon=True)
+                   for name in reloaded]
+        for thread in threads:
+            thread.start()
+        if wait:
+            for thread in threads:
+                thread.join()
+        return reloaded
+
+    def swap(self, name: str):
+        """load the new version of a dataset and replace the current one with it"""
+        try:
+            paths = self.datasets[name]
+            storage = FileStorageEngine(paths['heatmap'], paths['histogram'], paths['swarmplot'], name=name)
+        except Exception:
+            logger.exception(f"failed to reload dataset {name}, the previous version is still served")
+            DATASET_RELOADS.labels(name, 'error').inc()
+            return
+        finally:
+            with self._lock:
+                self._reloading.discard(name)
+        with self._lock:
+            previous = self._loaded.get(name)
+            # a dataset evicted while reloading stays unloaded
+            if previous is not None:
+                self._loaded[name] = storage
+                self.evict(keep=name)
+        DATASET_RELOADS.labels(name, 'ok').inc()
+        logger.info(f"reloaded dataset {name}, version {previous.version if previous else None} -> {storage.version}")
+
+    def start_watcher(self):
+        """check the files of the loaded datasets every watch_interval seconds from a thread of this process"""
+        self._watcher_pid = os.getpid()
+        threading.Thread(target=self.watch, name="dataset-watcher", daemon=True).start()
+
+    def watch(self):
+        # a dataset is only reloaded once its files didn't change for a whole interval, so that files being written
+        # are not picked up
+        previous_signatures = {}
+        while True:
+            time.sleep(self.watch_interval)
+            with self._lock:
+                loaded = dict(self._loaded)
+            for name, storage in loaded.items():
+                signature = get_paths_signature([self.datasets[name][file_type] for file_type in DATASET_FILE_TYPES])
+                if signature is not None and signature != storage.signature and \
+                        signature == previous_signatures.get(name):
+                    logger.info(f"files of dataset {name} changed, reloading it")
+                    self.reload([name])
+                previous_signatures[name] = signature
+
+    def get_version(self, name: str = None):
+        """get the version of a dataset without loading it: the one of the loaded storage, which the responses are
+        computed from, otherwise the one of its files, computed again when their signature changed, eg when they were
+        regenerated after the dataset was evicted"""
+        name = name or self.default
+        storage = self._loaded.get(name)
+        if storage is not None:
+            return storage.version
+        paths = [self.datasets[name][file_type] for file_type in DATASET_FILE_TYPES]
+        signature = get_paths_signature(paths)
+        cached = self._versions.get(name)
+        if cached is None or cached[0] != signature:
+            cached = self._versions[name] = (signature, compute_data_version(paths, signature))
+        return cached[1]
+
+    def get_status(self):
+        """loaded datasets with the state, load time and memory of each part"""
+        with self._lock:
+            loaded = dict(self._loaded)
+        datasets = []
+        for name in self.datasets:
+            status = {"name": name, "loaded": name in loaded, "preloaded": name in self.preloaded,
+                      "reloading": name in self._reloading}
+            if name in loaded:
+                parts = loaded[name].get_load_status()
+                status.update(version=loaded[name].version, memory_bytes=loaded[name].get_memory_size(), parts=parts,
+                              progress=sum(part['state'] == 'ready' for part in parts.values()) / len(parts))
+            datasets.append(status)
+        return {"default": self.default, "memory_budget_bytes": self.memory_budget_bytes, "datasets": datasets}
+
+
+COLUMNAR_MEDIA_TYPE = 'application/vnd.wormcells.columnar'
+COLUMNAR_MAGIC = b'WCV1'
+
+
+@lru_cache(maxsize=65536)
+def json_string(name: str):
+    return json.dumps(name)
+
+
+def json_floats(values):
+    """serialize each value of a 1-D array to its json representation, in a single json.dumps call"""
+    values = np.asarray(values).tolist()
+    return json.dumps(values)[1:-1].split(', ') if values else []
+
+
+def encode_heatmap_json(gene_ids: List[str], cell_names: List[str], values, excluded_entities: List[str]):
+    cell_keys = [json_string(cell_name) + ': ' for cell_name in cell_names]
+    genes_json = [json_string(gene_id) + ': {' + ', '.join(map(str.__add__, cell_keys, json_floats(gene_values))) +
+                  '}' for gene_id, gene_values in zip(gene_ids, values.T)]
+    return '{"response": {' + ', '.join(genes_json) + '}, "excludedEntities": ' + json.dumps(excluded_entities) + '}'
+
+
+def encode_histogram_json(gene_id: str, cell_names: List[str], counts, freqs: List[float]):
+    freqs_json = json_floats(freqs) if freqs is not None else ['0'] * len(cell_names)
+    cells_json = [json_string(cell_name) + ': [' + json.dumps(cell_counts) + ', ' + freq + ']' for
+                  cell_name, cell_counts, freq in zip(cell_names, counts.tolist(), freqs_json)]
+    return '{"response": {' + ', '.join(cells_json) + '}, "gene_id": ' + json_string(gene_id) + '}'
+
+
+def encode_swarmplot_json(cell: str, arrays: dict):
+    cell_names_json = [json_string(cell_name) for cell_name in arrays['cell_names']]
+    genes_json = []
+    for gene_id, ref_val, heatmap_vals, lfc_vals, positive_lfc in zip(
+            arrays['gene_ids'], json_floats(arrays['ref_vals']), arrays['heatmap_vals'].T, arrays['lfc_vals'].T,
+            arrays['positive_lfc'].T):
+        cells_loc = np.flatnonzero(positive_lfc)
+        points = ['[' + cell_names_json[cell_loc] + ', ' + heatmap_val + ', ' + lfc_val + ']' for
+                  cell_loc, heatmap_val, lfc_val in zip(cells_loc.tolist(), json_floats(heatmap_vals[cells_loc]),
+                                                        json_floats(lfc_vals[cells_loc]))]
+        genes_json.append(json_string(gene_id) + ': [' + ref_val + ', [' + ', '.join(points) + ']]')
+    return '{"response": {' + ', '.join(genes_json) + '}, "cell": ' + json_string(cell) + '}'
+
+
+def encode_columnar(header: dict, arrays: dict):
+    """encode arrays in the binary columnar format
+
+    The payload starts with the magic bytes WCV1 and the length of a json header as little endian uint32, followed by
+    the header, padded with spaces to a multiple of 8 bytes, and by the raw little endian arrays, each one starting at
+    a multiple of 8 bytes. header["arrays"] contains the name, dtype, shape and offset of each array, where the offset
+    is relative to the end of the header. float16 arrays are sent as float32 and boolean arrays as uint8, so that all
+    arrays can be read with javascript typed arrays.
+    """
+    buffers = []
+    header = dict(header, arrays=[])
+    offset = 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        if array.dtype == np.float16:
+            array = array.astype(np.float32)
+        elif array.dtype == np.bool_:
+            array = array.astype(np.uint8)
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+        header['arrays'].append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                                 'offset': offset})
+        buffer = array.tobytes()
+        buffers.append(buffer + b'\0' * (-len(buffer) % 8))
+        offset += len(buffers[-1])
+    header_json = json.dumps(header).encode()
+    header_json += b' ' * (-(len(header_json) + 8) % 8)
+    return COLUMNAR_MAGIC + struct.pack('<I', len(header_json)) + header_json + b''.join(buffers)
+
+
+def negotiate_media_type(req):
+    """json, unless the client explicitly prefers the binary columnar encoding"""
+    # the last type wins the ties, such as a missing Accept header or */*
+    return req.client_prefers([COLUMNAR_MEDIA_TYPE, falcon.MEDIA_JSON]) or falcon.MEDIA_JSON
+
+
+def set_response_body(resp, body, media_type: str):
+    if isinstance(body, bytes):
+        resp.data = body
+    else:
+        resp.body = body
+    resp.content_type = media_type
+    resp.append_header('Vary', 'Accept')
+
+
+class CompressionMiddleware(object):
+    """Compress the responses larger than min_size bytes with brotli, if installed, or gzip, as accepted by the
+    client"""
+
+    def __init__(self, min_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        resp.append_header('Vary', 'Accept-Encoding')
+        data = resp.body.encode() if isinstance(resp.body, str) else resp.data
+        if not data or len(data) < self.min_size or resp.get_header('Content-Encoding'):
+            return
+        accepted_encodings = set()
+        for encoding in (req.get_header('Accept-Encoding') or '').lower().split(','):
+            encoding, _, params = encoding.partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted_encodings.add(encoding.strip())
+        if brotli is not None and 'br' in accepted_encodings:
+            with timing_span('compress'):
+                resp.data = brotli.compress(data, quality=self.brotli_quality)
+            resp.set_header('Content-Encoding', 'br')
+        elif 'gzip' in accepted_encodings:
+            with timing_span('compress'):
+                resp.data = gzip.compress(data, compresslevel=self.gzip_level)
+            resp.set_header('Content-Encoding', 'gzip')
+        else:
+            return
+        resp.body = None
+
+
+class ResponseCache(object):
+    """Serialized, uncompressed responses in an LRU cache bounded by their total size, with hit and miss counters"""
+
+    def __init__(self, max_size_bytes: int = 128 * 1024 * 1024):
+        self.max_size_bytes = max_size_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """get a cached response and its content type, returns None if missing"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, body: bytes, content_type: str):
+        if len(body) > self.max_size_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= len(self._entries.pop(key)[0])
+            self._entries[key] = (body, content_type)
+            self.size_bytes += len(body)
+            while self.size_bytes > self.max_size_bytes:
+                self.size_bytes -= len(self._entries.popitem(last=False)[1][0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                    "size_bytes": self.size_bytes, "max_size_bytes": self.max_size_bytes}
+
+
+class ResponseCacheMiddleware(object):
+    """Cache the responses of the resources with a cacheable attribute set to True
+
+    Responses are keyed on the route, the canonicalized request parameters and the version of the requested dataset,
+    the key is sent as ETag so that clients can revalidate their copy with If-None-Match and get a 304.
+    """
+
+    def __init__(self, cache: ResponseCache, registry: DatasetRegistry):
+        self.cache = cache
+        self.registry = registry
+
+    def get_cache_key(self, req, params: dict):
+        key_params = {'method': req.method, 'path': req.path, 'query': sorted(req.params.items()),
+                      'accept': req.get_header('Accept'), 'media': req.media if req.method == 'POST' else None,
+                      'version': self.registry.get_version(self.registry.get_name(req, params))}
+        return hashlib.sha256(json.dumps(key_params, sort_keys=True).encode()).hexdigest()
+
+    def process_resource(self, req, resp, resource, params):
+        if not getattr(resource, 'cacheable', False):
+            return
+        try:
+            with timing_span('cache'):
+                key = self.get_cache_key(req, params)
+        except (falcon.HTTPError, TypeError, ValueError):
+            # the responder deals with requests that can't be parsed
+            return
+        except OSError as e:
+            # the files of the dataset are missing or being replaced, the request is answered without the cache
+            logger.warning(f"not caching {req.path}, the dataset version is not available: {e!r}")
+            return
+        req.context.response_cache_key = key
+        # weak, because the same response can be sent with different compressions
+        req.context.response_etag = f'W/"{key[:32]}"'
+        if_none_match = req.get_header('If-None-Match')
+        if if_none_match and req.context.response_etag[2:] in [tag.strip().replace('W/', '', 1) for tag in
+                                                               if_none_match.split(',')]:
+            resp.status = falcon.HTTP_NOT_MODIFIED
+            resp.complete = True
+            return
+        with timing_span('cache'):
+            entry = self.cache.get(key)
+        if entry is not None:
+            resp.data, resp.content_type = entry
+            resp.status = falcon.HTTP_OK
+            resp.append_header('Vary', 'Accept')
+            resp.set_header('X-Cache', 'HIT')
+            resp.complete = True
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        key = getattr(req.context, 'response_cache_key', None)
+        if not key or not req_succeeded or resp.status not in (falcon.HTTP_OK, falcon.HTTP_NOT_MODIFIED):
+            return
+        resp.set_header('ETag', req.context.response_etag)
+        resp.set_header('Cache-Control', 'no-cache')
+        if resp.status == falcon.HTTP_OK and not resp.get_header('X-Cache'):
+            body = resp.body.encode() if isinstance(resp.body, str) else resp.data
+            if body is not None:
+                self.cache.set(key, body, resp.content_type)
+                resp.set_header('X-Cache', 'MISS')
+
+
+class MetricsMiddleware(object):
+    """Record the prometheus metrics of each request
+
+    It must be the first middleware, so that its process_response is called last and sees the response as sent.
+    """
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        # the route template and not the path, so that the number of label values stays bounded
+        route = req.uri_template or 'unmatched'
+        status = resp.status.split(' ', 1)[0]
+        # an unhandled exception leaves the default 200 status, the server sends a 500 once it is raised again
+        if not req_succeeded and status.startswith('2'):
+            status = '500'
+        REQUESTS.labels(route, req.method, status).inc()
+        REQUEST_DURATION.labels(route, req.method).observe(time.perf_counter() - req.context.metrics_start)
+        # json bodies are ascii, so their length is their size in bytes
+        RESPONSE_SIZE.labels(route).observe(len(resp.data) if resp.data is not None else len(resp.body or ''))
+        if getattr(resource, 'cacheable', False):
+            cache_result = 'not_modified' if resp.status == falcon.HTTP_NOT_MODIFIED else \
+                (resp.get_header('X-Cache') or '').lower()
+            if cache_result:
+                RESPONSE_CACHE_RESULTS.labels(route, cache_result).inc()
+        WORKER_MAX_RSS.set(get_max_rss_bytes())
+
+
+class TimingMiddleware(object):
+    """Send the time spent in each phase of the request (lookup, sort, gather, read, encode, cache, compress) in a
+    Server-Timing header, in ms, along with the total time
+
+    It must come right after the MetricsMiddleware, so that the compression of the response is included.
+    """
+
+    def process_request(self, req, resp):
+        req.context.timings_start = time.perf_counter()
+        req.context.timings_token = request_timings.set({})
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        token = getattr(req.context, 'timings_token', None)
+        if token is None:
+            return
+        timings = [f"{name};dur={duration * 1000:.3f}" for name, duration in request_timings.get().items()]
+        timings.append(f"total;dur={(time.perf_counter() - req.context.timings_start) * 1000:.3f}")
+        request_timings.reset(token)
+        resp.set_header('Server-Timing', ', '.join(timings))
+        # lets the frontend read the timings from the resource timing API
+        resp.set_header('Timing-Allow-Origin', '*')
+
+
+def is_admin_request(req, admin_token: str):
+    token = req.get_header('X-Admin-Token')
+    return token is not None and hmac.compare_digest(token.encode(), admin_token.encode())
+
+
+class RequestProfiler(object):
+    """Capture cProfile profiles of requests, dumped in profile_dir as .prof files that can be read with pstats
+
+    A request is profiled when it carries the admin token in the X-Admin-Token header, or when the profiler was armed
+    for the next requests of the worker with ProfileAdminResource. Only one request is profiled at a time, the others
+    are served as usual. The file name of the profile is sent in the X-Profile-File header.
+    """
+
+    def __init__(self, admin_token: str, profile_dir: str, max_listed_files: int = 20):
+        self.admin_token = admin_token
+        self.profile_dir = profile_dir
+        self.remaining = 0
+        self.route = None
+        self.profile_files = []
+        self.num_profiles = 0
+        self.max_listed_files = max_listed_files
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+
+    def is_admin(self, req):
+        return is_admin_request(req, self.admin_token)
+
+    def arm(self, num_requests: int, route: str = None):
+        """profile the next num_requests requests, only the ones to the given route template if set"""
+        with self._lock:
+            self.remaining = num_requests
+            self.route = route
+
+    def get_status(self):
+        with self._lock:
+            return {"pid": os.getpid(), "remaining": self.remaining, "route": self.route,
+                    "profile_dir": self.profile_dir, "profile_files": list(self.profile_files)}
+
+    def process_resource(self, req, resp, resource, params):
+        if isinstance(resource, ProfileAdminResource) or not self._profiling.acquire(blocking=False):
+            return
+        profile = self.is_admin(req)
+        if not profile:
+            with self._lock:
+                if self.remaining and self.route in (None, req.uri_template):
+                    self.remaining -= 1
+                    profile = True
+        if not profile:
+            self._profiling.release()
+            return
+        req.context.profiler = cProfile.Profile()
+        req.context.profiler.enable()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        profiler = getattr(req.context, 'profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        self._profiling.release()
+        with self._lock:
+            self.num_profiles += 1
+            file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.num_profiles}" \
+                        f"{req.uri_template.replace('/', '_')}.prof"
+            self.profile_files = (self.profile_files + [file_name])[-self.max_listed_files:]
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.profile_dir, file_name))
+        resp.set_header('X-Profile-File', file_name)
+        logger.info(f"profile of {req.method} {req.path} written to {file_name}")
+
+
+class ProfileAdminResource:
+    """Arm the profiler of the worker that handles the request, with the admin token in the X-Admin-Token header
+
+    POST {"num_requests": 10, "route": "/get_data_swarmplot"} profiles the next 10 swarmplot requests of the worker,
+    without route all the requests are profiled. GET returns the number of requests still to profile and the last
+    profile files written by the worker.
+    """
+
+    def __init__(self, profiler: RequestProfiler):
+        self.profiler = profiler
+
+    def on_get(self, req, resp):
+        if not self.profiler.is_admin(req):
+            raise falcon.HTTPForbidden(description="invalid admin token")
+        resp.body = json.dumps(self.profiler.get_status())
+        resp.status = falcon.HTTP_OK
+
+    def on_post(self, req, resp):
+        if not self.profiler.is_admin(req):
+            raise falcon.HTTPForbidden(description="invalid admin token")
+        media = req.media or {}
+        num_requests = media.get("num_requests", 1)
+        if not isinstance(num_requests, int) or num_requests < 0:
+            resp.status = falcon.HTTP_BAD_REQUEST
+            return
+        self.profiler.arm(num_requests, media.get("route"))
+        resp.body = json.dumps(self.profiler.get_status())
+        resp.status = falcon.HTTP_OK
+
+
+class ReloadAdminResource:
+    """Reload the datasets whose files changed in the worker that handles the request, with the admin token in the
+    X-Admin-Token header
+
+    POST {"datasets": ["cengen"]} reloads the given datasets, without datasets all of them are checked. The response
+    lists the datasets being reloaded, their new version is served once loaded. With several workers, the other ones
+    pick up the changes with the watcher (--watch-interval).
+    """
+
+    def __init__(self, registry: DatasetRegistry, admin_token: str):
+        self.registry = registry
+        self.admin_token = admin_token
+
+    def on_post(self, req, resp):
+        if not is_admin_request(req, self.admin_token):
+            raise falcon.HTTPForbidden(description="invalid admin token")
+        names = (req.media or {}).get("datasets")
+        if names is not None and (not isinstance(names, list) or any(name not in self.registry.datasets
+                                                                      for name in names)):
+            resp.status = falcon.HTTP_BAD_REQUEST
+            return
+        resp.body = json.dumps({"pid": os.getpid(), "reloading": self.registry.reload(names)})
+        resp.status = falcon.HTTP_OK
+
+
+class MetricsReader:
+    """Prometheus metrics, aggregated over all the gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set"""
+
+    def on_get(self, req, resp):
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        resp.data = generate_latest(registry)
+        resp.content_type = CONTENT_TYPE_LATEST
+        resp.status = falcon.HTTP_OK
+
+
+class ResponseCacheStatsReader:
+
+    def __init__(self, cache: ResponseCache):
+        self.cache = cache
+
+    def on_get(self, req, resp):
+        resp.body = json.dumps(self.cache.get_stats())
+        resp.status = falcon.HTTP_OK
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class GeneMetadataCache(object):
+    """Bounded in-memory cache with LRU eviction and a time to live, optionally backed by a persistent sqlite file
+    shared by all the workers"""
+
+    def __init__(self, max_size: int = 50000, ttl: float = 7 * 24 * 3600, db_path: str = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.db_path = db_path
+        self._db = None
+        self._db_pid = None
+
+    def _get_db(self):
+        # sqlite connections can't be shared with forked processes, each worker opens its own
+        if self.db_path and self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS gene_metadata (key TEXT PRIMARY KEY, value TEXT, "
+                             "stored_at REAL)")
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def get(self, key: str):
+        """get a cached value, raises KeyError if the key is missing or expired"""
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                value, stored_at = self._entries[key]
+                if now - stored_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+            db = self._get_db()
+            if db is not None:
+                row = db.execute("SELECT value, stored_at FROM gene_metadata WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] < self.ttl:
+                    value = json.loads(row[0])
+                    self._store_in_memory(key, value, row[1])
+                    return value
+        raise KeyError(key)
+
+    def set(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            self._store_in_memory(key, value, now)
+            db = self._get_db()
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO gene_metadata VALUES (?, ?, ?)", (key, json.dumps(value), now))
+                db.commit()
+
+    def get_all(self, key_prefix: str):
+        """get all the values that didn't expire with a key starting with the given prefix"""
+        now = time.time()
+        values = {}
+        with self._lock:
+            db = self._get_db()
+            if db is not None:
+                for key, value, stored_at in db.execute("SELECT key, value, stored_at FROM gene_metadata WHERE key "
+                                                        "LIKE ?", (key_prefix + '%',)):
+                    if now - stored_at < self.ttl:
+                        values[key] = json.loads(value)
+            for key, (value, stored_at) in self._entries.items():
+                if key.startswith(key_prefix) and now - stored_at < self.ttl:
+                    values[key] = value
+        return values
+
+    def _store_in_memory(self, key: str, value, stored_at: float):
+        self._entries[key] = (value, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class WormBaseClient(object):
+    """Client for the gene fields of the WormBase REST API
+
+    Connections are kept alive in a bounded pool, each upstream call is limited by a timeout, the results are cached and
+    concurrent requests for the same gene field are coalesced into a single upstream call.
+    """
+
+    # extract the value returned to the frontend from the json of each field
+    FIELDS = {
+        'concise_description': lambda field_json: field_json["concise_description"]["data"]["text"],
+        'name': lambda field_json: field_json["name"]["data"]["label"]
+    }
+
+    def __init__(self, base_url: str = 'http://rest.wormbase.org', timeout: float = 10, pool_size: int = 8,
+                 cache: GeneMetadataCache = None):
+        url = urllib.parse.urlsplit(base_url)
+        self._connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self._host = url.netloc
+        self._path_prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.cache = cache if cache is not None else GeneMetadataCache()
+        self._idle_connections = queue.LifoQueue(maxsize=pool_size)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        # names of the genes resolved by this process, for the gene search
+        self.gene_names = {}
+
+    def _get_json(self, path: str):
+        start = time.perf_counter()
+        try:
+            result = self._request_json(path)
+        except UpstreamError:
+            WORMBASE_REQUEST_DURATION.labels('error').observe(time.perf_counter() - start)
+            raise
+        WORMBASE_REQUEST_DURATION.labels('ok').observe(time.perf_counter() - start)
+        return result
+
+    def _request_json(self, path: str):
+        # a connection taken from the pool may have been closed by the server while idle, in that case the call is
+        # retried once on a new connection
+        for attempt in range(2):
+            try:
+                connection, reused = self._idle_connections.get_nowait(), True
+            except queue.Empty:
+                connection, reused = self._connection_class(self._host, timeout=self.timeout), False
+            try:
+                connection.request('GET', self._path_prefix + path, headers={'Accept': 'application/json'})
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if reused and attempt == 0 and not isinstance(e, socket.timeout):
+                    continue
+                raise UpstreamError(f"request to {self._host}{path} failed: {e}") from e
+            if response.will_close:
+                connection.close()
+            else:
+                try:
+                    self._idle_connections.put_nowait(connection)
+                except queue.Full:
+                    connection.close()
+            if response.status != 200:
+                raise UpstreamError(f"request to {self._host}{path} returned status {response.status}")
+            return json.loads(body)
+
+    def _fetch_field(self, gene_id: str, field: str):
+        field_json = self._get_json(f"/rest/field/gene/{urllib.parse.quote(gene_id)}/{field}")
+        try:
+            return self.FIELDS[field](field_json)
+        except (KeyError, TypeError) as e:
+            raise UpstreamError(f"unexpected {field} response for gene {gene_id}") from e
+
+    def get_field(self, gene_id: str, field: str):
+        """get a gene field from the cache or from WormBase, raises UpstreamError if WormBase can't be reached"""
+        key = f"{field}/{gene_id}"
+        try:
+            value = self.cache.get(key)
+            if field == 'name':
+                self.gene_names[gene_id] = value
+            return value
+        except KeyError:
+            pass
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+        if not owner:
+            return future.result()
+        try:
+            value = self._fetch_field(gene_id, field)
+            self.cache.set(key, value)
+            if field == 'name':
+                self.gene_names[gene_id] = value
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def get_concise_description(self, gene_id: str):
+        return self.get_field(gene_id, 'concise_description')
+
+    def get_name(self, gene_id: str):
+        return self.get_field(gene_id, 'name')
+
+    def get_many(self, gene_ids: List[str], fields: List[str] = None):
+        """resolve the fields of many genes concurrently, returns the results by gene and the genes that failed"""
+        fields = fields if fields else list(self.FIELDS.keys())
+        futures = {(gene_id, field): self._executor.submit(self.get_field, gene_id, field) for gene_id in
+                   dict.fromkeys(gene_ids) for field in fields}
+        results = defaultdict(dict)
+        failed = set()
+        for (gene_id, field), future in futures.items():
+            try:
+                results[gene_id][field] = future.result()
+            except UpstreamError as e:
+                logger.warning(str(e))
+                failed.add(gene_id)
+        return dict(results), sorted(failed)
+
+    def load_cached_names(self):
+        """make the gene names of the persistent cache searchable, eg the ones prefetched before serving"""
+        for key, name in self.cache.get_all('name/').items():
+            self.gene_names[key[len('name/'):]] = name
+
+    def prefetch(self, gene_ids: List[str], fields: List[str] = None, batch_size: int = 500):
+        """warm the cache for all the given genes, to be used with a persistent cache before serving"""
+        num_failed = 0
+        for start in range(0, len(gene_ids), batch_size):
+            _, failed = self.get_many(gene_ids[start:start + batch_size], fields)
+            num_failed += len(failed)
+            logger.info(f"prefetched gene metadata for {min(start + batch_size, len(gene_ids))}/{len(gene_ids)} "
+                        f"genes, {num_failed} failed")
+        return num_failed
 
 
 class HeatmapReader:
 
-    def __init__(self, storage_engine: FileStorageEngine):
-        self.storage = storage_engine
+    cacheable = True
+    # parts of the dataset used by the queries
+    data_types = ['heatmap']
+
+    def __init__(self, registry: DatasetRegistry):
+        self.registry = registry
         self.logger = logging.getLogger(__name__)
 
-    def on_post(self, req, resp):
+    @staticmethod
+    def parse_query(media: dict):
+        gene_ids = media["gene_ids"] if "gene_ids" in media and media["gene_ids"] and media["gene_ids"] != [''] \
+            else None
+        cell_names = media["cell_names"] if "cell_names" in media and media["cell_names"] and \
+            media["cell_names"] != [''] else None
+        return {'gene_ids': gene_ids, 'cell_names': cell_names}
+
+    def query(self, storage: FileStorageEngine, params: dict, shared: dict = None,
+              media_type: str = falcon.MEDIA_JSON):
+        """get the serialized response for the parsed query parameters, plus a description of the query to log"""
+        gene_ids, cell_names, values, excluded_entities = storage.get_heatmap_arrays(**params)
+        if excluded_entities:
+            EXCLUDED_ENTITIES.labels('heatmap').inc(len(excluded_entities))
+        with timing_span('encode'):
+            if media_type == COLUMNAR_MEDIA_TYPE:
+                body = encode_columnar({"type": "heatmap", "gene_ids": gene_ids, "cell_names": cell_names,
+                                        "excludedEntities": excluded_entities}, {"values": values})
+            else:
+                body = encode_heatmap_json(gene_ids, cell_names, values, excluded_entities)
+        return body, "gene_ids=" + ",".join(gene_ids) + " cells=" + ",".join(cell_names)
+
+    def on_post(self, req, resp, dataset=None):
         if req.media:
-            gene_ids = req.media["gene_ids"] if "gene_ids" in req.media and req.media["gene_ids"] and \
-                                                req.media["gene_ids"] != [''] else None
-            cell_names = req.media["cell_names"] if "cell_names" in req.media and req.media["cell_names"] and \
-                                                    req.media["cell_names"] != [''] else None
-            results, excluded_entites = self.storage.get_data_heatmap(gene_ids=gene_ids, cell_names=cell_names)
-            gene_ids = list(results.keys())
-            cell_names = list(results[gene_ids[0]].keys())
-            print(str(datetime.now()) + " - Requested heatmap data by IP " + req.access_route[0] + " gene_ids=" +
-                  ",".join(gene_ids) + " cells=" + ",".join(cell_names))
-            resp.body = f'{{"response": {json.dumps(results)}, "excludedEntities": {json.dumps(excluded_entites)}}}'
+            name = self.registry.get_name(req, {'dataset': dataset})
+            media_type = negotiate_media_type(req)
+            body, query_desc = self.query(self.registry.get_ready(name, self.data_types), self.parse_query(req.media),
+                                          media_type=media_type)
+            self.logger.info("Requested heatmap data of " + name + " by IP " + req.access_route[0] + " " + query_desc)
+            set_response_body(resp, body, media_type)
             resp.status = falcon.HTTP_OK
         else:
             resp.status = falcon.HTTP_BAD_REQUEST
@@ -129,23 +1706,52 @@ class HeatmapReader:
 
 class HistogramReader:
 
-    def __init__(self, storage_engine: FileStorageEngine):
-        self.storage = storage_engine
+    cacheable = True
+    data_types = ['heatmap', 'histogram']
+
+    def __init__(self, registry: DatasetRegistry):
+        self.registry = registry
         self.logger = logging.getLogger(__name__)
 
-    def on_post(self, req, resp):
+    @staticmethod
+    def parse_query(media: dict):
+        gene_id = media["gene_id"] if "gene_id" in media and media["gene_id"] else None
+        cell_names = media["cell_names"] if "cell_names" in media and media["cell_names"] else None
+        sort_by_freq = media["sort_by_freq"] if "sort_by_freq" in media and media["sort_by_freq"] else None
+        return {'gene_id': gene_id, 'cell_names': cell_names, 'sort_by_freq': sort_by_freq}
+
+    def query(self, storage: FileStorageEngine, params: dict, shared: dict = None,
+              media_type: str = falcon.MEDIA_JSON):
+        gene_id = params['gene_id']
+        # heatmap values for sort_by_freq may have been gathered once for all the queries of a batch
+        heatmap_values = shared['histogram_heatmap_values'].get(gene_id) if shared and params['sort_by_freq'] \
+            else None
+        try:
+            gene_id, cell_names, counts, freqs = storage.get_histogram_arrays(heatmap_values=heatmap_values, **params)
+        except KeyError:
+            EXCLUDED_ENTITIES.labels('histogram').inc()
+            body = encode_columnar({"type": "histogram", "gene_id": gene_id, "cell_names": []}, {}) if \
+                media_type == COLUMNAR_MEDIA_TYPE else f'{{"response": {{}}, "gene_id": "{gene_id}"}}'
+            return body, "gene_id=" + str(gene_id)
+        with timing_span('encode'):
+            if media_type == COLUMNAR_MEDIA_TYPE:
+                arrays = {"counts": counts}
+                if freqs is not None:
+                    arrays["freqs"] = np.array(freqs, dtype=np.float64)
+                body = encode_columnar({"type": "histogram", "gene_id": gene_id, "cell_names": cell_names,
+                                        "bins": storage.histogram.bins}, arrays)
+            else:
+                body = encode_histogram_json(gene_id, cell_names, counts, freqs)
+        return body, "gene_id=" + str(gene_id)
+
+    def on_post(self, req, resp, dataset=None):
         if req.media:
-            gene_id = req.media["gene_id"] if "gene_id" in req.media and req.media["gene_id"] else None
-            cell_names = req.media["cell_names"] if "cell_names" in req.media and req.media["cell_names"] else None
-            sort_by_freq = req.media["sort_by_freq"] if "sort_by_freq" in req.media and req.media["sort_by_freq"] else \
-                None
-            try:
-                results, gene_id = self.storage.get_data_histogram(gene_id=gene_id, cell_names=cell_names,
-                                                                   sort_by_freq=sort_by_freq)
-            except KeyError:
-                results, gene_id = {}, gene_id
-            print(str(datetime.now()) + " - Requested histogram data by IP " + req.access_route[0] + " gene_id=" + gene_id)
-            resp.body = f'{{"response": {json.dumps(results)}, "gene_id": "{gene_id}"}}'
+            name = self.registry.get_name(req, {'dataset': dataset})
+            media_type = negotiate_media_type(req)
+            body, query_desc = self.query(self.registry.get_ready(name, self.data_types), self.parse_query(req.media),
+                                          media_type=media_type)
+            self.logger.info("Requested histogram data of " + name + " by IP " + req.access_route[0] + " " + query_desc)
+            set_response_body(resp, body, media_type)
             resp.status = falcon.HTTP_OK
         else:
             resp.status = falcon.HTTP_BAD_REQUEST
@@ -153,68 +1759,454 @@ class HistogramReader:
 
 class SwarmplotReader:
 
-    def __init__(self, storage_engine: FileStorageEngine):
-        self.storage = storage_engine
+    cacheable = True
+    data_types = ['heatmap', 'swarmplot']
+
+    def __init__(self, registry: DatasetRegistry):
+        self.registry = registry
         self.logger = logging.getLogger(__name__)
 
-    def on_post(self, req, resp):
-        if req.media:
-            cell = req.media.get("cell")
-            max_num_genes = req.media.get("max_num_genes")
-            ascending = req.media.get("ascending")
-            ascending = ascending == "true" if ascending else True
-            max_num_genes = int(max_num_genes) if max_num_genes else max_num_genes
-            sort_by = req.media.get("sort_by")
-            cell_name, results = self.storage.get_data_swarmplot(cell=cell, max_num_genes=max_num_genes,
-                                                                 sort_by=sort_by, ascending=ascending)
-            print(str(datetime.now()) + " - Requested swarmplot data by IP " + req.access_route[0] + " cell=" + cell_name +
-                  " max_num_genes=" + str(max_num_genes) + " ascending=" + str(ascending) + " sort_by=" + sort_by)
-            resp.body = f'{{"response": {json.dumps(results)}, "cell": "{cell_name}"}}'
+    @staticmethod
+    def parse_query(media: dict):
+        """raises ValueError if the cell is not a name or max_num_genes is not a positive number"""
+        cell = media.get("cell")
+        if cell is not None and not isinstance(cell, str):
+            raise ValueError(f"invalid cell {cell!r}")
+        max_num_genes = media.get("max_num_genes")
+        if max_num_genes:
+            try:
+                max_num_genes = int(max_num_genes)
+            except TypeError:
+                raise ValueError(f"invalid max_num_genes {max_num_genes!r}")
+            if max_num_genes < 1:
+                raise ValueError(f"invalid max_num_genes {max_num_genes!r}")
+        ascending = media.get("ascending")
+        return {'cell': cell,
+                'max_num_genes': max_num_genes,
+                'ascending': ascending == "true" if ascending else True,
+                'sort_by': media.get("sort_by")}
+
+    def query(self, storage: FileStorageEngine, params: dict, shared: dict = None,
+              media_type: str = falcon.MEDIA_JSON):
+        cell_name, arrays = storage.get_swarmplot_arrays(**params)
+        with timing_span('encode'):
+            if media_type == COLUMNAR_MEDIA_TYPE:
+                body = encode_columnar({"type": "swarmplot", "cell": cell_name, "gene_ids": arrays['gene_ids'],
+                                        "cell_names": arrays['cell_names']},
+                                       {name: arrays[name] for name in ['ref_vals', 'heatmap_vals', 'lfc_vals',
+                                                                        'positive_lfc']})
+            else:
+                body = encode_swarmplot_json(cell_name, arrays)
+        return body, "cell=" + cell_name + " max_num_genes=" + str(params['max_num_genes']) + " ascending=" + \
+            str(params['ascending']) + " sort_by=" + str(params['sort_by'])
+
+    def on_post(self, req, resp, dataset=None):
+        try:
+            params = self.parse_query(req.media) if req.media else None
+        except ValueError as e:
+            self.logger.info(f"Invalid swarmplot query by IP {req.access_route[0]}: {e}")
+            params = None
+        if params:
+            name = self.registry.get_name(req, {'dataset': dataset})
+            media_type = negotiate_media_type(req)
+            storage = self.registry.get_ready(name, self.data_types)
+            if params['cell'] and params['cell'] not in storage.swarmplot.cell_idx:
+                resp.status = falcon.HTTP_BAD_REQUEST
+                return
+            body, query_desc = self.query(storage, params, media_type=media_type)
+            self.logger.info("Requested swarmplot data of " + name + " by IP " + req.access_route[0] + " " + query_desc)
+            set_response_body(resp, body, media_type)
             resp.status = falcon.HTTP_OK
         else:
             resp.status = falcon.HTTP_BAD_REQUEST
 
 
+class BatchReader:
+    """Run several heatmap, histogram and swarmplot queries in one request
+
+    The body contains a list of queries, each one with a "type" key (heatmap, histogram or swarmplot) and the same
+    parameters as the corresponding endpoint. The response contains the responses of the queries, in the same order
+    and with the same format as the single endpoints, or an error for the queries that failed.
+    """
+
+    cacheable = True
+
+    def __init__(self, registry: DatasetRegistry, max_workers: int = 4):
+        self.registry = registry
+        self.logger = logging.getLogger(__name__)
+        self.readers = {'heatmap': HeatmapReader(registry), 'histogram': HistogramReader(registry),
+                        'swarmplot': SwarmplotReader(registry)}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def run_query(self, storage: FileStorageEngine, query_type: str, params: dict, shared: dict,
+                  timings: dict = None):
+        if timings is not None:
+            # the query runs in a copy of the request context, its timings go to a dict of its own that is merged into
+            # the request ones once the batch is done, as several pool threads can't update the same dict
+            request_timings.set(timings)
+        try:
+            return self.readers[query_type].query(storage, params, shared)[0]
+        except Exception as e:
+            self.logger.warning(f"batch {query_type} query {params} failed: {e!r}")
+            return json.dumps({"error": f"{query_type} query failed"})
+
+    def on_post(self, req, resp, dataset=None):
+        if req.media and isinstance(req.media.get("queries"), list) and all(
+                isinstance(query, dict) and query.get("type") in self.readers for query in req.media["queries"]):
+            # all the queries of a batch are run on the same dataset
+            try:
+                queries = [(query["type"], self.readers[query["type"]].parse_query(query))
+                           for query in req.media["queries"]]
+            except ValueError as e:
+                self.logger.info(f"Invalid batch query by IP {req.access_route[0]}: {e}")
+                resp.status = falcon.HTTP_BAD_REQUEST
+                return
+            name = self.registry.get_name(req, {'dataset': dataset})
+            storage = self.registry.get_ready(name, sorted({data_type for query_type, _ in queries for data_type in
+                                                            self.readers[query_type].data_types}))
+            for query_type, params in queries:
+                if query_type == 'histogram' and not params['gene_id']:
+                    params['gene_id'] = storage.get_all_genes()[0]
+            # lookups shared by several queries are computed once for the whole batch
+            shared = {'histogram_heatmap_values': storage.get_histogram_heatmap_values(
+                [params['gene_id'] for query_type, params in queries if
+                 query_type == 'histogram' and params['sort_by_freq']])}
+            timings = request_timings.get()
+            queries_timings = [{} if timings is not None else None for _ in queries]
+            bodies = [future.result() for future in [
+                self.executor.submit(contextvars.copy_context().run, self.run_query, storage, query_type, params,
+                                     shared, query_timings)
+                for (query_type, params), query_timings in zip(queries, queries_timings)]]
+            if timings is not None:
+                for query_timings in queries_timings:
+                    for phase, duration in query_timings.items():
+                        timings[phase] = timings.get(phase, 0) + duration
+            self.logger.info("Requested batch data of " + name + " by IP " + req.access_route[0] + " queries=" +
+                             ",".join(query_type for query_type, _ in queries))
+            resp.body = '{"responses": [' + ', '.join(bodies) + ']}'
+            resp.status = falcon.HTTP_OK
+        else:
+            resp.status = falcon.HTTP_BAD_REQUEST
+
+
+def set_catalog_response(req, resp, storage: FileStorageEngine, catalog: str, max_page_size: int = 10000):
+    """send the pre-serialized list of all the genes or cells, or the page given by the offset and limit parameters
+    with the total number of entries"""
+    offset = req.get_param_as_int('offset', min_value=0)
+    limit = req.get_param_as_int('limit', min_value=1, max_value=max_page_size)
+    if offset is None and limit is None:
+        resp.data = storage.get_serialized_catalog(catalog)
+    else:
+        names = storage.get_all_genes() if catalog == 'genes' else storage.get_all_cells()
+        offset = offset or 0
+        limit = limit or 1000
+        resp.body = json.dumps({"total": len(names), "offset": offset, "limit": limit,
+                                catalog: names[offset:offset + limit]})
+    resp.status = falcon.HTTP_OK
+
+
 class GenesReader:
 
-    def __init__(self, storage_engine: FileStorageEngine):
-        self.storage = storage_engine
+    cacheable = True
+    data_types = ['heatmap']
+
+    def __init__(self, registry: DatasetRegistry):
+        self.registry = registry
         self.logger = logging.getLogger(__name__)
 
-    def on_get(self, req, resp):
-        resp.body = json.dumps(self.storage.get_all_genes())
-        resp.status = falcon.HTTP_OK
+    def on_get(self, req, resp, dataset=None):
+        storage = self.registry.get_ready(self.registry.get_name(req, {'dataset': dataset}), self.data_types)
+        set_catalog_response(req, resp, storage, 'genes')
 
 
 class CellsReader:
 
-    def __init__(self, storage_engine: FileStorageEngine):
-        self.storage = storage_engine
+    cacheable = True
+    data_types = ['heatmap']
+
+    def __init__(self, registry: DatasetRegistry):
+        self.registry = registry
+        self.logger = logging.getLogger(__name__)
+
+    def on_get(self, req, resp, dataset=None):
+        storage = self.registry.get_ready(self.registry.get_name(req, {'dataset': dataset}), self.data_types)
+        set_catalog_response(req, resp, storage, 'cells')
+
+
+class GeneSearchReader:
+    """Autocomplete of the genes of a dataset, by id or by name for the genes whose name was resolved by the worker
+
+    GET ?q=unc-&limit=20 returns the genes with an id or a name starting with the query, then the ones containing it.
+    """
+
+    data_types = ['heatmap']
+
+    def __init__(self, registry: DatasetRegistry, wormbase_client: WormBaseClient, max_limit: int = 100):
+        self.registry = registry
+        self.wormbase = wormbase_client
+        self.max_limit = max_limit
+
+    def on_get(self, req, resp, dataset=None):
+        query = req.get_param('q', required=True)
+        limit = req.get_param_as_int('limit', min_value=1, max_value=self.max_limit) or 20
+        storage = self.registry.get_ready(self.registry.get_name(req, {'dataset': dataset}), self.data_types)
+        gene_ids = storage.search_genes(query, limit, self.wormbase.gene_names)
+        resp.body = json.dumps({"query": query, "results": [{"gene_id": gene_id,
+                                                             "name": self.wormbase.gene_names.get(gene_id)}
+                                                            for gene_id in gene_ids]})
+        resp.status = falcon.HTTP_OK
+
+
+class CellSearchReader:
+    """Autocomplete of the cells of a dataset, GET ?q=neuron&limit=20"""
+
+    data_types = ['heatmap']
+
+    def __init__(self, registry: DatasetRegistry, max_limit: int = 100):
+        self.registry = registry
+        self.max_limit = max_limit
+
+    def on_get(self, req, resp, dataset=None):
+        query = req.get_param('q', required=True)
+        limit = req.get_param_as_int('limit', min_value=1, max_value=self.max_limit) or 20
+        storage = self.registry.get_ready(self.registry.get_name(req, {'dataset': dataset}), self.data_types)
+        resp.body = json.dumps({"query": query, "results": storage.search_cells(query, limit)})
+        resp.status = falcon.HTTP_OK
+
+
+class SimilarGenesReader:
+    """Genes with the most similar expression across the cell types to a gene, by correlation or cosine similarity
+
+    GET ?gene_id=WBGene00000001&k=20&metric=correlation returns the neighbors sorted by decreasing similarity, the
+    distance being 1 - similarity.
+    """
+
+    cacheable = True
+    data_types = ['heatmap']
+
+    def __init__(self, registry: DatasetRegistry, max_k: int = 500):
+        self.registry = registry
+        self.max_k = max_k
         self.logger = logging.getLogger(__name__)
 
+    def on_get(self, req, resp, dataset=None):
+        gene_id = req.get_param('gene_id', required=True)
+        k = req.get_param_as_int('k', min_value=1, max_value=self.max_k) or 20
+        metric = req.get_param('metric', default='correlation')
+        if metric not in COEXPRESSION_METRICS:
+            raise falcon.HTTPInvalidParam('It must be one of ' + ', '.join(COEXPRESSION_METRICS), 'metric')
+        name = self.registry.get_name(req, {'dataset': dataset})
+        storage = self.registry.get_ready(name, self.data_types)
+        if gene_id not in storage.heatmap.gene_idx:
+            raise falcon.HTTPNotFound(description=f"unknown gene {gene_id} in dataset {name}")
+        gene_ids, similarities = storage.get_similar_genes(gene_id, k, metric)
+        self.logger.info("Requested similar genes of " + name + " by IP " + req.access_route[0] + " gene_id=" +
+                         gene_id + " metric=" + metric)
+        resp.body = json.dumps({"gene_id": gene_id, "metric": metric,
+                                "neighbors": [{"gene_id": neighbor_id, "similarity": similarity} for
+                                              neighbor_id, similarity in zip(gene_ids, similarities)]})
+        resp.status = falcon.HTTP_OK
+
+
+class DatasetsReader:
+
+    def __init__(self, registry: DatasetRegistry):
+        self.registry = registry
+
+    def on_get(self, req, resp):
+        resp.body = json.dumps(self.registry.get_status())
+        resp.status = falcon.HTTP_OK
+
+
+class ReadinessReader:
+    """Readiness probe for load balancers and orchestrators, fails until the datasets loaded at startup are loaded and
+    once the server is shutting down, so that no new requests are sent to it while the ongoing ones finish"""
+
+    def __init__(self, registry: DatasetRegistry, shutdown_event: threading.Event):
+        self.registry = registry
+        self.shutdown_event = shutdown_event
+
     def on_get(self, req, resp):
-        resp.body = json.dumps(self.storage.get_all_cells())
+        ready = not self.shutdown_event.is_set() and self.registry.is_ready()
+        resp.body = json.dumps({"ready": ready, "shutting_down": self.shutdown_event.is_set(),
+                                "datasets": self.registry.get_status()["datasets"]})
+        resp.status = falcon.HTTP_OK if ready else falcon.HTTP_SERVICE_UNAVAILABLE
+
+
+class HealthReader:
+    """Liveness probe, answers as long as the process can handle requests, with the load progress of the datasets"""
+
+    def __init__(self, registry: DatasetRegistry):
+        self.registry = registry
+        self.started = time.time()
+
+    def on_get(self, req, resp):
+        resp.body = json.dumps({"status": "ok", "uptime_seconds": time.time() - self.started,
+                                "datasets": self.registry.get_status()["datasets"]})
         resp.status = falcon.HTTP_OK
 
 
 class GeneDescriptionsReader:
 
+    def __init__(self, wormbase_client: WormBaseClient):
+        self.wormbase = wormbase_client
+
     def on_get(self, req, resp, gene_id):
-        with urllib.request.urlopen(f'http://rest.wormbase.org/rest/field/gene/{gene_id}/concise_description') as response:
-            desc = json.loads(response.read())
-            desc = desc["concise_description"]["data"]["text"]
-            resp.body = json.dumps(desc)
-            resp.status = falcon.HTTP_OK
+        try:
+            desc = self.wormbase.get_concise_description(gene_id)
+        except UpstreamError as e:
+            raise falcon.HTTPBadGateway(description=str(e))
+        resp.body = json.dumps(desc)
+        resp.status = falcon.HTTP_OK
 
 
 class GeneNameReader:
 
+    def __init__(self, wormbase_client: WormBaseClient):
+        self.wormbase = wormbase_client
+
     def on_get(self, req, resp, gene_id):
-        with urllib.request.urlopen(f'http://rest.wormbase.org/rest/field/gene/{gene_id}/name') as response:
-            name = json.loads(response.read())
-            name = name["name"]["data"]["label"]
-            resp.body = json.dumps(name)
+        try:
+            name = self.wormbase.get_name(gene_id)
+        except UpstreamError as e:
+            raise falcon.HTTPBadGateway(description=str(e))
+        resp.body = json.dumps(name)
+        resp.status = falcon.HTTP_OK
+
+
+class GeneMetadataReader:
+
+    def __init__(self, wormbase_client: WormBaseClient, max_gene_ids: int = 1000):
+        self.wormbase = wormbase_client
+        # each gene not in the cache is one request to the WormBase REST API per field
+        self.max_gene_ids = max_gene_ids
+
+    def on_post(self, req, resp):
+        gene_ids = req.media.get("gene_ids") if isinstance(req.media, dict) else None
+        if isinstance(gene_ids, list) and 0 < len(gene_ids) <= self.max_gene_ids and all(
+                isinstance(gene_id, str) for gene_id in gene_ids):
+            fields = req.media.get("fields") or list(WormBaseClient.FIELDS.keys())
+            if not isinstance(fields, list) or any(not isinstance(field, str) or field not in WormBaseClient.FIELDS
+                                                   for field in fields):
+                resp.status = falcon.HTTP_BAD_REQUEST
+                return
+            results, failed = self.wormbase.get_many(gene_ids=gene_ids, fields=fields)
+            resp.body = f'{{"response": {json.dumps(results)}, "failed": {json.dumps(failed)}}}'
             resp.status = falcon.HTTP_OK
+        else:
+            resp.status = falcon.HTTP_BAD_REQUEST
+
+
+def create_registry(datasets_config: str = None, heatmap_file: str = None, histogram_file: str = None,
+                    swarmplot_file: str = None, memory_budget_mb: int = None, preload: bool = False,
+                    background: bool = False, watch_interval: float = None, load: bool = True):
+    """get the datasets from a json config file, or a single dataset from the three data files, which is always
+    preloaded. The preloaded datasets are loaded right away, unless load is False"""
+    memory_budget_bytes = memory_budget_mb * 1024 * 1024 if memory_budget_mb else None
+    if datasets_config:
+        registry = DatasetRegistry.from_config(datasets_config, memory_budget_bytes=memory_budget_bytes,
+                                               preload=preload, background=background, watch_interval=watch_interval)
+    else:
+        registry = DatasetRegistry({'default': {'heatmap': heatmap_file, 'histogram': histogram_file,
+                                                'swarmplot': swarmplot_file}}, memory_budget_bytes=memory_budget_bytes,
+                                   preloaded=['default'], background=background, watch_interval=watch_interval)
+    if load:
+        registry.load_preloaded()
+    return registry
+
+
+def create_app(registry: DatasetRegistry, response_cache_size_mb: int = 128,
+               wormbase_url: str = 'http://rest.wormbase.org', gene_metadata_cache: str = None,
+               server_timing: bool = False, admin_token: str = None, profile_dir: str = DEFAULT_PROFILE_DIR,
+               shutdown_event: threading.Event = None):
+    """build the falcon app serving the datasets of the registry, used by main and by gunicorn"""
+    response_cache = ResponseCache(max_size_bytes=response_cache_size_mb * 1024 * 1024)
+    profiler = RequestProfiler(admin_token, profile_dir) if admin_token else None
+    wormbase_client = WormBaseClient(base_url=wormbase_url, cache=GeneMetadataCache(db_path=gene_metadata_cache))
+    if gene_metadata_cache:
+        wormbase_client.load_cached_names()
+    app = falcon.API(middleware=[MetricsMiddleware(), *([TimingMiddleware()] if server_timing else []),
+                                 *([profiler] if profiler else []), HandleCORS(), CompressionMiddleware(),
+                                 ResponseCacheMiddleware(response_cache, registry)])
+    # the data routes are served for the default dataset, and for each dataset under its name as prefix
+    for route, reader in [('get_data_heatmap', HeatmapReader(registry)),
+                          ('get_data_histogram', HistogramReader(registry)),
+                          ('get_data_swarmplot', SwarmplotReader(registry)),
+                          ('get_data_batch', BatchReader(registry)),
+                          ('get_all_genes', GenesReader(registry)),
+                          ('get_all_cells', CellsReader(registry)),
+                          ('search_genes', GeneSearchReader(registry, wormbase_client)),
+                          ('search_cells', CellSearchReader(registry)),
+                          ('get_similar_genes', SimilarGenesReader(registry))]:
+        app.add_route('/' + route, reader)
+        app.add_route('/{dataset}/' + route, reader)
+    app.add_route('/datasets', DatasetsReader(registry))
+    app.add_route('/ready', ReadinessReader(registry, shutdown_event or threading.Event()))
+    app.add_route('/health', HealthReader(registry))
+    app.add_route('/get_gene_concise_desc/{gene_id}', GeneDescriptionsReader(wormbase_client))
+    app.add_route('/get_gene_name/{gene_id}', GeneNameReader(wormbase_client))
+    app.add_route('/get_gene_metadata', GeneMetadataReader(wormbase_client))
+    app.add_route('/cache_stats', ResponseCacheStatsReader(response_cache))
+    app.add_route('/metrics', MetricsReader())
+    if admin_token:
+        app.add_route('/admin/profile', ProfileAdminResource(profiler))
+        app.add_route('/admin/reload', ReloadAdminResource(registry, admin_token))
+    return app
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    # server_close waits for the requests being handled
+    daemon_threads = False
+    block_on_close = True
+
+
+def serve_threaded(app, port: int, shutdown_event: threading.Event, registry: DatasetRegistry,
+                   host: str = '0.0.0.0'):
+    """serve the app from a thread per request in this process, until SIGTERM or SIGINT. SIGHUP reloads the datasets
+    whose files changed"""
+    httpd = simple_server.make_server(host, port, app, server_class=ThreadingWSGIServer)
+
+    def shutdown(signum, frame):
+        logger.info(f"received signal {signum}, finishing the ongoing requests")
+        shutdown_event.set()
+        # serve_forever runs in this thread, it can only be stopped from another one
+        threading.Thread(target=httpd.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGHUP, lambda signum, frame: registry.reload())
+    httpd.serve_forever()
+    httpd.server_close()
+
+
+def serve_gunicorn(app, port: int, workers: int, threads: int, graceful_timeout: int, host: str = '0.0.0.0',
+                   post_worker_init=None, on_reload=None):
+    """serve the app with gunicorn, from worker processes forked after the app and its datasets are loaded, or that
+    load the datasets themselves in post_worker_init. On SIGHUP, on_reload is called before the workers are replaced
+    by new ones"""
+
+    class Server(gunicorn.app.base.BaseApplication):
+
+        def load_config(self):
+            # the gthread worker keeps notifying the arbiter while a request loads a dataset, so that it isn't killed
+            self.cfg.set('bind', f"{host}:{port}")
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('graceful_timeout', graceful_timeout)
+            if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+                self.cfg.set('child_exit', lambda server, worker: multiprocess.mark_process_dead(worker.pid))
+            if post_worker_init:
+                self.cfg.set('post_worker_init', post_worker_init)
+            if on_reload:
+                self.cfg.set('on_reload', on_reload)
+
+        def load(self):
+            return app
+
+    if workers > 1 and not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        logger.warning("PROMETHEUS_MULTIPROC_DIR is not set, /metrics only reports the worker handling the request")
+    Server().run()
 
 
 def main():
@@ -223,6 +2215,46 @@ def main():
     parser.add_argument("-i", "--histogram-file", metavar="histogram_file", dest="histogram_file", type=str)
     parser.add_argument("-s", "--swarmplot-file", metavar="swarmplot_file", dest="swarmplot_file", type=str)
     parser.add_argument("-p", "--port", metavar="port", dest="port", type=int, help="API port")
+    parser.add_argument("-d", "--datasets-config", metavar="config_file", dest="datasets_config", type=str,
+                        default=None, help="json file with the datasets to serve, in place of the three data files")
+    parser.add_argument("--memory-budget", metavar="size_mb", dest="memory_budget", type=int, default=None,
+                        help="maximum size in MB of the arrays of the datasets held in memory, the least recently "
+                             "used datasets are unloaded above it")
+    parser.add_argument("--preload", dest="preload", action="store_true",
+                        help="load all the datasets of the config at startup, before forking the workers, instead of "
+                             "on their first request")
+    parser.add_argument("--background-loading", dest="background_loading", action="store_true",
+                        help="start serving right away and load the datasets in the background, each route answers "
+                             "with 503 until the data it needs is loaded. With gunicorn each worker loads the datasets "
+                             "after it starts, instead of sharing the ones loaded before the fork")
+    parser.add_argument("--watch-interval", metavar="seconds", dest="watch_interval", type=float, default=None,
+                        help="check the files of the loaded datasets for changes every given seconds, and reload the "
+                             "changed datasets without downtime")
+    parser.add_argument("--workers", metavar="num_workers", dest="workers", type=int, default=1,
+                        help="number of worker processes, each one sharing the datasets loaded before it is forked")
+    parser.add_argument("--threads", metavar="num_threads", dest="threads", type=int, default=4,
+                        help="number of threads handling the requests in each worker")
+    parser.add_argument("--graceful-timeout", metavar="seconds", dest="graceful_timeout", type=int, default=30,
+                        help="time given to the ongoing requests to finish on shutdown")
+    parser.add_argument("-w", "--write-store", metavar="store_dir", dest="store_dir", type=str, default=None,
+                        help="convert the three data files to a memory mappable store in the given directory and "
+                             "exit. Pass the store directory as heatmap, histogram and swarmplot file to serve it")
+    parser.add_argument("--response-cache-size", metavar="size_mb", dest="response_cache_size", type=int,
+                        default=128, help="maximum size in MB of the serialized responses kept in the cache")
+    parser.add_argument("--wormbase-url", dest="wormbase_url", type=str, default="http://rest.wormbase.org",
+                        help="base url of the WormBase REST API used for gene names and descriptions")
+    parser.add_argument("--gene-metadata-cache", metavar="cache_file", dest="gene_metadata_cache", type=str,
+                        default=None, help="path to a persistent cache file for the gene names and descriptions")
+    parser.add_argument("--prefetch-gene-metadata", dest="prefetch_gene_metadata", action="store_true",
+                        help="fetch the names and descriptions of all the genes in the persistent cache and exit")
+    parser.add_argument("--server-timing", dest="server_timing", action="store_true",
+                        help="send the time spent in each phase of the requests in a Server-Timing header")
+    parser.add_argument("--admin-token", dest="admin_token", type=str, default=None,
+                        help="token expected in the X-Admin-Token header of the admin requests, enables request "
+                             "profiling")
+    parser.add_argument("--profile-dir", dest="profile_dir", type=str,
+                        default=DEFAULT_PROFILE_DIR,
+                        help="directory where the request profiles are written")
     parser.add_argument("-l", "--log-file", metavar="log_file", dest="log_file", type=str, default=None,
                         help="path to the log file to generate")
     parser.add_argument("-L", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR',
@@ -233,32 +2265,52 @@ def main():
     logging.basicConfig(filename=args.log_file, level=args.log_level,
                         format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
 
-    app = falcon.API(middleware=[HandleCORS()])
-    file_storage = FileStorageEngine(args.heatmap_file, args.histogram_file, args.swarmplot_file)
-    app.add_route('/get_data_heatmap', HeatmapReader(file_storage))
-    app.add_route('/get_data_histogram', HistogramReader(file_storage))
-    app.add_route('/get_data_swarmplot', SwarmplotReader(file_storage))
-    app.add_route('/get_all_genes', GenesReader(file_storage))
-    app.add_route('/get_all_cells', CellsReader(file_storage))
-    app.add_route('/get_gene_concise_desc/{gene_id}', GeneDescriptionsReader())
-    app.add_route('/get_gene_name/{gene_id}', GeneNameReader())
-    httpd = simple_server.make_server('0.0.0.0', args.port, app)
-    httpd.serve_forever()
+    # threads don't survive a fork, so with gunicorn the background loading only starts in the workers
+    serve_with_gunicorn = gunicorn is not None and not args.store_dir and not args.prefetch_gene_metadata
+    registry = create_registry(args.datasets_config, args.heatmap_file, args.histogram_file, args.swarmplot_file,
+                               memory_budget_mb=args.memory_budget, preload=args.preload,
+                               background=args.background_loading, watch_interval=args.watch_interval,
+                               load=not (args.background_loading and serve_with_gunicorn))
+    if args.store_dir:
+        registry.get().write_store(args.store_dir)
+        return
+    if args.prefetch_gene_metadata:
+        wormbase_client = WormBaseClient(base_url=args.wormbase_url,
+                                         cache=GeneMetadataCache(db_path=args.gene_metadata_cache))
+        for name in registry.datasets:
+            wormbase_client.prefetch(registry.get(name).get_all_genes())
+        return
+    shutdown_event = threading.Event()
+    app = create_app(registry, response_cache_size_mb=args.response_cache_size, wormbase_url=args.wormbase_url,
+                     gene_metadata_cache=args.gene_metadata_cache, server_timing=args.server_timing,
+                     admin_token=args.admin_token, profile_dir=args.profile_dir, shutdown_event=shutdown_event)
+    if serve_with_gunicorn:
+        serve_gunicorn(app, args.port, workers=args.workers, threads=args.threads,
+                       graceful_timeout=args.graceful_timeout,
+                       post_worker_init=(lambda worker: registry.load_preloaded()) if args.background_loading else None,
+                       # the new workers are forked from the reloaded datasets, the old ones finish their requests
+                       on_reload=None if args.background_loading else lambda server: registry.reload(wait=True))
+    else:
+        if args.workers > 1:
+            logger.warning("gunicorn is not installed, serving from a single process")
+        serve_threaded(app, args.port, shutdown_event, registry)
 
 
 if __name__ == '__main__':
     main()
-else:
-    import os
-    app = falcon.API(middleware=[HandleCORS()])
-    file_storage = FileStorageEngine(os.environ['HEATMAP_FILE_PATH'], os.environ['HISTOGRAM_FILE_PATH'],
-                                     os.environ['SWARMPLOT_FILE_PATH'])
-    app.add_route('/get_data_heatmap', HeatmapReader(file_storage))
-    app.add_route('/get_data_histogram', HistogramReader(file_storage))
-    app.add_route('/get_data_swarmplot', SwarmplotReader(file_storage))
-    app.add_route('/get_all_genes', GenesReader(file_storage))
-    app.add_route('/get_all_cells', CellsReader(file_storage))
-    app.add_route('/get_gene_concise_desc/{gene_id}', GeneDescriptionsReader())
-    app.add_route('/get_gene_name/{gene_id}', GeneNameReader())
-
-
+elif os.environ.get('DATASETS_CONFIG_PATH') or os.environ.get('HEATMAP_FILE_PATH'):
+    # entry point of gunicorn, backend.api:app. With the gunicorn --preload option, the datasets loaded here are
+    # shared by the workers. With background loading, gunicorn.conf.py doesn't preload the app, so that each worker
+    # loads the datasets itself in background threads
+    registry = create_registry(os.environ.get('DATASETS_CONFIG_PATH'), os.environ.get('HEATMAP_FILE_PATH'),
+                               os.environ.get('HISTOGRAM_FILE_PATH'), os.environ.get('SWARMPLOT_FILE_PATH'),
+                               memory_budget_mb=int(os.environ.get('DATASETS_MEMORY_BUDGET_MB', 0)),
+                               preload=os.environ.get('DATASETS_PRELOAD') in ('1', 'true'),
+                               background=os.environ.get('DATASETS_BACKGROUND_LOADING') in ('1', 'true'),
+                               watch_interval=float(os.environ.get('DATASETS_WATCH_INTERVAL', 0)) or None)
+    app = create_app(registry, response_cache_size_mb=int(os.environ.get('RESPONSE_CACHE_SIZE_MB', 128)),
+                     wormbase_url=os.environ.get('WORMBASE_URL', 'http://rest.wormbase.org'),
+                     gene_metadata_cache=os.environ.get('GENE_METADATA_CACHE_PATH'),
+                     server_timing=os.environ.get('SERVER_TIMING') in ('1', 'true'),
+                     admin_token=os.environ.get('ADMIN_TOKEN'),
+                     profile_dir=os.environ.get('PROFILE_DIR', DEFAULT_PROFILE_DIR))
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""Benchmark of the backend api on synthetic datasets
+
+The script generates synthetic heatmap, histogram and swarmplot files with the layouts written by data_preparation.py,
+for each requested size (number of cell types x number of genes), and for each dataset it measures:
+
+- load_seconds: time to import the api module, load the dataset with create_registry and build the app with
+  create_app, the factories used by both the api.py and the gunicorn entry points
+- peak_rss_mb: peak resident memory of the process after loading the dataset and after running all the benchmarks
+- for each FileStorageEngine method and each api route (called through the falcon test client), the latency
+  percentiles in ms and the peak memory allocated by a single call, in KB, as traced by tracemalloc
+
+Each dataset is benchmarked in a fresh process, so that its peak memory is not affected by the others. The response
+cache is disabled, so that each request is actually computed.
+
+The results can be saved as a baseline and later runs compared to it, the script then exits with status 1 if any
+metric is worse than the baseline by more than the tolerance:
+
+    $ python3 -m backend.benchmark --sizes 50x5000,170x20000 --save-baseline benchmark_baseline.json
+    $ python3 -m backend.benchmark --sizes 50x5000,170x20000 --baseline benchmark_baseline.json
+
+Generated datasets are kept in --data-dir and reused by later runs. Note that the legacy anndata swarmplot layout
+holds the whole pairwise lfc tensor in memory (cell types x cell types x genes float16 values), so the largest sizes
+need several GB of memory to generate and load.
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import anndata
+import falcon.testing
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from data_preparation.wormcells_formats import SWARMPLOT_STATS, create_histogram_tensor, create_swarmplot_columnar
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASET_FORMATS = ['anndata', 'hdf5', 'store']
+HISTOGRAM_NUM_BINS = 100
+# metrics compared to the baseline, with the absolute difference under which a change is considered noise
+COMPARED_METRICS = {'p50_ms': 0.25, 'p90_ms': 1, 'alloc_peak_kb': 64, 'load_seconds': 0.25, 'peak_rss_mb': 16}
+
+
+def parse_size(size: str):
+    num_cells, num_genes = size.lower().split('x')
+    return int(num_cells), int(num_genes)
+
+
+def get_names(num_cells: int, num_genes: int):
+    return [f"cell_type_{idx:03d}" for idx in range(num_cells)], [f"WBGene{idx:08d}" for idx in range(num_genes)]
+
+
+def make_heatmap_values(rng, num_cells: int, num_genes: int):
+    # log10 of the scvi expression frequency, of shape (cells x genes)
+    return rng.uniform(-7, -1, (num_cells, num_genes))
+
+
+def make_gene_histograms(rng, num_cells: int, gene_expression):
+    """counts in each bin of the log10 expression, of shape (cells x bins), as a bump around the expression of the
+    gene in each cell type so that most bins are empty, like in real data"""
+    bin_starts = np.linspace(-10, 0, HISTOGRAM_NUM_BINS, endpoint=False)
+    width = rng.uniform(0.2, 1, (num_cells, 1))
+    num_cells_in_type = rng.integers(10, 2000, (num_cells, 1))
+    density = np.exp(-(bin_starts[np.newaxis, :] - gene_expression[:, np.newaxis]) ** 2 / (2 * width ** 2))
+    return np.round(density / density.sum(axis=1, keepdims=True) * num_cells_in_type).astype(np.int16)
+
+
+def make_swarmplot_stats(rng, heatmap):
+    """one vs all DE statistics of shape (cells x genes) and a per cell type expression used to build the pairwise lfc,
+    so that the pairwise lfc is antisymmetric like the one computed by data_preparation.py"""
+    lfc_mean = rng.normal(0, 1.5, heatmap.shape)
+    stats = {'proba_not_de': rng.uniform(0, 1, heatmap.shape), 'scale1': 10 ** heatmap,
+             'scale2': 10 ** (heatmap - lfc_mean * np.log10(2)), 'lfc_mean': lfc_mean,
+             'lfc_median': lfc_mean + rng.normal(0, 0.1, heatmap.shape)}
+    return {stat: values.astype(np.float16) for stat, values in stats.items()}, rng.normal(0, 2, heatmap.shape)
+
+
+def get_pairwise_lfc(log2_expression, cell_pos: int):
+    # median lfc of each cell type vs the given one, of shape (cells x genes), rounded like in data_preparation.py
+    return np.round(log2_expression - log2_expression[cell_pos], 2).astype(np.float16)
+
+
+def write_anndata_dataset(paths: dict, num_cells: int, num_genes: int, seed: int):
+    """write the three files with the original anndata layouts"""
+    rng = np.random.default_rng(seed)
+    cells, genes = get_names(num_cells, num_genes)
+    heatmap = make_heatmap_values(rng, num_cells, num_genes)
+    write_heatmap_anndata(paths['heatmap'], heatmap, cells, genes)
+
+    bins = np.round(np.linspace(-10, 0, HISTOGRAM_NUM_BINS, endpoint=False), 1).astype(str)
+    histogram_adata = anndata.AnnData(X=np.zeros((num_cells, HISTOGRAM_NUM_BINS)), obs=pd.DataFrame(index=cells),
+                                      var=pd.DataFrame(index=bins))
+    for gene_pos, gene_id in enumerate(genes):
+        histogram_adata.layers[gene_id] = sparse.csr_matrix(make_gene_histograms(rng, num_cells, heatmap[:, gene_pos]))
+    histogram_adata.uns['about'] = 'synthetic histograms generated by benchmark.py'
+    histogram_adata.write_h5ad(paths['histogram'])
+    del histogram_adata
+
+    stats, log2_expression = make_swarmplot_stats(rng, heatmap)
+    swarmplot_adata = anndata.AnnData(X=np.zeros((num_cells, num_genes)), obs=pd.DataFrame(index=cells),
+                                      var=pd.DataFrame(index=genes))
+    for cell_pos, cell_name in enumerate(cells):
+        # the layer of each cell type has the lfc of every cell type vs the layer one, of shape (cells x genes)
+        swarmplot_adata.layers[cell_name] = -get_pairwise_lfc(log2_expression, cell_pos)
+        swarmplot_adata.uns[cell_name] = pd.DataFrame({stat: stats[stat][cell_pos] for stat in SWARMPLOT_STATS},
+                                                      index=genes)
+    swarmplot_adata.uns['heatmap'] = pd.DataFrame(heatmap.T, index=genes, columns=cells)
+    swarmplot_adata.uns['about'] = 'synthetic swarm plots generated by benchmark.py'
+    swarmplot_adata.write_h5ad(paths['swarmplot'])
+
+
+def write_heatmap_anndata(file_path: str, heatmap, cells, genes):
+    heatmap_adata = anndata.AnnData(X=heatmap, obs=pd.DataFrame(index=cells), var=pd.DataFrame(index=genes))
+    heatmap_adata.uns['about'] = 'synthetic heatmap generated by benchmark.py'
+    heatmap_adata.write_h5ad(file_path)
+
+
+def write_hdf5_dataset(paths: dict, num_cells: int, num_genes: int, seed: int):
+    """write the heatmap anndata, the histogram tensor and the swarmplot columnar file written by the current version
+    of data_preparation.py, with the writers of data_preparation/wormcells_formats.py"""
+    rng = np.random.default_rng(seed)
+    cells, genes = get_names(num_cells, num_genes)
+    heatmap = make_heatmap_values(rng, num_cells, num_genes)
+    write_heatmap_anndata(paths['heatmap'], heatmap, cells, genes)
+
+    bins = np.round(np.linspace(-10, 0, HISTOGRAM_NUM_BINS, endpoint=False), 1).astype(str)
+    h5_file, counts = create_histogram_tensor(paths['histogram'], genes=genes, cells=cells, bins=bins,
+                                              about='synthetic histograms generated by benchmark.py')
+    with h5_file:
+        for gene_pos in range(num_genes):
+            counts[gene_pos] = make_gene_histograms(rng, num_cells, heatmap[:, gene_pos])
+
+    stats, log2_expression = make_swarmplot_stats(rng, heatmap)
+    with create_swarmplot_columnar(paths['swarmplot'], genes=genes, cells=cells,
+                                   about='synthetic swarm plots generated by benchmark.py') as h5_file:
+        for stat in SWARMPLOT_STATS:
+            h5_file[stat][...] = stats[stat]
+        for cell_pos in range(num_cells):
+            # lfc of the cell type vs every other cell type
+            h5_file['lfc_median_pairwise'][cell_pos] = -get_pairwise_lfc(log2_expression, cell_pos)
+        h5_file['heatmap'][...] = heatmap
+
+
+def generate_dataset(data_dir: str, num_cells: int, num_genes: int, dataset_format: str, seed: int = 0):
+    """generate the files of a synthetic dataset, unless they were generated by a previous run, and return their
+    paths"""
+    name = f"{num_cells}x{num_genes}_seed{seed}"
+    file_format = 'hdf5' if dataset_format == 'store' else dataset_format
+    extension = '.h5ad' if file_format == 'anndata' else '.h5'
+    paths = {'heatmap': os.path.join(data_dir, f"{name}+heatmap_anndata.h5ad"),
+             'histogram': os.path.join(data_dir, f"{name}+{file_format}+histogram{extension}"),
+             'swarmplot': os.path.join(data_dir, f"{name}+{file_format}+swarmplot{extension}")}
+    # the swarmplot is written last, so its presence means that the dataset is complete
+    if not os.path.isfile(paths['swarmplot']):
+        print(f"Generating {file_format} dataset {name} in {data_dir}")
+        os.makedirs(data_dir, exist_ok=True)
+        if file_format == 'anndata':
+            write_anndata_dataset(paths, num_cells, num_genes, seed)
+        else:
+            write_hdf5_dataset(paths, num_cells, num_genes, seed)
+    if dataset_format == 'store':
+        store_dir = os.path.join(data_dir, f"{name}+store")
+        if not os.path.isfile(os.path.join(store_dir, 'index.json')):
+            print(f"Writing store {store_dir}")
+            subprocess.run([sys.executable, '-m', 'backend.api', '-e', paths['heatmap'], '-i', paths['histogram'],
+                            '-s', paths['swarmplot'], '-w', store_dir], check=True,
+                           env=dict(os.environ, PYTHONPATH=REPO_DIR))
+        paths = {data_type: store_dir for data_type in paths}
+    return paths
+
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return peak_rss / 1024 ** 2 if sys.platform == 'darwin' else peak_rss / 1024
+
+
+def load_api(paths: dict):
+    """import the api module and build the app with the factory of the api entry points, with the response cache
+    disabled, and return them with the load time"""
+    start = time.perf_counter()
+    api = importlib.import_module('backend.api')
+    registry = api.create_registry(heatmap_file=paths['heatmap'], histogram_file=paths['histogram'],
+                                   swarmplot_file=paths['swarmplot'])
+    app = api.create_app(registry, response_cache_size_mb=0)
+    return api, registry, app, time.perf_counter() - start
+
+
+def make_queries(engine, num_queries: int, seed: int):
+    """random but reproducible queries, each one usable both for the engine methods and the api routes"""
+    rng = np.random.default_rng(seed)
+    genes, cells = engine.get_all_genes(), engine.get_all_cells()
+    return [{'gene_ids': list(rng.choice(genes, min(20, len(genes)), replace=False)),
+             'cell_names': list(rng.choice(cells, min(20, len(cells)), replace=False)),
+             'gene_id': str(rng.choice(genes)), 'cell': str(rng.choice(cells)),
+             'sort_by': str(rng.choice(['p_value', 'lfc', 'expr'])), 'ascending': bool(rng.integers(2))}
+            for _ in range(num_queries)]
+
+
+def get_benchmarks(api, engine, client):
+    """functions called with a query, for each engine method and each route"""
+
+    def post(path: str, media: dict, accept: str = 'application/json'):
+        result = client.simulate_post(path, json=media, headers={'Accept': accept})
+        if result.status_code != 200:
+            raise RuntimeError(f"{path} returned {result.status}")
+
+    def heatmap_media(query):
+        return {'gene_ids': query['gene_ids'], 'cell_names': query['cell_names']}
+
+    def histogram_media(query):
+        return {'gene_id': query['gene_id'], 'sort_by_freq': True}
+
+    def swarmplot_media(query):
+        return {'cell': query['cell'], 'sort_by': query['sort_by'], 'max_num_genes': 50,
+                'ascending': 'true' if query['ascending'] else 'false'}
+
+    return {
+        'engine.get_data_heatmap': lambda query: engine.get_data_heatmap(query['gene_ids'], query['cell_names']),
+        'engine.get_data_histogram': lambda query: engine.get_data_histogram(query['gene_id'], sort_by_freq=True),
+        'engine.get_data_swarmplot': lambda query: engine.get_data_swarmplot(query['cell'], query['sort_by'],
+                                                                             query['ascending'], 50),
+        'engine.get_all_genes': lambda query: engine.get_all_genes(),
+        'engine.get_all_cells': lambda query: engine.get_all_cells(),
+        'engine.get_similar_genes': lambda query: engine.get_similar_genes(query['gene_id']),
+        'POST /get_data_heatmap': lambda query: post('/get_data_heatmap', heatmap_media(query)),
+        'POST /get_data_histogram': lambda query: post('/get_data_histogram', histogram_media(query)),
+        'POST /get_data_swarmplot': lambda query: post('/get_data_swarmplot', swarmplot_media(query)),
+        'POST /get_data_heatmap columnar': lambda query: post('/get_data_heatmap', heatmap_media(query),
+                                                              api.COLUMNAR_MEDIA_TYPE),
+        'POST /get_data_histogram columnar': lambda query: post('/get_data_histogram', histogram_media(query),
+                                                                api.COLUMNAR_MEDIA_TYPE),
+        'POST /get_data_swarmplot columnar': lambda query: post('/get_data_swarmplot', swarmplot_media(query),
+                                                                api.COLUMNAR_MEDIA_TYPE),
+        'POST /get_data_batch': lambda query: post('/get_data_batch', {'queries': [
+            dict(heatmap_media(query), type='heatmap'), dict(histogram_media(query), type='histogram'),
+            dict(swarmplot_media(query), type='swarmplot')]}),
+        'GET /get_all_genes': lambda query: client.simulate_get('/get_all_genes'),
+        'GET /get_all_cells': lambda query: client.simulate_get('/get_all_cells'),
+        'GET /get_similar_genes': lambda query: client.simulate_get('/get_similar_genes',
+                                                                    params={'gene_id': query['gene_id']}),
+    }
+
+
+def run_benchmark(function, queries, num_warmup: int = 5, num_traced: int = 5):
+    for query in queries[:num_warmup]:
+        function(query)
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        function(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    # allocations are traced separately, since tracing slows down the calls
+    alloc_peaks = []
+    for query in queries[:num_traced]:
+        tracemalloc.start()
+        function(query)
+        alloc_peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+        tracemalloc.stop()
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'max_ms': max(latencies), 'mean_ms': np.mean(latencies),
+            'alloc_peak_kb': max(alloc_peaks)}
+
+
+def benchmark_dataset(paths: dict, num_queries: int, seed: int):
+    """load a dataset in the api and run all the benchmarks on it, meant to be run in a fresh process"""
+    # the routes log each request at the INFO level, which is not enabled here: the log messages are built but not
+    # written, unlike in production where they go to the log file
+    api, registry, app, load_seconds = load_api(paths)
+    results = {'load_seconds': load_seconds, 'loaded_rss_mb': get_peak_rss_mb(), 'benchmarks': {}}
+    client = falcon.testing.TestClient(app)
+    queries = make_queries(registry.get(), num_queries, seed)
+    for name, function in get_benchmarks(api, registry.get(), client).items():
+        results['benchmarks'][name] = run_benchmark(function, queries)
+    results['peak_rss_mb'] = get_peak_rss_mb()
+    return results
+
+
+def print_results(label: str, results: dict):
+    print(f"\n{label}: load {results['load_seconds']:.2f} s, RSS after load {results['loaded_rss_mb']:.0f} MB, "
+          f"peak RSS {results['peak_rss_mb']:.0f} MB")
+    print(f"{'benchmark':<36}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'alloc KB':>12}")
+    for name, metrics in results['benchmarks'].items():
+        print(f"{name:<36}{metrics['p50_ms']:>10.2f}{metrics['p90_ms']:>10.2f}{metrics['p99_ms']:>10.2f}"
+              f"{metrics['max_ms']:>10.2f}{metrics['alloc_peak_kb']:>12.0f}")
+
+
+def compare_to_baseline(all_results: dict, baseline: dict, tolerance: float):
+    """return the list of metrics worse than the baseline by more than the tolerance, as readable strings"""
+    regressions = []
+
+    def compare(label: str, metric: str, value: float, baseline_value: float):
+        if value > baseline_value * (1 + tolerance) and value - baseline_value > COMPARED_METRICS[metric]:
+            regressions.append(f"{label} {metric}: {value:.2f} vs {baseline_value:.2f} in the baseline "
+                               f"(+{(value / baseline_value - 1) * 100 if baseline_value else float('inf'):.0f}%)")
+
+    for dataset_label, results in all_results.items():
+        if dataset_label not in baseline:
+            print(f"Dataset {dataset_label} is not in the baseline, not compared")
+            continue
+        for metric in ('load_seconds', 'peak_rss_mb'):
+            compare(dataset_label, metric, results[metric], baseline[dataset_label][metric])
+        for name, metrics in results['benchmarks'].items():
+            baseline_metrics = baseline[dataset_label]['benchmarks'].get(name)
+            if baseline_metrics is None:
+                continue
+            for metric in ('p50_ms', 'p90_ms', 'alloc_peak_kb'):
+                compare(f"{dataset_label} {name}", metric, metrics[metric], baseline_metrics[metric])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend api on synthetic datasets")
+    parser.add_argument("--sizes", dest="sizes", type=str, default="50x5000",
+                        help="comma separated list of dataset sizes, as number of cell types x number of genes, "
+                             "for example 50x5000,170x20000,500x20000")
+    parser.add_argument("-f", "--format", dest="dataset_format", choices=DATASET_FORMATS, default="anndata",
+                        help="layout of the dataset files: the original anndata files, the HDF5 files written by the "
+                             "current data_preparation.py, or a store of memory mapped arrays")
+    parser.add_argument("-d", "--data-dir", dest="data_dir", type=str, default="benchmark_data",
+                        help="directory where the synthetic datasets are generated and kept for later runs")
+    parser.add_argument("-n", "--num-queries", dest="num_queries", type=int, default=200,
+                        help="number of calls of each benchmark")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="seed of the synthetic data and queries")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None,
+                        help="write the results to this json file")
+    parser.add_argument("--save-baseline", dest="save_baseline", type=str, default=None,
+                        help="write the results to this json file, to be used as baseline by later runs")
+    parser.add_argument("-b", "--baseline", dest="baseline", type=str, default=None,
+                        help="compare the results to this baseline and exit with status 1 if any is worse")
+    parser.add_argument("-t", "--tolerance", dest="tolerance", type=float, default=0.25,
+                        help="relative increase of a metric over the baseline considered a regression")
+    args = parser.parse_args()
+
+    all_results = {}
+    for size in args.sizes.split(','):
+        num_cells, num_genes = parse_size(size)
+        paths = generate_dataset(args.data_dir, num_cells, num_genes, args.dataset_format, args.seed)
+        dataset_label = f"{args.dataset_format} {num_cells}x{num_genes}"
+        # a new process for each dataset, so that its memory usage is measured on its own
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                    mp_context=multiprocessing.get_context('spawn')) as executor:
+            all_results[dataset_label] = executor.submit(benchmark_dataset, paths, args.num_queries, args.seed).result()
+        print_results(dataset_label, all_results[dataset_label])
+
+    for output in (args.output, args.save_baseline):
+        if output:
+            with open(output, 'w') as output_file:
+                json.dump(all_results, output_file, indent=2)
+            print(f"\nResults written to {output}")
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(all_results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} REGRESSIONS compared to {args.baseline}:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print(f"\nNo regression compared to {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# gunicorn settings for the backend api, to be used with
+# gunicorn -c backend/gunicorn.conf.py backend.api:app
+# with the PROMETHEUS_MULTIPROC_DIR environment variable pointing to an empty directory, so that /metrics aggregates
+# the metrics of all the workers
+
+import os
+import sys
+
+from prometheus_client import multiprocess
+
+# the datasets are loaded once before forking the workers, which share their pages copy-on-write. With
+# DATASETS_BACKGROUND_LOADING, each worker loads them in background threads instead, since threads don't survive a fork
+preload_app = os.environ.get('DATASETS_BACKGROUND_LOADING') not in ('1', 'true')
+# the gthread worker keeps notifying the arbiter while a request loads a dataset, so that it isn't killed
+worker_class = 'gthread'
+threads = 4
+graceful_timeout = 30
+
+
+def child_exit(server, worker):
+    # drops the live gauges of the worker, its counters and histograms are kept in the totals
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def on_reload(server):
+    # on SIGHUP the new workers are forked from the preloaded app, so the datasets whose files changed are reloaded
+    # first, while the old workers keep serving
+    api = sys.modules.get(server.app.app_uri.split(':')[0])
+    if preload_app and getattr(api, 'registry', None) is not None:
+        api.registry.reload(wait=True)
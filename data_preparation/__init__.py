@@ -0,0 +1 @@
+# shared data formats, imported by the backend api as data_preparation.wormcells_formats
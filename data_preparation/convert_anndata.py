@@ -0,0 +1,35 @@
+### This script converts the anndata files created by older versions of data_preparation.py
+### to the current wormcells-viz file formats, without having to recompute anything
+### https://github.com/WormBase/wormcells-viz
+### for example, to convert a histogram anndata with one layer per gene to a histogram tensor:
+# python3 convert_anndata.py histogram cengen+histogram_anndata.h5ad cengen+histogram.h5
+### or to convert a swarm plot anndata with one dataframe per cell type in uns to a swarm plot columnar file:
+# python3 convert_anndata.py swarmplot cengen+swarmplot_anndata.h5ad cengen+swarmplot.h5
+### or to add the precomputed co-expression neighbors of each gene to an existing heatmap anndata:
+# python3 convert_anndata.py coexpression cengen+heatmap_anndata.h5ad cengen+heatmap_anndata.h5ad
+
+import argparse
+
+from wormcells_formats import convert_histogram_anndata, convert_swarmplot_anndata, add_coexpression_neighbors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert wormcells-viz anndata files to the current formats")
+    parser.add_argument("file_type", choices=['histogram', 'swarmplot', 'coexpression'],
+                        help="type of data contained in the input file")
+    parser.add_argument("input_file", help="path to the anndata (.h5ad) file to convert")
+    parser.add_argument("output_file", help="path of the converted file to write")
+    parser.add_argument("--n-neighbors", type=int, default=100,
+                        help="number of co-expression neighbors of each gene to store, for coexpression")
+    args = parser.parse_args()
+
+    if args.file_type == 'histogram':
+        convert_histogram_anndata(args.input_file, args.output_file)
+    elif args.file_type == 'swarmplot':
+        convert_swarmplot_anndata(args.input_file, args.output_file)
+    elif args.file_type == 'coexpression':
+        import anndata
+        adata = anndata.read_h5ad(args.input_file)
+        add_coexpression_neighbors(adata, n_neighbors=args.n_neighbors)
+        adata.write_h5ad(args.output_file)
+    print('Converted', args.input_file, 'to', args.output_file)
@@ -5,7 +5,7 @@
 It assumes that data has been wrangled into the WormBase standard anndata format:
 https://github.com/WormBase/anndata-wrangling
 
-Three separate anndata files (.h5ad) will be created:
+Three separate data files will be created, the heatmap as an anndata file (.h5ad):
 ## For the expression heatmap
 This data is a 2D matrix of shape:
 $ n_{celltypes} \times n_{genes} = x_{obs} \times y_{var}  $
@@ -15,48 +15,48 @@ adata.obs = cell_types
 adata.var = gene_id
 adata.X = log10 scvi expression frequency values in the X field
 ```
+Optionally with the co-expression neighbors of each gene precomputed in `adata.varm`, see `wormcells_formats.py`.
 ## For the gene histogram
 This data is a 3D tensor of shape:
-$ n_{celltypes} \times n_{bins} \times n_{genes} = x_{obs} \times y_{var} \times z_{layers} $
-The anndata obs contains the cell types and var contains the histogram bins,
-the genes are stored in layers with the keys being the gene ID.
-We store the genes in the layers because each view in the wormcells-viz app show the histograms for a single gene,
-so this makes accessing the data simpler
+$ n_{genes} \times n_{celltypes} \times n_{bins} $
+It is stored as a single contiguous int16 tensor in an HDF5 file, chunked by gene, because each view in the
+wormcells-viz app shows the histograms for a single gene, so one view is a single chunk read.
 The histogram bin counts are computed from the scvi normalized expression values, binned in 100 bins from 10^-9 to 10^0
 ```
-adata.obs = cell_types
-adata.var = bins with counts
+file['counts'] = counts of shape (genes x cell types x bins)
 these should be 100 evenly spaced bins, with the counts of cells containing
 values between (-10, 0), representing the data 10^-9 to 10^0 expression rates  log10 transformed
-adata.X = NOTHING (filled with vector of zeroes)
-adata.layers[cell_type] = the key is the corresponding cell_type
-each layer contains counts in each bin for all cell types
-adata.uns['about'] = information about the dataset
+file['genes'] = gene ids
+file['cells'] = cell types
+file['bins'] = lower bound of each bin
+file.attrs['about'] = information about the dataset
 ```
+See `wormcells_formats.py` for the details. Histogram anndata files created by older versions of this script, with the
+genes stored in the layers, can be converted with `convert_anndata.py`.
 
 ## For the swarm plots
 This data is a 3D tensor of shape:
-$ n_{celltypes} \times n_{genes} \times n_{celltypes} = x_{obs} \times y_{var} \times z_{layers} $
+$ n_{celltypes} \times n_{celltypes} \times n_{genes} $
 Notice that the cell types are repeated along two dimensions, because this data contains the results of pairwise DE
 comparisons among each cell type in the data.
-Plus $n_{celltypes}$ matrices of shape:
-$ n_{celltypes} \times n_{genes} = x_{obs} \times y_{var}  $
-
-Because each `anndata.uns[celltype]` contains a dataframe with global differnetial expression results for that celltype.
-Finally, `anndata.uns['heatmap']` contains the 2D matrix with log10 scvi expression rates heatmap data, with genes in
-the index and cell types in the columns. This can be used to display the expression of each tissue upon mouseover.
+Plus one matrix of shape
+$ n_{celltypes} \times n_{genes} $
+for each statistic of the global differential expression of each cell type vs all other cells.
+Finally, a matrix of the same shape contains the log10 scvi expression rates heatmap data,
+which can be used to display the expression of each tissue upon mouseover.
+All of them are stored as stacked arrays in a single HDF5 file, sharing the same gene and cell type indexes:
 ```
-anndata.obs = cell_types
-anndata.var = gene_id
-anndata.X = NOTHING (filled with vector of zeroes)
-anndata.layers[cell_type] = mean log fold change for a given cell type for all genes
-anndata.uns[cell_type] = contain the DE result of the corresponding cell type vs all other cells
-this can be used for ordering the genes by p-value, expression,
-and by log fold change lfc max/min/median/mean/std
-anndata.uns['heatmap']= dataframe with genes in index and cell types in columns containing the log10 of the
-scvi expression frequency for each cell type
-anndata.uns['about'] = information about the dataset
+file['cells'] = cell types
+file['genes'] = gene ids
+file['lfc_median_pairwise'] = median log fold change of shape (group1 cell types x group2 cell types x genes)
+file['proba_not_de'], file['scale1'], file['scale2'], file['lfc_mean'], file['lfc_median'] = DE results of each
+cell type vs all other cells, of shape (cell types x genes)
+this can be used for ordering the genes by p-value, expression, and by log fold change
+file['heatmap'] = log10 of the scvi expression frequency for each cell type, of shape (cell types x genes)
+file.attrs['about'] = information about the dataset
 ```
+See `wormcells_formats.py` for the details. Swarm plot anndata files created by older versions of this script, with
+one dataframe per cell type in `anndata.uns`, can be converted with `convert_anndata.py`.
 '''
 ### USER DEFINED ARGUMENTS
 ### PLEASE MAKE SURE THESE ARGUMENTS MATCH YOUR DATA
@@ -77,6 +77,46 @@ batch_key = 'sample_batch'
 # save the trained model if it doesn't find anything
 model_name = 'cengen_scvi_2021-06-13'
 
+# the normalized expression used for the histograms is computed in batches of this many cells, peak memory of the
+# histogram step is roughly proportional to histogram_cell_batch_size x number of genes in each batch
+histogram_cell_batch_size = 2048
+# the genes are split in batches of this size, each batch of genes needs one more pass of the model over all cells, so
+# smaller batches are slower and only needed when a batch of cells x all genes does not fit in memory. None uses the
+# largest batch whose int32 counts of shape (genes x cell types x bins) fit in histogram_counts_max_bytes, which is
+# all the genes of CeNGEN (about 1.4 GB for 20k genes x 169 cell types x 100 bins)
+histogram_gene_batch_size = None
+histogram_counts_max_bytes = 2 * 1024 ** 3
+
+# all the DE comparisons are computed from posterior samples of the normalized expression of each cell type,
+# which are drawn from the model only once and stored in the model_name+posterior_samples folder
+# number of posterior samples used for each DE comparison, as in scvi model.differential_expression
+de_n_samples = 5000
+# minimum absolute log2 fold change for a gene to be considered differentially expressed, as in scvi
+de_delta = 0.25
+# number of cells decoded at a time when drawing the posterior samples
+posterior_samples_cell_batch_size = 2048
+
+# number of processes used for the pairwise DE, which is the slowest step of the pipeline
+# each process computes the comparisons from the posterior samples on CPU only, None uses one process per CPU
+# and 1 runs serially
+pairwise_de_n_workers = None
+# the DE of group2 vs group1 is the mirror of group1 vs group2 (negated lfc, swapped scales), so only one of the two
+# is computed, this is the number of random pairs for which the reverse comparison is also computed explicitly
+# to check the mirrored values, 0 disables the check
+pairwise_de_validation_pairs = 0
+
+# number of co-expression neighbors of each gene to precompute and store in the heatmap anndata, so that the
+# similar genes queries are answered without computing them, None computes them in the backend on request
+coexpression_n_neighbors = None
+
+# every file created by the pipeline is stamped with a hash of its inputs and parameters, and is only rebuilt when
+# they change, files created by older versions of this script have no stamp: with True they are assumed to be up to
+# date and get stamped with the current inputs, with a warning, so that eg a trained model is not retrained, with
+# False they are rebuilt
+trust_unstamped_artifacts = True
+# run `python3 data_preparation.py --dry-run` to print what would be rebuilt, with the estimated cost, without
+# running anything
+
 ### these multiline strings will be added to the adata.uns['about'] property, it can be anything
 
 about_heatmap = """
@@ -110,16 +150,57 @@ import pandas as pd
 import os
 import scanpy
 import warnings
+import time
+import multiprocessing
+import zlib
+import sys
+import hashlib
 from scipy import sparse
 
+from wormcells_formats import create_histogram_tensor, create_swarmplot_columnar, add_coexpression_neighbors, \
+    SWARMPLOT_STATS
+from posterior_samples import write_genes, read_genes, create_posterior_samples, finish_posterior_samples, \
+    posterior_samples_path, has_posterior_samples, load_posterior_samples, compute_de_stats, DE_STATS
+from pipeline_stamps import hash_parameters, read_stamp, write_stamp, remove_stamp, check_stamp
+
 warnings.filterwarnings("ignore")
 print('Using scvi-tools version:', scvi.__version__)
 
 
-def load_or_train_scvi_model(model_name=model_name, anndata_path=anndata_path):
+def is_stage_up_to_date(artifact_path, stamp_key):
+    # without a stamp key only checks that the artifact exists, otherwise also checks that it was created from the
+    # same inputs and parameters
+    if stamp_key is None:
+        return os.path.exists(artifact_path)
+    up_to_date, reason = check_stamp(artifact_path, stamp_key, trust_unstamped=trust_unstamped_artifacts)
+    if up_to_date and read_stamp(artifact_path) is None:
+        print('Warning: assuming that', artifact_path, 'was created from the current inputs, since it is not stamped, '
+              'delete it or set trust_unstamped_artifacts = False to rebuild it')
+        write_stamp(artifact_path, stamp_key)
+    elif not up_to_date and os.path.exists(artifact_path):
+        print('Rebuilding', artifact_path, '--', reason)
+    return up_to_date
+
+
+def stamp_stage(artifact_path, stamp_key, start_time, **details):
+    if stamp_key is not None:
+        write_stamp(artifact_path, stamp_key, elapsed=time.time() - start_time, **details)
+
+
+def stage_key(pipeline_keys, stage, item=None):
+    # key of one artifact from the keys computed by compute_pipeline_keys, None when the pipeline runs without them
+    if pipeline_keys is None:
+        return None
+    return pipeline_keys[stage] if item is None else pipeline_keys[stage][item]
+
+
+def load_or_train_scvi_model(model_name=model_name, anndata_path=anndata_path, pipeline_keys=None):
     # Try loading model, if it doesn't exist train from scratch
     print('Trying to load or train model...')
+    start_time = time.time()
     try:
+        if not is_stage_up_to_date(model_name, stage_key(pipeline_keys, 'train')):
+            raise FileNotFoundError('Missing or out of date model: ' + model_name)
         model = scvi.model.SCVI.load(model_name)
         print('Loaded model:', model_name)
     except:
@@ -167,36 +248,109 @@ def load_or_train_scvi_model(model_name=model_name, anndata_path=anndata_path):
 
         ### MAKE SURE THE MODEL FINISHED TRAINING FOR BEST RESULTS
         print(train_test_results)
-        model.save(model_name, save_anndata=True)
+        model.save(model_name, save_anndata=True, overwrite=True)
         # save the training results to a csv for inspection if needed
         train_test_results.to_csv(model_name + '+train_test_results.csv')
+        stamp_stage(model_name, stage_key(pipeline_keys, 'train'), start_time)
     return model
 
 
-def make_de_global(model, stratification_label=stratification_label, model_name=model_name):
+def posterior_samples_store_path(model_name=model_name):
+    return model_name + '+posterior_samples'
+
+
+def de_comparison_seed(group1_label, group2_label):
+    # each comparison uses its own fixed random seed, so the results do not depend on the order of the comparisons
+    return zlib.crc32((str(group1_label) + ' vs ' + str(group2_label)).encode())
+
+
+def make_posterior_samples(model,
+                           stratification_label=stratification_label,
+                           model_name=model_name,
+                           n_samples=de_n_samples,
+                           cell_batch_size=posterior_samples_cell_batch_size,
+                           pipeline_keys=None):
+    # draws the posterior samples of the normalized expression of each cell type once,
+    # all the DE comparisons are then computed from these samples without running the model again
+    adata = model.adata
+    store_path = posterior_samples_store_path(model_name)
+    obs_stratification_labels = adata.obs[stratification_label]
+    write_genes(store_path, adata.var.index)
+    for group_label in tqdm(obs_stratification_labels.unique()):
+        samples_filename = posterior_samples_path(store_path, group_label, 'log2_samples.npy')
+        if has_posterior_samples(store_path, group_label) and \
+                is_stage_up_to_date(samples_filename, stage_key(pipeline_keys, 'posterior_samples', group_label)):
+            continue
+        start_time = time.time()
+        # each cell type has its own random seed so that it can be sampled again independently of the others
+        rng = np.random.default_rng(de_comparison_seed(group_label, 'samples'))
+        cell_indices = np.flatnonzero((obs_stratification_labels == group_label).values)
+        # like scvi, uses at most n_samples cells, and several samples per cell for the smaller cell types
+        if len(cell_indices) > n_samples:
+            cell_indices = np.sort(rng.choice(cell_indices, n_samples, replace=False))
+        n_samples_per_cell = max(n_samples // len(cell_indices), 1)
+        log2_samples = create_posterior_samples(store_path, group_label,
+                                                n_samples=len(cell_indices) * n_samples_per_cell,
+                                                n_genes=adata.n_vars)
+        scale_sum = np.zeros(adata.n_vars)
+        batch_size = max(cell_batch_size // n_samples_per_cell, 1)
+        sample_pos = 0
+        for cell_start in range(0, len(cell_indices), batch_size):
+            samples = model.get_normalized_expression(indices=cell_indices[cell_start:cell_start + batch_size],
+                                                      n_samples=n_samples_per_cell,
+                                                      return_mean=False,
+                                                      return_numpy=True).reshape(-1, adata.n_vars)
+            scale_sum += samples.sum(axis=0)
+            # avoids log2(0) for the expression values that underflow
+            np.maximum(samples, np.finfo('float32').tiny, out=samples)
+            log2_samples[sample_pos:sample_pos + len(samples)] = np.log2(samples, out=samples)
+            sample_pos += len(samples)
+        finish_posterior_samples(store_path, group_label, log2_samples, scale_mean=scale_sum / sample_pos,
+                                 n_cells=(obs_stratification_labels == group_label).sum())
+        stamp_stage(samples_filename, stage_key(pipeline_keys, 'posterior_samples', group_label), start_time)
+
+
+def make_de_global(model,
+                   stratification_label=stratification_label,
+                   model_name=model_name,
+                   n_samples=de_n_samples,
+                   delta=de_delta,
+                   pipeline_keys=None):
     # perform DE on each cell type vs the rest of cells, this computes the expresssion (scale1)
     # in each celltype, used for the heatmap anndata, plus scale1, the p-values and lfc_median
     # for each cell type which are used for ranking the swarmplot
     # saves in a csv to avoid recomputing
     # checks if the CSV exists prior to running the DE
     de_global_filename = model_name + '+de_global.csv'
-    try:
+    if is_stage_up_to_date(de_global_filename, stage_key(pipeline_keys, 'de_global')):
         de_global = pd.read_csv(de_global_filename, index_col=0)
         print('Loaded global DE:', de_global_filename)
-    except:
+    else:
         print('Performing global DE...')
-        de_global = model.differential_expression(
-            groupby=stratification_label,
-            all_stats=False
-        )
-
-        # scvi currently puts the groups in a column named "comparison", eg
-        # an entry would be "Neurons vs Instestine" but we need to split that into
-        # one column for group1 and group2. Submitted a PR to change that:
-        # https://github.com/YosefLab/scvi-tools/pull/1074
-        de_global['group1'] = de_global['comparison'].str.split(' vs ', expand=True)[0]
-        de_global['group2'] = de_global['comparison'].str.split(' vs ', expand=True)[1]
+        make_posterior_samples(model, stratification_label=stratification_label, model_name=model_name,
+                               n_samples=n_samples, pipeline_keys=pipeline_keys)
+        start_time = time.time()
+        store_path = posterior_samples_store_path(model_name)
+        obs_stratification_label_unique_values = model.adata.obs[stratification_label].unique()
+        posterior_samples = {group_label: load_posterior_samples(store_path, group_label)
+                             for group_label in obs_stratification_label_unique_values}
+        de_global = []
+        for group1_label in tqdm(obs_stratification_label_unique_values):
+            # the rest of the cells are all the other cell types, weighted by their number of cells
+            rest = [posterior_samples[group2_label] for group2_label in obs_stratification_label_unique_values
+                    if group2_label != group1_label]
+            de_df = pd.DataFrame(compute_de_stats([posterior_samples[group1_label]], rest,
+                                                  n_samples=n_samples, delta=delta,
+                                                  rng=de_comparison_seed(group1_label, 'Rest')),
+                                 index=model.adata.var.index)
+            # same columns as the results of scvi model.differential_expression
+            de_df['comparison'] = group1_label + ' vs Rest'
+            de_df['group1'] = group1_label
+            de_df['group2'] = 'Rest'
+            de_global.append(de_df)
+        de_global = pd.concat(de_global)
         de_global.to_csv(de_global_filename)
+        stamp_stage(de_global_filename, stage_key(pipeline_keys, 'de_global'), start_time)
 
     return de_global
 
@@ -204,13 +358,16 @@ def make_de_global(model, stratification_label=stratification_label, model_name=
 def make_heatmap_anndata(de_global,
                          about=about_heatmap,
                          model_name=model_name,
-                         stratification_label=stratification_label):
+                         stratification_label=stratification_label,
+                         coexpression_n_neighbors=coexpression_n_neighbors,
+                         pipeline_keys=None):
     heatmap_anndata_filename = model_name + '+heatmap_anndata.h5ad'
-    if os.path.isfile(heatmap_anndata_filename):
+    if is_stage_up_to_date(heatmap_anndata_filename, stage_key(pipeline_keys, 'heatmap')):
         print('Skipping heatmatp creation, anndata already exists at file:  ', heatmap_anndata_filename)
         return None
     else:
         print('Creating heatmap anndata... ')
+        start_time = time.time()
         # pivot the DE result dataframe to create a dataframe for the heatmap
         # with gene ids in the index and cell type name in the columns and
         # scale1 in the entries, then take the log10 of scale1
@@ -231,185 +388,671 @@ def make_heatmap_anndata(de_global,
 
         # add some meatadata explaining what the data is
         heatmap_adata.uns['about'] = about_heatmap
+        if coexpression_n_neighbors:
+            print('Computing the co-expression neighbors of each gene... ')
+            add_coexpression_neighbors(heatmap_adata, n_neighbors=coexpression_n_neighbors)
         heatmap_adata.write_h5ad(heatmap_anndata_filename)
+        stamp_stage(heatmap_anndata_filename, stage_key(pipeline_keys, 'heatmap'), start_time)
         print('Heatmap anndata saved: ', heatmap_anndata_filename)
         return None
 
 
+def compute_histogram_bin_indices(values, nbins=100, histogram_range=(-10, 0)):
+    # vectorized equivalent of the binning done by np.histogram(values, bins=nbins, range=histogram_range)
+    # returns the bin index of each value, with the same bin edges and edge handling as np.histogram,
+    # and -1 for the values outside of the range, which includes the -inf from log10(0) and NaNs
+    first_edge, last_edge = histogram_range
+    bin_type = np.result_type(first_edge, last_edge, values)
+    if np.issubdtype(bin_type, np.integer):
+        bin_type = np.result_type(bin_type, float)
+    bin_edges = np.linspace(first_edge, last_edge, nbins + 1, endpoint=True, dtype=bin_type)
+    values = np.asarray(values, dtype=bin_type)
+    keep = (values >= first_edge) & (values <= last_edge)
+    kept_values = values[keep]
+    # same computation as np.histogram, then corrects the floating point errors around the bin edges
+    indices = ((kept_values - first_edge) * (nbins / (last_edge - first_edge))).astype(np.intp)
+    indices[indices == nbins] -= 1
+    decrement = kept_values < bin_edges[indices]
+    indices[decrement] -= 1
+    increment = (kept_values >= bin_edges[indices + 1]) & (indices != nbins - 1)
+    indices[increment] += 1
+    bin_indices = np.full(values.shape, -1, dtype=np.intp)
+    bin_indices[keep] = indices
+    return bin_indices
+
+
+def count_histogram_bins(values, group_codes, n_groups, nbins=100, histogram_range=(-10, 0), counts=None,
+                         gene_block_size=256):
+    # values has shape (cells x genes), group_codes contains the group of each cell (-1 for no group)
+    # adds the counts in each bin of each gene for each group to counts, of shape (genes x groups x bins), allocated
+    # as int32 when not given, and returns it
+    # the counts of each block of genes are computed with one bincount over the (gene, group, bin) of its values
+    # instead of one np.histogram per group, so the temporary arrays are the size of a block of genes
+    n_genes = values.shape[1]
+    if counts is None:
+        counts = np.zeros((n_genes, n_groups, nbins), dtype='int32')
+    group_codes = np.asarray(group_codes, dtype=np.intp)[:, np.newaxis]
+    for gene_start in range(0, n_genes, gene_block_size):
+        block_values = values[:, gene_start:gene_start + gene_block_size]
+        n_block_genes = block_values.shape[1]
+        bin_indices = compute_histogram_bin_indices(block_values, nbins=nbins, histogram_range=histogram_range)
+        valid = (bin_indices >= 0) & (group_codes >= 0)
+        flat_indices = (np.arange(n_block_genes, dtype=np.intp)[np.newaxis, :] * n_groups + group_codes) * nbins + \
+            bin_indices
+        block_counts = np.bincount(flat_indices[valid], minlength=n_block_genes * n_groups * nbins)
+        counts[gene_start:gene_start + n_block_genes] += block_counts.reshape(n_block_genes, n_groups, nbins)
+    return counts
+
+
 def make_histogram_anndata(model,
                            stratification_label=stratification_label,
-                           about_histograms=about_histograms):
-    histogram_anndata_filename = model_name + '+histogram_anndata.h5ad'
-    if os.path.isfile(histogram_anndata_filename):
-        print('Skipping histogram creation, anndata already exists at file: ', histogram_anndata_filename)
+                           about_histograms=about_histograms,
+                           cell_batch_size=histogram_cell_batch_size,
+                           gene_batch_size=histogram_gene_batch_size,
+                           pipeline_keys=None):
+    histogram_filename = model_name + '+histogram.h5'
+    if is_stage_up_to_date(histogram_filename, stage_key(pipeline_keys, 'histogram')):
+        print('Skipping histogram creation, file already exists: ', histogram_filename)
         return None
     else:
+        start_time = time.time()
         adata = model.adata
-        bins_intervals = np.histogram([0], bins=100, range=(-10, 0), density=False)[1][:-1]
-        ### get the scvi normalized expression then log10 that
-        adata.layers['normalized'] = model.get_normalized_expression()
-        adata.layers['log10normalized'] = np.log10(adata.layers['normalized'])
-
-        ###loops through each cell type and then each gene to compute the histogram of expression
-
-        # first get dimensions to initialize adata object
-        obs_stratification_label_unique_values = adata.obs[stratification_label].unique()
-
         # gets the bin intervals from the np histogram function
         nbins = 100
         histogram_range = (-10, 0)
-        bin_intervals = np.histogram([0], bins=nbins, range=histogram_range, density=False)[1][:-1]
-        # converts list of bins to string for anndata var index
+        bins_intervals = np.histogram([0], bins=nbins, range=histogram_range, density=False)[1][:-1]
+
+        # first get dimensions to initialize the histogram tensor
+        obs_stratification_label_unique_values = adata.obs[stratification_label].unique()
+        n_groups = len(obs_stratification_label_unique_values)
+        # integer code of the cell type of each cell, in the order of the tensor
+        group_codes = pd.Categorical(adata.obs[stratification_label],
+                                     categories=obs_stratification_label_unique_values).codes
+
+        # converts list of bins to string for the bins index
         bin_intervals = np.round(list(bins_intervals), 1).astype(str)
-        gene_histogram_adata = anndata.AnnData(X=np.zeros((len(obs_stratification_label_unique_values),
-                                                           len(bins_intervals))),
-                                               var=pd.DataFrame(index=bin_intervals),
-                                               obs=pd.DataFrame(index=obs_stratification_label_unique_values),
-                                               )
-        # rename obs and var to make clear what they hold
-        gene_histogram_adata.var.index.rename('histogram_bins', inplace=True)
-        gene_histogram_adata.obs.index.rename(stratification_label, inplace=True)
-
-        # now that adata is ready loop through every gene
-        # and for each gene computes the counts in each bin for each cell type
-        for gene_id in tqdm(adata.var.index):
-            log10_normalized_expression_in_gene = adata[:, adata.var.index == gene_id].layers['log10normalized']
-            log10_normalized_expression_in_gene = np.squeeze(np.asarray(log10_normalized_expression_in_gene))
-            # gets the bin intervals from the np histogram function
-            gene_histogram_df = pd.DataFrame(columns=bins_intervals)
-            for label in obs_stratification_label_unique_values:
-                # fetch only the expression of that gene in that cell
-                log10_normalized_expression_in_celltype = log10_normalized_expression_in_gene[
-                    adata.obs[stratification_label] == label]
-                gene_histogram_df.loc[label] = \
-                    np.histogram(log10_normalized_expression_in_celltype, bins=100, range=(-10, 0), density=False)[0]
-                gene_histogram_df.loc[label] = \
-                    np.histogram(log10_normalized_expression_in_celltype, bins=100, range=(-10, 0), density=False)[0]
-            # convert to sparse matrix to reduce final file size
-            gene_histogram_adata.layers[gene_id]=sparse.csr_matrix(gene_histogram_df.values.astype('int16'))
+        histogram_file, histogram_counts = create_histogram_tensor(histogram_filename,
+                                                                   genes=adata.var.index,
+                                                                   cells=obs_stratification_label_unique_values,
+                                                                   bins=bin_intervals,
+                                                                   about=about_histograms)
 
-        # add some meatadata explaining what the data is
-        gene_histogram_adata.uns['about'] = about_histograms
-        gene_histogram_adata.write_h5ad(histogram_anndata_filename)
+        # the scvi normalized expression is never materialized for the whole dataset: it is computed for a batch of
+        # cells (and optionally of genes) at a time, log10 transformed in place and added to the int32 running counts
+        # of each cell type, so peak memory depends on the batch sizes and not on the number of cells. The running
+        # counts hold the genes of a batch for all the cell types, so the default batch of genes keeps them within
+        # histogram_counts_max_bytes
+        gene_batch_size = gene_batch_size or max(1, histogram_counts_max_bytes // (n_groups * nbins * 4))
+        gene_batch_size = min(gene_batch_size, adata.n_vars)
+        with histogram_file:
+            for gene_start in range(0, adata.n_vars, gene_batch_size):
+                gene_end = min(gene_start + gene_batch_size, adata.n_vars)
+                gene_list = list(adata.var.index[gene_start:gene_end]) if gene_batch_size < adata.n_vars else None
+                running_counts = np.zeros((gene_end - gene_start, n_groups, nbins), dtype='int32')
+                for cell_start in tqdm(range(0, adata.n_obs, cell_batch_size)):
+                    cell_indices = np.arange(cell_start, min(cell_start + cell_batch_size, adata.n_obs))
+                    normalized_expression = model.get_normalized_expression(indices=cell_indices,
+                                                                            gene_list=gene_list,
+                                                                            return_numpy=True)
+                    log10_normalized_expression = np.log10(normalized_expression, out=normalized_expression)
+                    count_histogram_bins(log10_normalized_expression, group_codes[cell_indices], n_groups=n_groups,
+                                         nbins=nbins, histogram_range=histogram_range, counts=running_counts)
+                # the tensor stores int16 counts, saturate instead of overflowing for very large cell types
+                histogram_counts[gene_start:gene_end] = np.minimum(running_counts, np.iinfo('int16').max)
+        stamp_stage(histogram_filename, stage_key(pipeline_keys, 'histogram'), start_time)
+        print('Histogram saved: ', histogram_filename)
+
+
+def pairwise_de_one_group_filename(group1_label, model_name=model_name):
+    # results of all the pairwise comparisons of group1, stored as a numpy .npz file with
+    # stats = float32 array of shape (statistics x group2 cell types x genes)
+    # stat_names, group2, genes = names of each dimension of stats
+    return './pairwise_de/' + model_name + '+pairwise_de_one_group+' + group1_label + '+.npz'
+
+
+def legacy_pairwise_de_one_group_filename(group1_label, model_name=model_name):
+    # csv file with the results of all the pairwise comparisons of group1, as written by older versions of
+    # pairwise_de_only.py
+    return './pairwise_de/' + model_name + '+pairwise_de_one_group+' + group1_label + '+.csv'
+
+
+def pairwise_de_pair_filename(group1_label, group2_label, model_name=model_name):
+    # checkpoint of a single pairwise comparison, a float32 array of shape (statistics x genes),
+    # they are merged in the .npz file of each group once all its pairs are done
+    return './pairwise_de/pairs/' + model_name + '+pairwise_de_pair+' + group1_label + '+' + group2_label + '+.npy'
+
+
+def unordered_pairs(group_labels):
+    # each pair of different cell types once, the reverse comparisons are obtained by mirroring these ones
+    group_labels = sorted(group_labels)
+    return [(group1_label, group2_label) for pos, group1_label in enumerate(group_labels)
+            for group2_label in group_labels[pos + 1:]]
+
+
+def compute_pairwise_de_pair(group1_label,
+                             group2_label,
+                             model_name=model_name,
+                             n_samples=de_n_samples,
+                             delta=de_delta,
+                             stamp_key=None):
+    # does the DE of group1_label vs group2_label from the posterior samples and writes its checkpoint,
+    # unless the checkpoint already exists, returns the time it took
+    pair_filename = pairwise_de_pair_filename(group1_label, group2_label, model_name=model_name)
+    if is_stage_up_to_date(pair_filename, stamp_key):
+        return None
+    start_time = time.time()
+    store_path = posterior_samples_store_path(model_name)
+    group1_samples = load_posterior_samples(store_path, group1_label)
+    group2_samples = load_posterior_samples(store_path, group2_label)
+    de_stats = compute_de_stats([group1_samples], [group2_samples], n_samples=n_samples, delta=delta,
+                                rng=de_comparison_seed(group1_label, group2_label))
+    os.makedirs(os.path.dirname(pair_filename), exist_ok=True)
+    # writes to a temporary file first so an interrupted run never leaves a partial checkpoint behind
+    with open(pair_filename + '.tmp', 'wb') as pair_file:
+        np.save(pair_file, np.stack([de_stats[stat] for stat in DE_STATS]))
+    os.replace(pair_filename + '.tmp', pair_filename)
+    stamp_stage(pair_filename, stamp_key, start_time)
+    return time.time() - start_time
+
+
+def read_pairwise_de_pair(group1_label, group2_label, model_name=model_name):
+    # reads the DE of group1_label vs group2_label, of shape (statistics x genes),
+    # from whichever of the two orders was computed
+    if group1_label == group2_label:
+        # the comparison of a cell type with itself is not computed, by definition there is no change
+        _, scale_mean, _ = load_posterior_samples(posterior_samples_store_path(model_name), group1_label)
+        de_stats = np.zeros((len(DE_STATS), len(scale_mean)), dtype='float32')
+        de_stats[DE_STATS.index('proba_not_de')] = 1
+        de_stats[DE_STATS.index('bayes_factor')] = np.log(1e-8) - np.log(1 + 1e-8)
+        de_stats[DE_STATS.index('scale1')] = scale_mean
+        de_stats[DE_STATS.index('scale2')] = scale_mean
+        return de_stats
+    pair_filename = pairwise_de_pair_filename(group1_label, group2_label, model_name=model_name)
+    if os.path.isfile(pair_filename):
+        return np.load(pair_filename)
+    return mirror_de_stats(np.load(pairwise_de_pair_filename(group2_label, group1_label, model_name=model_name)))
+
+
+def mirror_de_stats(de_stats):
+    # the DE of group2 vs group1 from the one of group1 vs group2: the lfc distribution is negated
+    # and the scales are swapped, while the probabilities of being DE are the same
+    de_stats = de_stats.copy()
+    de_stats[[DE_STATS.index('scale1'), DE_STATS.index('scale2')]] = \
+        de_stats[[DE_STATS.index('scale2'), DE_STATS.index('scale1')]]
+    de_stats[[DE_STATS.index('lfc_mean'), DE_STATS.index('lfc_median')]] *= -1
+    return de_stats
+
+
+def merge_pairwise_de_one_group(group1_label,
+                                group2_labels,
+                                model_name=model_name,
+                                pipeline_keys=None,
+                                seconds_per_pair=None):
+    # merges the checkpoints of all pairs of group1_label in the .npz file read by make_swarmplot_anndata
+    # the key of each pair is also stored, so that a later run can reuse the pairs whose inputs did not change
+    genes = read_genes(posterior_samples_store_path(model_name))
+    pairwise_de_one_group = np.empty((len(DE_STATS), len(group2_labels), len(genes)), dtype='float32')
+    for group2_pos, group2_label in enumerate(group2_labels):
+        pairwise_de_one_group[:, group2_pos] = read_pairwise_de_pair(group1_label, group2_label, model_name=model_name)
+    npz_filename = pairwise_de_one_group_filename(group1_label, model_name=model_name)
+    with open(npz_filename + '.tmp', 'wb') as npz_file:
+        np.savez(npz_file, stats=pairwise_de_one_group, stat_names=np.array(DE_STATS),
+                 group2=np.array([str(label) for label in group2_labels]), genes=np.array(genes),
+                 pair_keys=np.array([str(pair_key(pipeline_keys, group1_label, group2_label))
+                                     for group2_label in group2_labels]))
+    os.replace(npz_filename + '.tmp', npz_filename)
+    if pipeline_keys is not None:
+        write_stamp(npz_filename, stage_key(pipeline_keys, 'pairwise_de', group1_label),
+                    seconds_per_pair=seconds_per_pair)
+    return pairwise_de_one_group
+
+
+def pair_key(pipeline_keys, group1_label, group2_label):
+    # the key of a pair is the same in both orders, the comparison of a cell type with itself has no key
+    if pipeline_keys is None or group1_label == group2_label:
+        return None
+    return pipeline_keys['pairs'][tuple(sorted((group1_label, group2_label)))]
+
+
+def find_reusable_pairwise_de_pairs(pairs, pipeline_keys, model_name=model_name):
+    # finds the pairs computed from the same inputs by a previous run, in the .npz file of either of the cell types
+    # returns a dict of pair: (cell type of the .npz file, position of the other cell type in that file)
+    pairs_of_label = {}
+    for pair in pairs:
+        for label in pair:
+            pairs_of_label.setdefault(label, []).append(pair)
+    reusable_pairs = {}
+    for label in sorted(pairs_of_label):
+        npz_filename = pairwise_de_one_group_filename(label, model_name=model_name)
+        if not os.path.isfile(npz_filename):
+            continue
+        with np.load(npz_filename) as pairwise_de_one_group:
+            if 'pair_keys' not in pairwise_de_one_group.files:
+                continue
+            previous_pair_keys = {group2_label: (group2_pos, previous_pair_key)
+                                  for group2_pos, (group2_label, previous_pair_key)
+                                  in enumerate(zip(pairwise_de_one_group['group2'],
+                                                   pairwise_de_one_group['pair_keys']))}
+        for pair in pairs_of_label[label]:
+            other_label = pair[1] if pair[0] == label else pair[0]
+            group2_pos, previous_pair_key = previous_pair_keys.get(str(other_label), (None, None))
+            if pair not in reusable_pairs and previous_pair_key == pair_key(pipeline_keys, *pair):
+                reusable_pairs[pair] = (label, group2_pos)
+    return reusable_pairs
+
+
+def restore_pairwise_de_pairs(pairs, pipeline_keys, model_name=model_name):
+    # writes back the checkpoints of the pairs whose inputs did not change since a previous run,
+    # so that only the pairs affected by the changes are computed again, returns the pairs still to compute
+    pending_pairs = [(group1_label, group2_label) for group1_label, group2_label in pairs
+                     if not is_stage_up_to_date(pairwise_de_pair_filename(group1_label, group2_label, model_name),
+                                                pair_key(pipeline_keys, group1_label, group2_label))]
+    if pipeline_keys is None:
+        return pending_pairs
+    reusable_pairs = find_reusable_pairwise_de_pairs(pending_pairs, pipeline_keys, model_name=model_name)
+    # reads the stats of each .npz file only once
+    for label in sorted({label for label, _ in reusable_pairs.values()}):
+        with np.load(pairwise_de_one_group_filename(label, model_name=model_name)) as pairwise_de_one_group:
+            previous_stats = pairwise_de_one_group['stats']
+        for (group1_label, group2_label), (source_label, group2_pos) in reusable_pairs.items():
+            if source_label != label:
+                continue
+            de_stats = previous_stats[:, group2_pos]
+            if group1_label != label:
+                de_stats = mirror_de_stats(de_stats)
+            pair_filename = pairwise_de_pair_filename(group1_label, group2_label, model_name=model_name)
+            os.makedirs(os.path.dirname(pair_filename), exist_ok=True)
+            with open(pair_filename + '.tmp', 'wb') as pair_file:
+                np.save(pair_file, de_stats)
+            os.replace(pair_filename + '.tmp', pair_filename)
+            write_stamp(pair_filename, pair_key(pipeline_keys, group1_label, group2_label))
+    return [pair for pair in pending_pairs if pair not in reusable_pairs]
+
+
+def read_pairwise_de_lfc_median(group1_label, model_name=model_name):
+    # median lfc of group1_label vs each other cell type, as a dataframe with gene ids in the index
+    # and the group2 cell types in the columns, also reads the csv files written by older versions of
+    # pairwise_de_only.py
+    npz_filename = pairwise_de_one_group_filename(group1_label, model_name=model_name)
+    if os.path.isfile(npz_filename):
+        with np.load(npz_filename) as pairwise_de_one_group:
+            stat_pos = list(pairwise_de_one_group['stat_names']).index('lfc_median')
+            return pd.DataFrame(pairwise_de_one_group['stats'][stat_pos].T,
+                                index=pairwise_de_one_group['genes'], columns=pairwise_de_one_group['group2'])
+    pairwise_de = pd.read_csv(legacy_pairwise_de_one_group_filename(group1_label, model_name=model_name),
+                              index_col=0)
+    return pairwise_de[pairwise_de['group1'] == group1_label].pivot(values='lfc_median', columns='group2')
+
+
+def validate_pairwise_de_mirroring(group_labels,
+                                   model_name=model_name,
+                                   n_pairs=pairwise_de_validation_pairs,
+                                   n_samples=de_n_samples,
+                                   delta=de_delta,
+                                   tolerance=0.1):
+    # computes the reverse comparison of a random sample of pairs explicitly and compares it to the mirrored values,
+    # the differences should only come from the sampling noise of the posterior samples
+    pairs = [pair for pair in unordered_pairs(group_labels)
+             if os.path.isfile(pairwise_de_pair_filename(*pair, model_name=model_name))]
+    if not pairs:
+        print('Skipping validation of the mirrored pairwise DE, no pair checkpoints found')
+        return None
+    rng = np.random.default_rng(0)
+    store_path = posterior_samples_store_path(model_name)
+    max_differences = {'proba_de': 0.0, 'lfc_mean': 0.0, 'lfc_median': 0.0}
+    for pair_pos in rng.choice(len(pairs), min(n_pairs, len(pairs)), replace=False):
+        group1_label, group2_label = pairs[pair_pos]
+        mirrored_stats = read_pairwise_de_pair(group2_label, group1_label, model_name=model_name)
+        reverse_stats = compute_de_stats([load_posterior_samples(store_path, group2_label)],
+                                         [load_posterior_samples(store_path, group1_label)],
+                                         n_samples=n_samples, delta=delta,
+                                         rng=de_comparison_seed(group2_label, group1_label))
+        for stat in max_differences:
+            max_differences[stat] = max(max_differences[stat],
+                                        float(np.nanmax(np.abs(mirrored_stats[DE_STATS.index(stat)] -
+                                                               reverse_stats[stat]))))
+    print('Max difference between the mirrored and the explicit reverse pairwise DE:', max_differences)
+    if max(max_differences.values()) > tolerance:
+        print('WARNING: the mirrored pairwise DE differs from the explicit reverse comparisons by more than',
+              tolerance)
+    return max_differences
+
+
+def remove_pairwise_de_pairs(group_labels, model_name=model_name):
+    # the pair checkpoints are no longer needed once the file of every group has been written
+    for group1_label, group2_label in unordered_pairs(group_labels):
+        pair_filename = pairwise_de_pair_filename(group1_label, group2_label, model_name=model_name)
+        if os.path.isfile(pair_filename):
+            os.remove(pair_filename)
+        remove_stamp(pair_filename)
 
 
 def compute_pairwise_de_one_group(group1_label,
                                   model,
                                   stratification_label=stratification_label,
-                                  model_name=model_name
+                                  model_name=model_name,
+                                  pipeline_keys=None
                                   ):
     adata = model.adata
-    csv_filename = model_name + '+pairwise_de_one_group+' + group1_label + '+.csv'
-    
-    
-    if os.path.isfile('./pairwise_de/'+csv_filename):
-        print('Skipping pairwise DE, csv file already exists: ', csv_filename)
+    npz_filename = pairwise_de_one_group_filename(group1_label, model_name=model_name)
+
+    if is_stage_up_to_date(npz_filename, stage_key(pipeline_keys, 'pairwise_de', group1_label)):
+        print('Skipping pairwise DE, file already exists: ', npz_filename)
         return None
     else:
         print('Doing pairwise DE for ', stratification_label, group1_label)
+        make_posterior_samples(model, stratification_label=stratification_label, model_name=model_name,
+                               pipeline_keys=pipeline_keys)
         # for a given group1_label (eg `Intestine`) do pairwise DE vs all other labels in that category (eg all other cell types)
+        # only computing the pairs that were not already computed in either order
         obs_stratification_label_unique_values = adata.obs[stratification_label].unique()
-        pairwise_de_one_group = pd.DataFrame()
-        for group2_label in tqdm(obs_stratification_label_unique_values):
-            de_df = model.differential_expression(
-                groupby=stratification_label,
-                group1=group1_label,
-                group2=group2_label,
-                silent=True,
-                n_samples=5000,
-                all_stats=False
-            )
-            de_df['group1'] = group1_label
-            de_df['group2'] = group2_label
-            pairwise_de_one_group = pairwise_de_one_group.append(de_df)
-        # write to disk just in case
-        if not os.path.exists('pairwise_de'):
-            os.makedirs('pairwise_de')
-        pairwise_de_one_group.to_csv('./pairwise_de/'+csv_filename)
-        
-        return pairwise_de_one_group
+        pairs = [pair for pair in unordered_pairs(obs_stratification_label_unique_values) if group1_label in pair]
+        pair_times = []
+        for group1, group2 in tqdm(restore_pairwise_de_pairs(pairs, pipeline_keys, model_name=model_name)):
+            pair_times.append(compute_pairwise_de_pair(group1, group2, model_name=model_name,
+                                                       stamp_key=pair_key(pipeline_keys, group1, group2)))
+        pair_times = [pair_time for pair_time in pair_times if pair_time is not None]
+        return merge_pairwise_de_one_group(group1_label, obs_stratification_label_unique_values,
+                                           model_name=model_name, pipeline_keys=pipeline_keys,
+                                           seconds_per_pair=np.mean(pair_times) if pair_times else None)
+
+
+def run_pairwise_de_pair_task(task):
+    group1_label, group2_label, stamp_key = task
+    pair_time = compute_pairwise_de_pair(group1_label, group2_label, model_name=_worker_model_name,
+                                         stamp_key=stamp_key)
+    return (group1_label, group2_label), pair_time
+
+
+# model name of each pairwise DE worker process, set once by init_pairwise_de_worker
+_worker_model_name = None
+
+
+def init_pairwise_de_worker(model_name):
+    global _worker_model_name
+    _worker_model_name = model_name
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def compute_pairwise_de_parallel(model,
+                                 stratification_label=stratification_label,
+                                 model_name=model_name,
+                                 n_workers=pairwise_de_n_workers,
+                                 n_validation_pairs=pairwise_de_validation_pairs,
+                                 pipeline_keys=None):
+    # runs all the pairwise comparisons across a pool of local processes, one unordered pair of cell types per task
+    # each finished pair is checkpointed, so an interrupted run resumes from the pairs that were not done yet
+    # the workers only read the posterior samples, so they neither load the model nor use the GPU
+    obs_stratification_label_unique_values = list(model.adata.obs[stratification_label].unique())
+    pending_group_labels = [group_label for group_label in obs_stratification_label_unique_values
+                            if not is_stage_up_to_date(pairwise_de_one_group_filename(group_label, model_name),
+                                                       stage_key(pipeline_keys, 'pairwise_de', group_label))]
+    pending_pairs = restore_pairwise_de_pairs(
+        [(group1_label, group2_label)
+         for group1_label, group2_label in unordered_pairs(obs_stratification_label_unique_values)
+         if group1_label in pending_group_labels or group2_label in pending_group_labels],
+        pipeline_keys, model_name=model_name)
+    # the pairs that each pending group is still waiting for before its file can be written
+    remaining_pairs = {group_label: {pair for pair in pending_pairs if group_label in pair}
+                       for group_label in pending_group_labels}
+    # cell types whose pairs were all done in a previous run but were not merged yet
+    for group_label in pending_group_labels:
+        if not remaining_pairs[group_label]:
+            merge_pairwise_de_one_group(group_label, obs_stratification_label_unique_values, model_name=model_name,
+                                        pipeline_keys=pipeline_keys)
+    if pending_pairs:
+        make_posterior_samples(model, stratification_label=stratification_label, model_name=model_name,
+                               pipeline_keys=pipeline_keys)
+        n_workers = n_workers or os.cpu_count()
+        print('Doing pairwise DE for {} pairs of {} with {} processes'.format(
+            len(pending_pairs), stratification_label, n_workers))
+        start_time = time.time()
+        pair_times = []
+        tasks = [(group1_label, group2_label, pair_key(pipeline_keys, group1_label, group2_label))
+                 for group1_label, group2_label in pending_pairs]
+        with multiprocessing.Pool(n_workers, initializer=init_pairwise_de_worker, initargs=(model_name,)) as pool:
+            for n_done, (pair, pair_time) in enumerate(pool.imap_unordered(run_pairwise_de_pair_task, tasks), 1):
+                if pair_time is not None:
+                    pair_times.append(pair_time)
+                for group_label in pair:
+                    if group_label in remaining_pairs:
+                        remaining_pairs[group_label].discard(pair)
+                        if not remaining_pairs[group_label]:
+                            merge_pairwise_de_one_group(group_label, obs_stratification_label_unique_values,
+                                                        model_name=model_name, pipeline_keys=pipeline_keys,
+                                                        seconds_per_pair=np.mean(pair_times))
+                            print('Pairwise DE saved: ', pairwise_de_one_group_filename(group_label, model_name))
+                elapsed = time.time() - start_time
+                print('Pairwise DE {}/{} pairs done, elapsed {}, ETA {}'.format(
+                    n_done, len(pending_pairs), format_duration(elapsed),
+                    format_duration(elapsed / n_done * (len(pending_pairs) - n_done))))
+    else:
+        print('Skipping pairwise DE, all files already exist')
+    if n_validation_pairs:
+        validate_pairwise_de_mirroring(obs_stratification_label_unique_values, model_name=model_name,
+                                       n_pairs=n_validation_pairs)
+    remove_pairwise_de_pairs(obs_stratification_label_unique_values, model_name=model_name)
 
 
 def make_swarmplot_anndata(model,
+                           de_global,
                            stratification_label=stratification_label,
-                           about_swarmplots=about_swarmplots):
+                           about_swarmplots=about_swarmplots,
+                           model_name=model_name,
+                           pipeline_keys=None):
     adata = model.adata
     obs_stratification_label_unique_values = adata.obs[stratification_label].unique()
 
     # check that all files exist
     for group1_label in obs_stratification_label_unique_values:
-        csv_filename = model_name + '+pairwise_de_one_group+' + group1_label + '+.csv'
-        if not os.path.isfile('./pairwise_de/'+csv_filename):
-            print('Aborting -- Missing pairwise DE csv file: ', csv_filename)
+        if not os.path.isfile(pairwise_de_one_group_filename(group1_label, model_name=model_name)) and \
+                not os.path.isfile(legacy_pairwise_de_one_group_filename(group1_label, model_name=model_name)):
+            print('Aborting -- Missing pairwise DE file: ',
+                  pairwise_de_one_group_filename(group1_label, model_name=model_name))
             return None
-    # initialize one pairwise_de dataframe
-    pairwise_de = pd.read_csv('./pairwise_de/'+csv_filename, index_col=0)
-    # make one swarm df to get the shape and order of the cell types/genes to initialize adata
-    mock_swarmdf = pairwise_de.pivot(values='lfc_median', columns='group2').round(2)
-
-    # initialize adata and fills the X with zeroes, the lfc_median for each cell type go in the layers
-
-    swarmplot_anndata_filename = model_name + '+swarmplot_anndata.h5ad'
-    swarmplot_adata = anndata.AnnData(X=np.zeros((len(mock_swarmdf.columns), len(mock_swarmdf.index))),
-                                      obs=pd.DataFrame(index=mock_swarmdf.columns),
-                                      var=pd.DataFrame(index=mock_swarmdf.index),
-                                      )
-    # loop through the celltypes and stores the lfc values for each cell in a layer
-    for group1_label in tqdm(mock_swarmdf.columns):
-        csv_filename = model_name + '+pairwise_de_one_group+' + group1_label + '+.csv'
-        pairwise_de = pd.read_csv('./pairwise_de/'+csv_filename, index_col=0)
-        swarmdf = pairwise_de[pairwise_de['group1'] == group1_label].pivot(values='lfc_median', columns='group2').round(
-            2)
-        swarmplot_adata.layers[group1_label] = swarmdf.values.T
-        ## convert data type float16 to reduce final anndata file size
-        swarmplot_adata.layers[group1_label] = swarmplot_adata.layers[group1_label].astype('float16')
-
-        # now performs one vs all DE and stores those results in adata.uns for access so that the genes can be sorted according to them
-        global_de = model.differential_expression(
-            groupby=stratification_label,
-            group1=group1_label,
-            all_stats=False,
-            n_samples=5000,
-            silent=True
-        )
-        # only keep needed columns as type float16 to reduce final anndata file size
-        global_de = global_de[['proba_not_de', 'scale1', 'scale2', 'lfc_mean', 'lfc_median']].astype('float16')
-        swarmplot_adata.uns[group1_label] = global_de
-        # also store the heatmap on the uns field for showing the mean expressison on tissue
-        # during mouseover
+    # the cell types and genes are sorted, in the same order as the results of pivoting the DE dataframes
+    cells = sorted(obs_stratification_label_unique_values)
+    genes = sorted(read_pairwise_de_lfc_median(cells[0], model_name=model_name).index)
+
+    swarmplot_filename = model_name + '+swarmplot.h5'
+    # without stamps the swarm plot is always rebuilt, as it is fast compared to the pairwise DE
+    if pipeline_keys is not None and is_stage_up_to_date(swarmplot_filename, stage_key(pipeline_keys, 'swarmplot')):
+        print('Skipping swarm plot creation, file already exists: ', swarmplot_filename)
+        return None
+    start_time = time.time()
+    with create_swarmplot_columnar(swarmplot_filename, genes=genes, cells=cells,
+                                   about=about_swarmplots) as swarmplot_file:
+        # streams the pairwise DE of each cell type in one slice of the preallocated pairwise tensor
+        for cell_pos, group1_label in enumerate(tqdm(cells)):
+            swarmdf = read_pairwise_de_lfc_median(group1_label, model_name=model_name).round(2)
+            ## convert data type float16 to reduce final file size
+            swarmplot_file['lfc_median_pairwise'][cell_pos] = \
+                swarmdf.reindex(index=genes, columns=cells).values.T.astype('float16')
+
+        # now stores the one vs all DE results so that the genes can be sorted according to them
+        # only keep needed columns as type float16 to reduce final file size
+        for stat in SWARMPLOT_STATS:
+            swarmplot_file[stat][...] = de_global.pivot(columns='group1', values=stat).reindex(
+                index=genes, columns=cells).values.T.astype('float16')
+        # also store the heatmap for showing the mean expressison on tissue during mouseover
         heatmap_df = pd.read_csv(model_name + '+heatmap_df.csv', index_col=0)
-        print(heatmap_df)
-        swarmplot_adata.uns['heatmap'] = heatmap_df
-    # rename obs and var to make clear what they hold
-    swarmplot_adata.var.index.rename('gene_id', inplace=True)
-    swarmplot_adata.obs.index.rename(stratification_label, inplace=True)
+        swarmplot_file['heatmap'][...] = heatmap_df.reindex(index=genes, columns=cells).values.T
+    stamp_stage(swarmplot_filename, stage_key(pipeline_keys, 'swarmplot'), start_time)
+    print('Swarm plot saved: ', swarmplot_filename)
 
-    swarmplot_adata.uns['about'] = about_swarmplots
 
-    swarmplot_adata.write_h5ad(swarmplot_anndata_filename)
+def hash_training_inputs(anndata_path=anndata_path, batch_key=batch_key, cell_batch_size=10000):
+    # hash of the parts of the input anndata used to train the model: the counts, the cell and gene names and the
+    # batches, so that changing the annotations (eg the stratification label) does not retrain the model
+    # this reads the whole counts matrix, so the hash is stored in the stamp of <anndata_path>+training_inputs and
+    # only computed again when the size or the modification time of the anndata file change
+    file_stat = os.stat(anndata_path)
+    file_key = hash_parameters(os.path.abspath(anndata_path), file_stat.st_size, file_stat.st_mtime_ns, batch_key)
+    cached = read_stamp(anndata_path + '+training_inputs')
+    if cached and cached.get('key') == file_key:
+        return cached['training_inputs_hash']
+    adata = anndata.read_h5ad(anndata_path, backed='r')
+    training_inputs_hash = hashlib.sha256()
+    for names in (adata.obs_names, adata.var_names, adata.obs[batch_key]):
+        training_inputs_hash.update(hash_parameters(list(map(str, names))).encode())
+    for cell_start in range(0, adata.n_obs, cell_batch_size):
+        counts = adata.X[cell_start:cell_start + cell_batch_size]
+        if sparse.issparse(counts):
+            counts = counts.tocsr()
+            for array in (counts.data, counts.indices, counts.indptr):
+                training_inputs_hash.update(np.ascontiguousarray(array).tobytes())
+        else:
+            training_inputs_hash.update(np.ascontiguousarray(counts).tobytes())
+    training_inputs_hash = training_inputs_hash.hexdigest()[:16]
+    try:
+        write_stamp(anndata_path + '+training_inputs', file_key, training_inputs_hash=training_inputs_hash)
+    except OSError:
+        # eg the folder of the input anndata is read only
+        pass
+    return training_inputs_hash
+
+
+def compute_pipeline_keys(anndata_path=anndata_path,
+                          stratification_label=stratification_label):
+    # hashes of the inputs and parameters of every artifact of the pipeline, following its DAG:
+    # train -> posterior samples of each cell type -> global DE -> heatmap
+    #       -> histogram
+    #       -> posterior samples of each cell type -> each pair of cell types -> pairwise DE of each cell type
+    # global DE, heatmap and pairwise DE -> swarm plot
+    # the key of an artifact includes the keys of the artifacts it depends on, so a change invalidates everything
+    # downstream of it and nothing else
+    print('Hashing the pipeline inputs...')
+    obs = anndata.read_h5ad(anndata_path, backed='r').obs
+    obs_stratification_labels = obs[stratification_label].astype(str)
+    group_labels = list(obs[stratification_label].unique())
+    keys = {'train': hash_parameters('train', hash_training_inputs(anndata_path), min_gene_counts, batch_key)}
+    keys['posterior_samples'] = {
+        group_label: hash_parameters('posterior_samples', keys['train'], stratification_label, str(group_label),
+                                     list(obs.index[(obs_stratification_labels == str(group_label)).values]),
+                                     de_n_samples)
+        for group_label in group_labels}
+    keys['de_global'] = hash_parameters('de_global', sorted(keys['posterior_samples'].items()), de_n_samples, de_delta)
+    # the parameter is only hashed when set, so that the heatmaps created without neighbors stay up to date
+    keys['heatmap'] = hash_parameters('heatmap', keys['de_global'],
+                                      *([coexpression_n_neighbors] if coexpression_n_neighbors else []))
+    keys['histogram'] = hash_parameters('histogram', keys['train'], stratification_label,
+                                        list(obs_stratification_labels))
+    keys['pairs'] = {(group1_label, group2_label): hash_parameters('pair',
+                                                                   keys['posterior_samples'][group1_label],
+                                                                   keys['posterior_samples'][group2_label],
+                                                                   de_n_samples, de_delta)
+                     for group1_label, group2_label in unordered_pairs(group_labels)}
+    keys['pairwise_de'] = {
+        group_label: hash_parameters('pairwise_de', sorted(map(str, group_labels)),
+                                     [key for pair, key in sorted(keys['pairs'].items()) if group_label in pair])
+        for group_label in group_labels}
+    keys['swarmplot'] = hash_parameters('swarmplot', keys['de_global'], keys['heatmap'],
+                                        sorted(keys['pairwise_de'].items()))
+    return keys
+
+
+def print_pipeline_plan(pipeline_keys, model_name=model_name):
+    # dry run: prints which artifacts would be rebuilt and why, with the cost estimated from the build times
+    # recorded in the stamps of the previous runs
+    store_path = posterior_samples_store_path(model_name)
+    group_labels = list(pipeline_keys['posterior_samples'])
+    stages = [('train', [(model_name, pipeline_keys['train'])]),
+              ('posterior samples', [(posterior_samples_path(store_path, group_label, 'log2_samples.npy'),
+                                      pipeline_keys['posterior_samples'][group_label])
+                                     for group_label in group_labels]),
+              ('global DE', [(model_name + '+de_global.csv', pipeline_keys['de_global'])]),
+              ('heatmap', [(model_name + '+heatmap_anndata.h5ad', pipeline_keys['heatmap'])]),
+              ('histogram', [(model_name + '+histogram.h5', pipeline_keys['histogram'])]),
+              ('pairwise DE', [(pairwise_de_one_group_filename(group_label, model_name),
+                                pipeline_keys['pairwise_de'][group_label]) for group_label in group_labels]),
+              ('swarm plot', [(model_name + '+swarmplot.h5', pipeline_keys['swarmplot'])])]
+    total_cost = 0
+    for stage_name, artifacts in stages:
+        stale_artifacts = []
+        for artifact_path, key in artifacts:
+            up_to_date, reason = check_stamp(artifact_path, key, trust_unstamped=trust_unstamped_artifacts)
+            if not up_to_date:
+                stale_artifacts.append((artifact_path, reason))
+        if not stale_artifacts:
+            print('{:<18} up to date'.format(stage_name))
+            continue
+        stamps = [read_stamp(artifact_path) for artifact_path, _ in artifacts]
+        if stage_name == 'pairwise DE':
+            stale_paths = {artifact_path for artifact_path, _ in stale_artifacts}
+            stale_labels = [group_label for group_label in group_labels
+                            if pairwise_de_one_group_filename(group_label, model_name) in stale_paths]
+            pairs = [pair for pair in unordered_pairs(group_labels)
+                     if pair[0] in stale_labels or pair[1] in stale_labels]
+            reusable_pairs = find_reusable_pairwise_de_pairs(pairs, pipeline_keys, model_name=model_name)
+            n_pairs = len(pairs) - len(reusable_pairs)
+            times = [stamp['seconds_per_pair'] for stamp in stamps if stamp and stamp.get('seconds_per_pair')]
+            cost = n_pairs * np.mean(times) if times else None
+            details = '{} of {} cell types, {} pairs to compute'.format(len(stale_labels), len(group_labels), n_pairs)
+        else:
+            times = [stamp['elapsed'] for stamp in stamps if stamp and stamp.get('elapsed')]
+            cost = len(stale_artifacts) * np.mean(times) if times else None
+            if len(artifacts) == 1:
+                details = stale_artifacts[0][1]
+            else:
+                details = '{} of {} cell types'.format(len(stale_artifacts), len(artifacts))
+        total_cost += cost or 0
+        print('{:<18} rebuild ({}), estimated {}'.format(stage_name, details,
+                                                          format_duration(cost) if cost is not None else 'unknown'))
+    print('Estimated total (without the unknown costs):', format_duration(total_cost))
 
 
 if __name__ == '__main__':
+    pipeline_keys = compute_pipeline_keys(anndata_path=anndata_path, stratification_label=stratification_label)
+    if '--dry-run' in sys.argv:
+        print_pipeline_plan(pipeline_keys, model_name=model_name)
+        sys.exit()
     print('Starting the pipeline...')
-    model = load_or_train_scvi_model(model_name=model_name, anndata_path=anndata_path)
+    model = load_or_train_scvi_model(model_name=model_name, anndata_path=anndata_path, pipeline_keys=pipeline_keys)
 
-    de_global = make_de_global(stratification_label=stratification_label, model=model, model_name=model_name)
+    de_global = make_de_global(stratification_label=stratification_label, model=model, model_name=model_name,
+                               pipeline_keys=pipeline_keys)
     print('✔️ Done with global DE')
     make_heatmap_anndata(de_global=de_global, about=about_heatmap,
                          model_name=model_name,
-                         stratification_label=stratification_label)
+                         stratification_label=stratification_label,
+                         coexpression_n_neighbors=coexpression_n_neighbors,
+                         pipeline_keys=pipeline_keys)
     print('✔️✔️ Done with heatmap')
     make_histogram_anndata(stratification_label=stratification_label,
                            model=model,
-                           about_histograms=about_histograms)
+                           about_histograms=about_histograms,
+                           cell_batch_size=histogram_cell_batch_size,
+                           gene_batch_size=histogram_gene_batch_size,
+                           pipeline_keys=pipeline_keys)
     print('✔️✔️✔️ Done with histogram')
-    for group1_label in model.adata.obs[stratification_label].unique():
-        compute_pairwise_de_one_group(stratification_label=stratification_label,
-                                      model=model,
-                                      model_name=model_name,
-                                      group1_label=group1_label)
+    if pairwise_de_n_workers == 1:
+        for group1_label in model.adata.obs[stratification_label].unique():
+            compute_pairwise_de_one_group(stratification_label=stratification_label,
+                                          model=model,
+                                          model_name=model_name,
+                                          group1_label=group1_label,
+                                          pipeline_keys=pipeline_keys)
+        if pairwise_de_validation_pairs:
+            validate_pairwise_de_mirroring(model.adata.obs[stratification_label].unique(),
+                                           model_name=model_name,
+                                           n_pairs=pairwise_de_validation_pairs)
+        remove_pairwise_de_pairs(model.adata.obs[stratification_label].unique(), model_name=model_name)
+    else:
+        compute_pairwise_de_parallel(stratification_label=stratification_label,
+                                     model=model,
+                                     model_name=model_name,
+                                     n_workers=pairwise_de_n_workers,
+                                     n_validation_pairs=pairwise_de_validation_pairs,
+                                     pipeline_keys=pipeline_keys)
     print('✔️✔️✔️✔️ Done with pairwise DE')
     make_swarmplot_anndata(stratification_label=stratification_label,
                            model=model,
-                           about_swarmplots=about_swarmplots)
+                           de_global=de_global,
+                           about_swarmplots=about_swarmplots,
+                           pipeline_keys=pipeline_keys)
     print('✔️✔️✔️✔️✔️ Done with swarmplot')
@@ -28,11 +28,12 @@ import anndata
 import scvi
 import numpy as np
 from tqdm import tqdm
-import pandas as pd
 import os
 import scanpy
 import warnings
 
+from posterior_samples import DE_STATS
+
 
 warnings.filterwarnings("ignore")
 print('Using scvi-tools version:', scvi.__version__)
@@ -94,6 +95,14 @@ def load_or_train_scvi_model(model_name, anndata_path):
         train_test_results.to_csv(model_name + '+train_test_results.csv')
     return model
 
+
+def pairwise_de_one_group_filename(group1_label, model_name):
+    # same .npz file as the one written by data_preparation.py, where it is read by make_swarmplot_anndata
+    # stats = float32 array of shape (statistics x group2 cell types x genes)
+    # stat_names, group2, genes = names of each dimension of stats
+    return './pairwise_de/' + model_name + '+pairwise_de_one_group+' + group1_label + '+.npz'
+
+
 def compute_pairwise_de_one_group(group1_label,
                                   model,
                                   stratification_label,
@@ -101,9 +110,9 @@ def compute_pairwise_de_one_group(group1_label,
                                   ):
     adata = model.adata
     print('Doing pairwise DE for ', stratification_label, group1_label)
-    csv_filename = model_name + '+pairwise_de_one_group+' + group1_label + '+.csv'
-    if os.path.isfile(csv_filename):
-        print('Skipping pairwise DE, csv file already exists: ', csv_filename)
+    npz_filename = pairwise_de_one_group_filename(group1_label, model_name)
+    if os.path.isfile(npz_filename):
+        print('Skipping pairwise DE, file already exists: ', npz_filename)
         return None
     else:
         
@@ -111,8 +120,10 @@ def compute_pairwise_de_one_group(group1_label,
         obs_stratification_label_unique_values = adata.obs[stratification_label].unique()
         print('Starting pairwise DE for ', len(obs_stratification_label_unique_values), ' labels:')
         print(list(obs_stratification_label_unique_values))
-        pairwise_de_one_group = pd.DataFrame()
-        for group2_label in tqdm(obs_stratification_label_unique_values):
+        genes = list(adata.var_names)
+        pairwise_de_one_group = np.empty((len(DE_STATS), len(obs_stratification_label_unique_values), len(genes)),
+                                         dtype='float32')
+        for group2_pos, group2_label in enumerate(tqdm(obs_stratification_label_unique_values)):
             de_df = model.differential_expression(
                 groupby=stratification_label,
                 group1=group1_label,
@@ -121,13 +132,14 @@ def compute_pairwise_de_one_group(group1_label,
                 n_samples=5000,
                 all_stats=False
             )
-            de_df['group1'] = group1_label
-            de_df['group2'] = group2_label
-            pairwise_de_one_group = pairwise_de_one_group.append(de_df)
-        # write to disk
-        if not os.path.exists('pairwise_de'):
-            os.makedirs('pairwise_de')
-        pairwise_de_one_group.to_csv('./pairwise_de/'+csv_filename)
+            pairwise_de_one_group[:, group2_pos] = de_df[DE_STATS].reindex(genes).values.T
+        # write to disk, through a temporary file so that an interrupted job doesn't leave a partial file
+        os.makedirs('pairwise_de', exist_ok=True)
+        with open(npz_filename + '.tmp', 'wb') as npz_file:
+            np.savez(npz_file, stats=pairwise_de_one_group, stat_names=np.array(DE_STATS),
+                     group2=np.array([str(label) for label in obs_stratification_label_unique_values]),
+                     genes=np.array(genes))
+        os.replace(npz_filename + '.tmp', npz_filename)
         return pairwise_de_one_group
 
 
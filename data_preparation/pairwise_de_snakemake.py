@@ -41,13 +41,13 @@ MODEL_NAME='cengen_scvi'
 STRATIFICATION_GROUP='cell_subtype'
 rule all:
     input:
-        expand('{model_name}+pairwise_de_one_group+{sample}+.csv', sample=SAMPLE_LIST, model_name=MODEL_NAME)        
+        expand('pairwise_de/{model_name}+pairwise_de_one_group+{sample}+.npz', sample=SAMPLE_LIST, model_name=MODEL_NAME)        
         
 rule run_pairwisede:   
     params: 
         SAMPLE_NAME = '{sample}',
     output:
-         OUT_FILE='{MODEL_NAME}+pairwise_de_one_group+{sample}+.csv',
+         OUT_FILE='pairwise_de/{MODEL_NAME}+pairwise_de_one_group+{sample}+.npz',
     threads: 1
          
     shell:
@@ -0,0 +1,69 @@
+### Stamps recording the inputs of each artifact created by data_preparation.py
+### https://github.com/WormBase/wormcells-viz
+### this module only depends on the standard library
+'''
+Each artifact of the pipeline (a file or a folder) gets a sidecar stamp file `<artifact>.stamp` with the hash of all
+the inputs and parameters used to create it, plus the time it took, eg for the heatmap:
+```
+cengen_scvi+heatmap_anndata.h5ad.stamp = {"key": "3f1c0b9a2e4d5f60", "elapsed": 12.3}
+```
+An artifact is up to date only if it exists and its stamp has the key of the current inputs, so changing a parameter
+or an input file rebuilds the artifacts that depend on it, and only those. The elapsed time of the previous build is
+used to estimate the cost of rebuilding an artifact.
+'''
+import hashlib
+import json
+import os
+
+
+def hash_parameters(*parameters):
+    # hash of any json serializable parameters, including the keys of other artifacts
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def hash_file(file_path, block_size=1 << 20):
+    # hash of the content of a file, so that touching or copying a file does not invalidate its artifacts
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()[:16]
+
+
+def stamp_path(artifact_path):
+    return artifact_path.rstrip('/') + '.stamp'
+
+
+def read_stamp(artifact_path):
+    try:
+        with open(stamp_path(artifact_path)) as stamp_file:
+            return json.load(stamp_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_stamp(artifact_path, key, elapsed=None, **details):
+    stamp = dict(details, key=key, elapsed=elapsed)
+    with open(stamp_path(artifact_path) + '.tmp', 'w') as stamp_file:
+        json.dump(stamp, stamp_file)
+    os.replace(stamp_path(artifact_path) + '.tmp', stamp_path(artifact_path))
+
+
+def remove_stamp(artifact_path):
+    if os.path.isfile(stamp_path(artifact_path)):
+        os.remove(stamp_path(artifact_path))
+
+
+def check_stamp(artifact_path, key, trust_unstamped=False):
+    '''
+    returns (up to date, reason) for the artifact built from inputs with the given key
+    artifacts created before stamps existed are only considered up to date with trust_unstamped
+    '''
+    if not os.path.exists(artifact_path):
+        return False, 'missing'
+    stamp = read_stamp(artifact_path)
+    if stamp is None:
+        return (True, 'not stamped, trusted') if trust_unstamped else (False, 'not stamped')
+    if stamp['key'] != key:
+        return False, 'inputs changed'
+    return True, 'up to date'
@@ -0,0 +1,124 @@
+### Posterior sample store and differential expression statistics computed from the stored samples
+### https://github.com/WormBase/wormcells-viz
+### this module only depends on numpy so that the DE statistics can be computed without loading the scvi model
+'''
+## Posterior sample store
+A directory with the posterior samples of the scvi normalized expression of each cell type, drawn once from the
+model and then reused by every DE comparison (global and pairwise) instead of running the decoder again each time.
+```
+genes.json = gene ids, in the order of the columns of all the samples arrays
+```
+For each cell type:
+```
+<label>+log2_samples.npy = float32 array of shape (samples x genes) with the log2 of the sampled normalized expression,
+    read as a memory map
+<label>+scale_mean.npy = float64 array of shape (genes) with the mean normalized expression of the samples
+<label>+n_cells.txt = number of cells of the cell type, written last, so it also marks the samples as complete
+```
+
+## DE statistics
+The statistics are the ones of the scvi "change" mode used by `model.differential_expression`:
+random pairs of samples of group1 and group2 give a distribution of log2 fold changes, and for each gene
+```
+proba_de = fraction of the pairs with |lfc| >= delta
+proba_not_de = 1 - proba_de
+bayes_factor = log(proba_de) - log(proba_not_de)
+scale1, scale2 = mean normalized expression of group1 and group2
+lfc_mean, lfc_median = mean and median of the lfc distribution
+```
+When group2 is made of several cell types (eg one cell type vs all other cells) its samples are drawn from each cell
+type proportionally to its number of cells.
+'''
+import json
+import os
+
+import numpy as np
+
+DE_STATS = ['proba_de', 'proba_not_de', 'bayes_factor', 'scale1', 'scale2', 'lfc_mean', 'lfc_median']
+
+
+def posterior_samples_path(store_path, label, suffix):
+    return os.path.join(store_path, str(label) + '+' + suffix)
+
+
+def write_genes(store_path, genes):
+    os.makedirs(store_path, exist_ok=True)
+    with open(os.path.join(store_path, 'genes.json'), 'w') as genes_file:
+        json.dump([str(gene) for gene in genes], genes_file)
+
+
+def read_genes(store_path):
+    with open(os.path.join(store_path, 'genes.json')) as genes_file:
+        return json.load(genes_file)
+
+
+def has_posterior_samples(store_path, label):
+    return os.path.isfile(posterior_samples_path(store_path, label, 'n_cells.txt'))
+
+
+def create_posterior_samples(store_path, label, n_samples, n_genes):
+    '''
+    creates the empty samples array of a cell type and returns it as a writable memory map,
+    the caller fills it with log2 samples and then calls finish_posterior_samples
+    '''
+    os.makedirs(store_path, exist_ok=True)
+    return np.lib.format.open_memmap(posterior_samples_path(store_path, label, 'log2_samples.npy'), mode='w+',
+                                     dtype='float32', shape=(n_samples, n_genes))
+
+
+def finish_posterior_samples(store_path, label, log2_samples, scale_mean, n_cells):
+    log2_samples.flush()
+    np.save(posterior_samples_path(store_path, label, 'scale_mean.npy'), np.asarray(scale_mean, dtype='float64'))
+    with open(posterior_samples_path(store_path, label, 'n_cells.txt'), 'w') as n_cells_file:
+        n_cells_file.write(str(int(n_cells)))
+
+
+def load_posterior_samples(store_path, label):
+    # returns (log2 samples as a read only memory map, mean scale, number of cells) of one cell type
+    log2_samples = np.load(posterior_samples_path(store_path, label, 'log2_samples.npy'), mmap_mode='r')
+    scale_mean = np.load(posterior_samples_path(store_path, label, 'scale_mean.npy'))
+    with open(posterior_samples_path(store_path, label, 'n_cells.txt')) as n_cells_file:
+        n_cells = int(n_cells_file.read())
+    return log2_samples, scale_mean, n_cells
+
+
+def draw_rows(groups, n_samples, rng):
+    # draws n_samples random rows from the samples of the groups, each group weighted by its number of cells
+    # returns a list of (log2 samples, sorted row indices), sorted rows make the reads from the memory maps sequential
+    n_cells = np.array([group_n_cells for (_, _, group_n_cells) in groups], dtype='float64')
+    group_draws = rng.multinomial(n_samples, n_cells / n_cells.sum())
+    return [(log2_samples, np.sort(rng.integers(0, len(log2_samples), n_draws)))
+            for (log2_samples, _, _), n_draws in zip(groups, group_draws) if n_draws]
+
+
+def gather_rows(draws, gene_start, gene_end):
+    return np.concatenate([log2_samples[rows, gene_start:gene_end] for log2_samples, rows in draws])
+
+
+def compute_de_stats(groups1, groups2, n_samples=5000, delta=0.25, rng=None, gene_batch_size=1024):
+    '''
+    computes the DE statistics of group1 vs group2 from the stored posterior samples
+    groups1 and groups2 are lists of (log2 samples, scale mean, n cells) as returned by load_posterior_samples,
+    with one element for a single cell type, or several for a group made of several cell types
+    returns a dict with one float32 array of shape (genes) for each statistic in DE_STATS
+    '''
+    rng = np.random.default_rng(rng)
+    draws1 = draw_rows(groups1, n_samples, rng)
+    draws2 = draw_rows(groups2, n_samples, rng)
+    # the rows of each side are sorted, so the pairs are made random by permuting one of the sides
+    pairing = rng.permutation(n_samples)
+    n_genes = groups1[0][0].shape[1]
+    stats = {stat: np.empty(n_genes, dtype='float32') for stat in DE_STATS}
+    for gene_start in range(0, n_genes, gene_batch_size):
+        gene_end = min(gene_start + gene_batch_size, n_genes)
+        lfc = gather_rows(draws1, gene_start, gene_end)
+        lfc -= gather_rows(draws2, gene_start, gene_end)[pairing]
+        stats['lfc_mean'][gene_start:gene_end] = lfc.mean(axis=0)
+        stats['proba_de'][gene_start:gene_end] = (np.abs(lfc) >= delta).mean(axis=0)
+        stats['lfc_median'][gene_start:gene_end] = np.median(lfc, axis=0)
+    stats['proba_not_de'][...] = 1 - stats['proba_de']
+    stats['bayes_factor'][...] = np.log(stats['proba_de'] + 1e-8) - np.log(stats['proba_not_de'] + 1e-8)
+    for stat, groups in (('scale1', groups1), ('scale2', groups2)):
+        n_cells = np.array([group_n_cells for (_, _, group_n_cells) in groups], dtype='float64')
+        stats[stat][...] = np.average([scale_mean for (_, scale_mean, _) in groups], axis=0, weights=n_cells)
+    return stats
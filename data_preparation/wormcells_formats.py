@@ -0,0 +1,202 @@
+### Readers and writers for the wormcells-viz data files that are not stored as anndata
+### https://github.com/WormBase/wormcells-viz
+### this module only depends on numpy, h5py and anndata so that it can be used without scvi-tools
+'''
+## Histogram tensor
+A single HDF5 file with one contiguous int16 tensor of shape
+$ n_{genes} \times n_{celltypes} \times n_{bins} $
+chunked by gene, so that the histograms of one gene for all cell types are read with a single chunk read.
+```
+file.attrs['wormcells_format'] = 'histogram_tensor'
+file.attrs['about'] = information about the dataset
+file['counts'] = int16 tensor of shape (genes x cell types x bins) with the counts in each bin
+file['genes'] = gene ids, in the order of the first dimension of counts
+file['cells'] = cell types, in the order of the second dimension of counts
+file['bins'] = lower bound of each bin, as strings, in the order of the third dimension of counts
+```
+
+## Swarm plot columnar file
+A single HDF5 file with one (cell types x genes) array per statistic, sharing the same gene and cell type indexes,
+plus the pairwise lfc tensor of shape
+$ n_{celltypes} \times n_{celltypes} \times n_{genes} $
+```
+file.attrs['wormcells_format'] = 'swarmplot_columnar'
+file.attrs['about'] = information about the dataset
+file['genes'] = gene ids, in the order of the last dimension of all arrays
+file['cells'] = cell types, in the order of the other dimensions of all arrays
+file['proba_not_de'], file['scale1'], file['scale2'], file['lfc_mean'], file['lfc_median'] = float16 arrays of
+    shape (cell types x genes) with the DE results of each cell type vs all other cells
+file['lfc_median_pairwise'] = float16 tensor of shape (group1 cell types x group2 cell types x genes) with the
+    median log fold change of each pairwise DE comparison
+file['heatmap'] = float32 array of shape (cell types x genes) with the log10 of the scvi expression frequency
+```
+
+## Co-expression neighbors
+Optionally stored in the heatmap anndata, for each metric (correlation or cosine), the genes with the most similar
+heatmap values across the cell types to each gene, sorted by decreasing similarity. The backend uses them instead of
+computing the neighbors on request, for up to n_neighbors neighbors.
+```
+adata.varm['coexpression_neighbors_' + metric] = int32 array of shape (genes x n_neighbors) with the positions of the
+    neighbors in adata.var
+adata.varm['coexpression_similarities_' + metric] = float32 array of shape (genes x n_neighbors) with their similarity,
+    the distance being 1 - similarity
+```
+'''
+import h5py
+import numpy as np
+
+HISTOGRAM_TENSOR_FORMAT = 'histogram_tensor'
+SWARMPLOT_COLUMNAR_FORMAT = 'swarmplot_columnar'
+SWARMPLOT_STATS = ['proba_not_de', 'scale1', 'scale2', 'lfc_mean', 'lfc_median']
+COEXPRESSION_METRICS = ['correlation', 'cosine']
+COEXPRESSION_NEIGHBORS_KEY = 'coexpression_neighbors_{}'
+COEXPRESSION_SIMILARITIES_KEY = 'coexpression_similarities_{}'
+
+
+def write_names(h5_file, key, names):
+    h5_file.create_dataset(key, data=[str(name) for name in names], dtype=h5py.string_dtype())
+
+
+def read_names(h5_file, key):
+    return [name.decode() if isinstance(name, bytes) else name for name in h5_file[key][()]]
+
+
+def create_histogram_tensor(file_path, genes, cells, bins, about=''):
+    '''
+    creates an empty histogram tensor file and returns the open h5py file and the counts dataset,
+    so that the caller can fill the counts one gene (or one block of genes) at a time
+    '''
+    h5_file = h5py.File(file_path, 'w')
+    h5_file.attrs['wormcells_format'] = HISTOGRAM_TENSOR_FORMAT
+    h5_file.attrs['about'] = about
+    write_names(h5_file, 'genes', genes)
+    write_names(h5_file, 'cells', cells)
+    write_names(h5_file, 'bins', bins)
+    counts = h5_file.create_dataset('counts', shape=(len(genes), len(cells), len(bins)), dtype='int16',
+                                    chunks=(1, len(cells), len(bins)), compression='gzip', compression_opts=4,
+                                    shuffle=True)
+    return h5_file, counts
+
+
+def convert_histogram_anndata(anndata_path, file_path):
+    # converts the original histogram anndata, with one sparse layer per gene, to a histogram tensor
+    import anndata
+    from scipy import sparse
+    adata = anndata.read_h5ad(anndata_path)
+    genes = list(adata.layers.keys())
+    h5_file, counts = create_histogram_tensor(file_path, genes=genes, cells=adata.obs_names, bins=adata.var_names,
+                                              about=adata.uns.get('about', ''))
+    with h5_file:
+        for gene_pos, gene_id in enumerate(genes):
+            layer = adata.layers[gene_id]
+            counts[gene_pos] = layer.toarray() if sparse.issparse(layer) else np.asarray(layer)
+
+
+def create_swarmplot_columnar(file_path, genes, cells, about=''):
+    '''
+    creates an empty swarm plot columnar file and returns the open h5py file, the arrays can then be filled
+    one cell type at a time, for example h5_file['lfc_median_pairwise'][cell_pos] = lfc_vs_all_other_cells
+    '''
+    n_cells, n_genes = len(cells), len(genes)
+    h5_file = h5py.File(file_path, 'w')
+    h5_file.attrs['wormcells_format'] = SWARMPLOT_COLUMNAR_FORMAT
+    h5_file.attrs['about'] = about
+    write_names(h5_file, 'genes', genes)
+    write_names(h5_file, 'cells', cells)
+    for stat in SWARMPLOT_STATS:
+        h5_file.create_dataset(stat, shape=(n_cells, n_genes), dtype='float16', compression='gzip',
+                               compression_opts=4)
+    h5_file.create_dataset('lfc_median_pairwise', shape=(n_cells, n_cells, n_genes), dtype='float16',
+                           chunks=(1, n_cells, n_genes), compression='gzip', compression_opts=4)
+    h5_file.create_dataset('heatmap', shape=(n_cells, n_genes), dtype='float32', compression='gzip',
+                           compression_opts=4)
+    return h5_file
+
+
+def convert_swarmplot_anndata(anndata_path, file_path):
+    # converts the original swarm plot anndata, with the pairwise lfc in the layers and one DE dataframe per cell type
+    # in uns, to a swarm plot columnar file
+    import anndata
+    adata = anndata.read_h5ad(anndata_path)
+    genes, cells = list(adata.var_names), list(adata.obs_names)
+    with create_swarmplot_columnar(file_path, genes=genes, cells=cells,
+                                   about=adata.uns.get('about', '')) as h5_file:
+        for cell_pos, cell_name in enumerate(cells):
+            h5_file['lfc_median_pairwise'][cell_pos] = np.asarray(adata.layers[cell_name])
+            global_de = adata.uns[cell_name].reindex(genes)
+            for stat in SWARMPLOT_STATS:
+                h5_file[stat][cell_pos] = global_de[stat].values
+        h5_file['heatmap'][...] = adata.uns['heatmap'].reindex(index=genes, columns=cells).values.T
+
+
+def normalize_gene_profiles(heatmap, metric='correlation'):
+    '''
+    returns the expression profiles of the genes of a heatmap of shape (cell types x genes), as a float32 array of
+    shape (genes x cell types) with each profile centered (for the correlation) and scaled to unit norm, so that the
+    dot product of two profiles is their correlation or cosine similarity
+    '''
+    profiles = np.nan_to_num(np.array(np.asarray(heatmap).T, dtype=np.float32, order='C'), copy=False, posinf=0,
+                             neginf=0)
+    if metric == 'correlation':
+        profiles -= profiles.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+    np.divide(profiles, norms, out=profiles, where=norms > 0)
+    return profiles
+
+
+def find_nearest_profiles(profiles, query_locs, k, block_size=4096):
+    '''
+    returns the positions and the similarities of the k profiles most similar to each query profile, other than
+    itself, as two arrays of shape (queries x k) sorted by decreasing similarity
+    the similarities are computed by blocks of profiles, with one matrix product per block, and only the best k so far
+    are kept with argpartition, so that the memory used doesn't grow with the number of genes
+    this is used both by compute_coexpression_neighbors and by the backend, for the neighbors that weren't precomputed
+    '''
+    query_locs = np.asarray(query_locs, dtype=np.intp)
+    k = min(k, len(profiles) - 1)
+    best_locs = np.empty((len(query_locs), 0), dtype=np.intp)
+    best_similarities = np.empty((len(query_locs), 0), dtype=np.float32)
+    if k < 1:
+        return best_locs, best_similarities
+    queries = profiles[query_locs]
+    for start in range(0, len(profiles), block_size):
+        similarities = queries @ profiles[start:start + block_size].T
+        block_locs = np.arange(start, start + similarities.shape[1])
+        # a gene is not its own neighbor
+        similarities[block_locs[np.newaxis, :] == query_locs[:, np.newaxis]] = -np.inf
+        best_similarities = np.concatenate([best_similarities, similarities], axis=1)
+        best_locs = np.concatenate([best_locs, np.broadcast_to(block_locs, similarities.shape)], axis=1)
+        if best_similarities.shape[1] > k:
+            top = np.argpartition(-best_similarities, k - 1, axis=1)[:, :k]
+            best_similarities = np.take_along_axis(best_similarities, top, axis=1)
+            best_locs = np.take_along_axis(best_locs, top, axis=1)
+    order = np.argsort(-best_similarities, axis=1, kind='stable')
+    return np.take_along_axis(best_locs, order, axis=1), np.take_along_axis(best_similarities, order, axis=1)
+
+
+def compute_coexpression_neighbors(heatmap, metric='correlation', n_neighbors=100, query_batch_size=1024,
+                                   block_size=4096):
+    '''
+    computes the co-expression neighbors of all the genes of a heatmap of shape (cell types x genes), returns the
+    positions and the similarities of the neighbors of each gene as arrays of shape (genes x n_neighbors)
+    '''
+    profiles = normalize_gene_profiles(heatmap, metric)
+    n_genes = len(profiles)
+    n_neighbors = max(min(n_neighbors, n_genes - 1), 0)
+    neighbors = np.empty((n_genes, n_neighbors), dtype=np.int32)
+    similarities = np.empty((n_genes, n_neighbors), dtype=np.float32)
+    for query_start in range(0, n_genes, query_batch_size):
+        query_locs = np.arange(query_start, min(query_start + query_batch_size, n_genes))
+        neighbors[query_locs], similarities[query_locs] = find_nearest_profiles(profiles, query_locs, n_neighbors,
+                                                                                block_size=block_size)
+    return neighbors, similarities
+
+
+def add_coexpression_neighbors(adata, metrics=COEXPRESSION_METRICS, n_neighbors=100):
+    # stores the co-expression neighbors of each gene in the varm of a heatmap anndata
+    from scipy import sparse
+    heatmap = adata.X.toarray() if sparse.issparse(adata.X) else np.asarray(adata.X)
+    for metric in metrics:
+        neighbors, similarities = compute_coexpression_neighbors(heatmap, metric=metric, n_neighbors=n_neighbors)
+        adata.varm[COEXPRESSION_NEIGHBORS_KEY.format(metric)] = neighbors
+        adata.varm[COEXPRESSION_SIMILARITIES_KEY.format(metric)] = similarities